@@ -1,7 +1,13 @@
 from .snapshot import SnapshotHeader, SnapshotBase
 from .gadget import GadgetSnapshot
+from .multifile import GadgetMultiSnapshot
 from .sphray import SPHRAYSnapshot
+from .catalog import load_headers
+from .spatial import SpatialIndex
+from .columnar import ColumnarReader, save_columnar
+from .mesh import deposit
+from .sph import project, smooth
 
 _known_formats = ['gadget', 'sphray']
-_known_classes = [GadgetSnapshot, SPHRAYSnapshot]
+_known_classes = [GadgetSnapshot, GadgetMultiSnapshot, SPHRAYSnapshot]
 _known_classes = dict([(s.__name__, s) for s in _known_classes])
@@ -0,0 +1,137 @@
+"""
+asyncio interfaces to snapshot and Fortran record files.
+
+All file I/O is run on an executor (by default, the event loop's default
+executor), so that many files may be read concurrently from a single thread
+without blocking the event loop. Requires Python 3.7 or later.
+"""
+import asyncio
+import threading
+
+from .fortranio import FortranFile
+
+class AsyncFortranFile(object):
+    """
+    A class for reading from a file of Fortran records with asyncio.
+
+    Provides coroutine equivalents of the reading methods of FortranFile, and
+    is used as an asynchronous context manager:
+
+        >>> async with AsyncFortranFile('file_name') as ffile:
+        >>>     data = await ffile.read_record('f4')
+
+    Each method runs on the executor. Methods are run one at a time, but,
+    since the file position is shared, a sequence of calls which depends on
+    the position, e.g. seek() then read_record(), should be made as a single
+    call().
+
+    Methods:
+        call
+        read_record
+        read_record_parts
+        seek
+        skip_record
+        tell
+    """
+
+    def __init__(self, fname, executor=None, **kwargs):
+        """
+        fname: the name of the file to read from
+        executor: the concurrent.futures.Executor on which to run all I/O, or
+                  None for the event loop's default executor
+        Any additional keyword arguments are passed to FortranFile.
+        """
+        super(AsyncFortranFile, self).__init__()
+        self.executor = executor
+        self._ffile = FortranFile(fname, 'rb', **kwargs)
+        # Held by the executor thread running each call, so that a call whose
+        # coroutine is cancelled completes before the file is closed.
+        self._lock = threading.Lock()
+
+    async def __aenter__(self):
+        await self.call(FortranFile.__enter__)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await asyncio.shield(self.call(FortranFile.__exit__, None, None, None))
+
+    async def call(self, func, *args):
+        """
+        Return func(ffile, *args), run on the executor.
+
+        ffile is the underlying FortranFile. No other call is run until func
+        returns.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._locked, func,
+                                          args)
+
+    async def read_record(self, dtype='b1'):
+        """See FortranFile.read_record()."""
+        return await self.call(FortranFile.read_record, dtype)
+
+    async def read_record_parts(self, dtype, ranges, out=None):
+        """See FortranFile.read_record_parts()."""
+        return await self.call(FortranFile.read_record_parts, dtype, ranges,
+                               out)
+
+    async def seek(self, offset):
+        """See FortranFile.seek()."""
+        return await self.call(FortranFile.seek, offset)
+
+    async def skip_record(self):
+        """See FortranFile.skip_record()."""
+        return await self.call(FortranFile.skip_record)
+
+    async def tell(self):
+        """See FortranFile.tell()."""
+        return await self.call(FortranFile.tell)
+
+    def _locked(self, func, args):
+        with self._lock:
+            return func(self._ffile, *args)
+
+async def aload(snapshot, fields=None, ptypes=None, memmap=False,
+                toc_cache=False, executor=None):
+    """
+    Load in snapshot data from its file, running all I/O on executor.
+
+    See SnapshotBase.aload().
+    """
+    if ptypes is not None:
+        ptypes = list(ptypes)
+
+    blocks = []
+    async with AsyncFortranFile(snapshot.fname, executor,
+                                memmap=memmap) as ffile:
+        await ffile.call(snapshot._load_header)
+        offsets = await ffile.call(_block_offsets, snapshot, toc_cache)
+        for (name, fmt) in snapshot._schema.items():
+            dtype, ndims, valid_ptypes, _ = fmt
+            if name in offsets and (fields is None or name in fields):
+                # Awaited block by block, so the load may be cancelled between
+                # any two blocks.
+                pdata = await ffile.call(_read_block, snapshot, name,
+                                         offsets[name], ptypes)
+            else:
+                pdata = snapshot._null_block(dtype, ndims, valid_ptypes)
+            blocks.append((name, pdata))
+
+    snapshot._lazy_blocks = {}
+    for (name, pdata) in blocks:
+        setattr(snapshot, name, pdata)
+    return snapshot
+
+def _block_offsets(ffile, snapshot, toc_cache):
+    """Return the offset of each block of snapshot in the open ffile."""
+    if toc_cache:
+        return snapshot._toc_offsets(snapshot._read_toc(ffile, cache=True))
+    return snapshot._block_offsets(ffile)
+
+def _read_block(ffile, snapshot, name, offset, load_ptypes):
+    """Read and return the data for block name, at offset, from ffile."""
+    # A block with no record (see SnapshotBase._skip_block) has no offset,
+    # and nothing is read for it.
+    if offset is not None:
+        ffile.seek(offset)
+    return snapshot._read_block(ffile, name, load_ptypes)
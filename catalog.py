@@ -0,0 +1,59 @@
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from .fortranio import FortranFile
+from .gadget import GadgetSnapshot
+from .snapshot import SnapshotIOException
+
+def load_headers(fnames, snapshot_class=GadgetSnapshot, nthreads=None,
+                 **kwargs):
+    """
+    Return the headers of many snapshot files as one structured ndarray.
+
+    fnames is a sequence of file names, all of which must be of the type
+    snapshot_class (instantiated with any additional keyword arguments to
+    determine the header schema). Element i of the returned array is the
+    header of fnames[i], and has one field for each header entry. For example,
+
+        >>> headers = load_headers(fnames)
+        >>> headers['redshift']
+        array([ 9.  ,  5.  ,  3.  , ...])
+        >>> headers['npart'].shape
+        (len(fnames), 6)
+
+    Only the header record of each file is read, directly into its element of
+    the returned array, by a pool of nthreads threads (by default, one per
+    CPU). A leading Gadget format 2 label record is skipped. Headers of files
+    of non-native byte order are converted to native order.
+    """
+    dtype = snapshot_class(None, **kwargs).header.dtype
+    headers = np.empty(len(fnames), dtype=dtype)
+    jobs = [(fname, headers[i:i + 1]) for (i, fname) in enumerate(fnames)]
+
+    pool = ThreadPool(nthreads)
+    try:
+        pool.map(_read_header_into, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return headers
+
+def _read_header_into(job):
+    """Read the header record of a file into a length-one structured array."""
+    fname, out = job
+    raw = out.view('b1')
+    with FortranFile(fname, 'rb') as ffile:
+        # Gadget format 2 label records are 8 bytes; headers are larger.
+        offset = 0
+        nbytes = ffile.skip_record()
+        if nbytes == 8:
+            offset = ffile.tell()
+            nbytes = ffile.skip_record()
+        if nbytes != raw.size:
+            message = "Header of file %s does not match schema" % fname
+            raise SnapshotIOException(message)
+        ffile.seek(offset)
+        ffile.read_record_parts('b1', [(0, nbytes), ], [raw, ])
+        if ffile.byteorder != '=':
+            out.byteswap(True)
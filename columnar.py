@@ -0,0 +1,438 @@
+"""
+A chunked, compressed, columnar container for snapshot data.
+
+A container is a directory holding one data file for each particle type of
+each block, and a JSON index. Each particle type's data are split into
+chunks of chunk_size particles, and each chunk is filtered and compressed
+independently, so that any range of particles of any block may be read by
+decompressing only the chunks which hold it.
+
+    >>> from glio import ColumnarReader, GadgetSnapshot, save_columnar
+    >>> s = GadgetSnapshot('file_name')
+    >>> s.load()
+    >>> save_columnar(s, 'container_dir')
+    >>> reader = ColumnarReader('container_dir')
+    >>> gas_pos = reader.read('pos', 0, begin=1000, end=2000)
+    >>> s2 = reader.load(fname='new_file_name')
+    >>> s2.save()
+
+Only the standard library and numpy are used. Chunks are compressed with
+zlib, with lzma (where available), or not at all. Before compression, the
+'shuffle' filter groups the bytes of a chunk's items by significance, and
+the 'delta' filter replaces integers by their differences from the previous
+integer, which compresses sorted or nearly sorted IDs well.
+
+Blocks with a precision (see SnapshotBase.precisions) are quantized before
+filtering, and so are stored lossily. With precision ('box', error), data
+are stored as unsigned integers of the smallest sufficient size, in units of
+2 * error * BoxSize, wrapped into the periodic box. With precision
+('relative', error), floating-point data keep only as many mantissa bits as
+the error requires, and the remaining, zeroed, bits compress away.
+
+The index, 'index.json', is of the form
+
+    {'version': 1, 'class': snapshot class name, 'snap_format': format,
+     'chunk_size': chunk_size, 'header': {name: value},
+     'blocks': {name: {'dtype': dtype, 'ndims': ndims,
+                       'ptypes': {ptype: entry}}}}
+
+where each entry is of the form
+
+    {'rows': nrows, 'codec': codec, 'filters': [filter],
+     'quantization': quantization, 'chunks': [[offset, nbytes]]}
+
+with offsets into the file '<name>.<ptype>.dat', or else {'rows': nrows,
+'constant': value} for a particle type whose data are a single value
+broadcast to nrows particles, e.g. a header mass. quantization is None, or
+{'kind': 'box', 'step': step, 'levels': levels, 'dtype': stored dtype} or
+{'kind': 'relative', 'bits': mantissa bits}.
+"""
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+import numpy as np
+
+from .snapshot import SnapshotIOException
+
+_INDEX_NAME = 'index.json'
+_VERSION = 1
+# The default number of particles per chunk.
+_CHUNK_SIZE = 65536
+_codecs = ('zlib', 'lzma', 'none')
+_filters = ('delta', 'shuffle')
+
+def save_columnar(snapshot, path, chunk_size=_CHUNK_SIZE, codec='zlib',
+                  level=None, filters=None, precisions=None, nthreads=None):
+    """
+    Write the header and all block data of snapshot to a container at path.
+
+    path is a directory, which is created if necessary. Existing container
+    files in it are overwritten.
+
+    codec is one of 'zlib', 'lzma' or 'none', and level is the codec's
+    compression level or preset, if not the default. filters is a dict of
+    block names to lists of filters, applied in order; by default, 'ID' is
+    filtered with ['delta', 'shuffle'] and all other blocks with ['shuffle'].
+    precisions is a dict of block names to precisions, which override those
+    of the snapshot's schema; a precision of None stores a block exactly.
+    Chunks are compressed concurrently by a pool of nthreads threads (by
+    default, one per CPU).
+
+    raise a ValueError if codec, a filter or a precision is invalid or
+    unavailable.
+    """
+    if codec not in _codecs or (codec == 'lzma' and lzma is None):
+        raise ValueError('Invalid or unavailable codec: ' + str(codec))
+    if filters is None:
+        filters = {}
+    block_precisions = snapshot.precisions
+    block_precisions.update(precisions or {})
+    box = 0.0
+    if 'BoxSize' in snapshot.header.fields:
+        box = float(snapshot.header.BoxSize)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    index = {
+        'version': _VERSION,
+        'class': type(snapshot).__name__,
+        'snap_format': getattr(snapshot, 'snap_format', None),
+        'chunk_size': chunk_size,
+        'header': dict((name, np.asarray(value).tolist())
+                       for (name, value) in snapshot.header.iterfields()),
+        'blocks': {},
+    }
+
+    pool = ThreadPool(nthreads)
+    try:
+        for (name, pdata) in snapshot.iterfields():
+            dtype, ndims, _, _ = snapshot._schema[name]
+            block_filters = list(filters.get(name, _default_filters(name)))
+            for f in block_filters:
+                if f not in _filters:
+                    raise ValueError('Invalid filter: ' + str(f))
+            quantization = _quantization(block_precisions.get(name), dtype,
+                                         box)
+            entries = {}
+            for (p, parray) in enumerate(pdata):
+                if parray is None or len(parray) == 0:
+                    continue
+                fname = os.path.join(path, '%s.%d.dat' % (name, p))
+                entries[str(p)] = _write_column(pool, fname, parray, dtype,
+                                                chunk_size, codec, level,
+                                                block_filters, quantization)
+            index['blocks'][name] = {'dtype': np.dtype(dtype).str,
+                                     'ndims': ndims, 'ptypes': entries}
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(os.path.join(path, _INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+
+
+class ColumnarReader(object):
+    """
+    A class for reading from a columnar container written by save_columnar().
+
+    Chunks are decompressed concurrently by a pool of nthreads threads (by
+    default, one per CPU).
+
+    Methods:
+        load
+        read
+    """
+
+    def __init__(self, path, nthreads=None):
+        """
+        path: the container directory
+        nthreads: the number of threads used to decompress chunks
+        """
+        super(ColumnarReader, self).__init__()
+        self.path = path
+        self.nthreads = nthreads
+        with open(os.path.join(path, _INDEX_NAME), 'r') as f:
+            self._index = json.load(f)
+        if self._index.get('version') != _VERSION:
+            raise SnapshotIOException("Unsupported container version")
+
+    @property
+    def blocks(self):
+        """The names of all blocks in the container."""
+        return list(self._index['blocks'])
+
+    @property
+    def header(self):
+        """A dict of all header values in the container."""
+        return dict(self._index['header'])
+
+    def load(self, snapshot_class=None, fname=None, fields=None, ptypes=None,
+             lazy=False, **kwargs):
+        """
+        Return a snapshot holding the container's data.
+
+        The snapshot is an instance of snapshot_class (by default, the class
+        of the snapshot written to the container) initialized with fname and
+        any additional keyword arguments, so that, e.g., s.save() writes it
+        to fname. fields and ptypes are as for SnapshotBase.load().
+
+        If lazy is True, each block is read, decompressed and decoded only
+        when its attribute is first accessed, as for SnapshotBase.load().
+
+        raise a SnapshotIOException if the container's data do not match the
+        snapshot's schema.
+        """
+        if snapshot_class is None:
+            from . import _known_classes
+            snapshot_class = _known_classes[self._index['class']]
+        snapshot = snapshot_class(fname, **kwargs)
+        if self._index.get('snap_format') is not None:
+            snapshot.snap_format = self._index['snap_format']
+
+        header = snapshot.header
+        record = np.zeros(1, dtype=header.dtype)[0]
+        for name in header.fields:
+            if name in self._index['header']:
+                record[name] = self._index['header'][name]
+        for name in header.fields:
+            setattr(header, name, record[name])
+
+        snapshot._lazy_blocks = {}
+        for (name, fmt) in snapshot._schema.items():
+            dtype, ndims, valid_ptypes, _ = fmt
+            block = self._index['blocks'].get(name)
+            if block is not None and (fields is None or name in fields):
+                if (np.dtype(block['dtype']) != dtype or
+                        block['ndims'] != ndims):
+                    message = "Block '%s' does not match schema" % name
+                    raise SnapshotIOException(message)
+                if lazy:
+                    snapshot._lazy_blocks[name] = None
+                    snapshot.__dict__.pop(name, None)
+                    continue
+                pdata = self._read_block(snapshot, name, ptypes)
+            else:
+                pdata = snapshot._null_block(dtype, ndims, valid_ptypes)
+            setattr(snapshot, name, pdata)
+        if lazy:
+            snapshot._lazy_source = (lambda name:
+                                     self._read_block(snapshot, name, ptypes))
+        return snapshot
+
+    def read(self, name, ptype, begin=0, end=None):
+        """
+        Return the data of particles [begin, end) of type ptype in block name.
+
+        Only the chunks holding those particles are read and decompressed.
+        end defaults to the number of particles.
+        """
+        pool = ThreadPool(self.nthreads)
+        try:
+            return self._read(pool, name, ptype, begin, end)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _entry(self, name, ptype):
+        block = self._index['blocks'].get(name)
+        if block is None:
+            raise SnapshotIOException("Block '%s' not in container" % name)
+        entry = block['ptypes'].get(str(ptype))
+        if entry is None:
+            message = ("No data for particle type %d in block '%s'" %
+                       (ptype, name))
+            raise SnapshotIOException(message)
+        return (block, entry)
+
+    def _read(self, pool, name, ptype, begin, end):
+        """Read particles [begin, end) of a block, decompressing with pool."""
+        block, entry = self._entry(name, ptype)
+        dtype = np.dtype(block['dtype'])
+        ndims = block['ndims']
+        rows = entry['rows']
+        if end is None:
+            end = rows
+        if begin < 0 or end < begin or end > rows:
+            raise SnapshotIOException('Row range exceeds particle count')
+
+        shape = (end - begin, ndims) if ndims > 1 else (end - begin, )
+        if 'constant' in entry:
+            return np.broadcast_to(np.array(entry['constant'], dtype=dtype),
+                                   shape)
+
+        out = np.empty(shape, dtype=dtype)
+        size = self._index['chunk_size']
+        first, last = begin // size, (end - 1) // size if end > begin else -1
+        fname = os.path.join(self.path, '%s.%d.dat' % (name, ptype))
+        jobs = []
+        with open(fname, 'rb') as f:
+            for c in range(first, last + 1):
+                offset, nbytes = entry['chunks'][c]
+                f.seek(offset)
+                jobs.append((c, f.read(nbytes)))
+
+        def decode(job):
+            c, data = job
+            chunk = _decode(data, entry, dtype, ndims)
+            lo = max(begin, c * size)
+            hi = min(end, (c + 1) * size)
+            out[lo - begin:hi - begin] = chunk[lo - c * size:hi - c * size]
+
+        pool.map(decode, jobs)
+        return out
+
+    def _read_block(self, snapshot, name, ptypes):
+        """Return the data of block name for snapshot, for types ptypes."""
+        dtype, ndims, valid_ptypes, _ = snapshot._schema[name]
+        pdata = snapshot._null_block(dtype, ndims, valid_ptypes)
+        pool = ThreadPool(self.nthreads)
+        try:
+            for (p, entry) in self._index['blocks'][name]['ptypes'].items():
+                p = int(p)
+                if p not in valid_ptypes:
+                    message = ("Particle type %d not valid for block '%s'"
+                               % (p, name))
+                    raise SnapshotIOException(message)
+                if ptypes is None or p in ptypes:
+                    pdata[p] = self._read(pool, name, p, 0, entry['rows'])
+        finally:
+            pool.close()
+            pool.join()
+        return pdata
+
+def _decode(data, entry, dtype, ndims):
+    """Return the array of a chunk's items from its stored bytes."""
+    quantization = entry.get('quantization')
+    block_dtype = dtype
+    if quantization is not None and quantization['kind'] == 'box':
+        dtype = np.dtype(quantization['dtype'])
+    codec = entry['codec']
+    if codec == 'zlib':
+        data = zlib.decompress(data)
+    elif codec == 'lzma':
+        if lzma is None:
+            raise SnapshotIOException('lzma is not available')
+        data = lzma.decompress(data)
+    raw = np.frombuffer(data, dtype='u1')
+    for f in reversed(entry['filters']):
+        if f == 'shuffle':
+            raw = raw.reshape(dtype.itemsize, -1).T.reshape(-1)
+        elif f == 'delta':
+            items = raw.view(dtype)
+            raw = np.cumsum(items, dtype=dtype).view('u1')
+    array = np.array(raw).view(dtype)
+    if dtype != block_dtype:
+        array = _dequantize(array, quantization, block_dtype)
+    if ndims > 1:
+        array = array.reshape(-1, ndims)
+    return array
+
+def _default_filters(name):
+    if name == 'ID':
+        return ['delta', 'shuffle']
+    return ['shuffle']
+
+def _dequantize(array, quantization, dtype):
+    """Return the values of quantized 'box' data array, of type dtype."""
+    values = np.multiply(array, quantization['step'], dtype='f8')
+    return values.astype(dtype)
+
+def _encode(chunk, codec, level, filters, quantization):
+    """Return the stored bytes of an array chunk."""
+    if quantization is not None:
+        chunk = _quantize(chunk, quantization)
+    raw = np.ascontiguousarray(chunk).reshape(-1).view('u1')
+    for f in filters:
+        if f == 'delta':
+            items = raw.view(chunk.dtype)
+            if items.dtype.kind not in 'iu':
+                raise ValueError('delta filter requires integer data')
+            diffs = items.copy()
+            diffs[1:] -= items[:-1]
+            raw = diffs.view('u1')
+        elif f == 'shuffle':
+            raw = raw.reshape(-1, chunk.dtype.itemsize).T.reshape(-1)
+    data = raw.tobytes()
+    if codec == 'zlib':
+        return zlib.compress(data, 6 if level is None else level)
+    elif codec == 'lzma':
+        return lzma.compress(data, preset=level)
+    return data
+
+def _quantization(precision, dtype, box):
+    """
+    Return the quantization parameters for a precision, or None.
+
+    raise a ValueError if data of type dtype cannot be stored to precision.
+    """
+    if precision is None:
+        return None
+    kind, error = precision
+    if kind not in ('box', 'relative') or not 0 < error < 1:
+        raise ValueError('Invalid precision: ' + str(precision))
+    dtype = np.dtype(dtype)
+    if kind == 'box':
+        if box <= 0:
+            raise ValueError("'box' precision requires a positive BoxSize")
+        step = 2 * error * box
+        levels = int(np.ceil(box / step))
+        for stored in ('u2', 'u4', 'u8'):
+            if levels - 1 <= np.iinfo(stored).max:
+                break
+        return {'kind': kind, 'step': step, 'levels': levels,
+                'dtype': np.dtype(stored).str}
+
+    if dtype.kind != 'f':
+        raise ValueError("'relative' precision requires floating-point data")
+    # Rounding to bits mantissa bits gives a relative error of at most
+    # 2^-(bits + 1).
+    bits = max(0, int(np.ceil(-np.log2(error) - 1)))
+    return {'kind': kind, 'bits': bits}
+
+def _quantize(chunk, quantization):
+    """Return the quantized data of chunk."""
+    if quantization['kind'] == 'box':
+        levels = np.float64(quantization['levels'])
+        q = np.round(np.asarray(chunk, dtype='f8') / quantization['step'])
+        return np.mod(q, levels).astype(quantization['dtype'])
+
+    # Round each mantissa to the nearest value with only the leading bits
+    # set. A carry into the exponent gives the correctly rounded value.
+    drop = np.finfo(chunk.dtype).nmant - quantization['bits']
+    if drop <= 0:
+        return chunk
+    uint = np.dtype('u%d' % chunk.dtype.itemsize)
+    ints = np.array(chunk).view(uint)
+    ints += uint.type(1 << (drop - 1))
+    ints &= ~uint.type((1 << drop) - 1)
+    return ints.view(chunk.dtype)
+
+def _write_column(pool, fname, parray, dtype, chunk_size, codec, level,
+                  filters, quantization):
+    """Write one particle type's block data to fname. Return its entry."""
+    rows = len(parray)
+    if parray.strides[0] == 0:
+        return {'rows': rows, 'constant': np.asarray(parray[0]).tolist()}
+
+    # Converted to the schema type, and to native byte order.
+    parray = np.asarray(parray, dtype=np.dtype(dtype).newbyteorder('='))
+    chunks = [parray[b:b + chunk_size] for b in range(0, rows, chunk_size)]
+    encoded = pool.map(lambda c: _encode(c, codec, level, filters,
+                                         quantization), chunks)
+
+    entry = {'rows': rows, 'codec': codec, 'filters': filters,
+             'quantization': quantization, 'chunks': []}
+    offset = 0
+    with open(fname, 'wb') as f:
+        for data in encoded:
+            f.write(data)
+            entry['chunks'].append([offset, len(data)])
+            offset += len(data)
+    return entry
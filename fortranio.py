@@ -1,5 +1,26 @@
+from bisect import bisect_left
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import threading
+
 import numpy as np
 
+# The maximum number of buffers passed to a single os.writev call. POSIX
+# guarantees at least 16; Linux and most other systems allow 1024.
+_IOV_MAX = 1024
+# The size of the staging buffer through which non-contiguous arrays are
+# written, in bytes.
+_STAGING_BYTES = 4 * 1024 * 1024
+# File modes in which records may be read. Records may also be overwritten in
+# the last two.
+_read_modes = ('r', 'rb', 'r+', 'r+b')
+# The byte order character of non-native data.
+_swapped_order = '<' if sys.byteorder == 'big' else '>'
+# The default maximum size of all records held by a PrefetchingFortranFile,
+# in bytes.
+_PREFETCH_BYTES = 64 * 1024 * 1024
+
 class FortranIOException(Exception):
     """Base class for exceptions in the fortranio module."""
     def __init__(self, message):
@@ -11,29 +32,78 @@ class FortranFile(object):
 
     Methods:
         read_record
+        read_record_parts
+        seek
+        skip_record
         tell
         write_ndarray
         write_ndarrays
+        write_record_parts
     """
 
-    def __init__(self, fname, mode='rb', control_bytes='4'):
+    def __init__(self, fname, mode='rb', control_bytes=None, memmap=False,
+                 byteorder=None):
         """
         fname: the name of the file to read from or write to
-        mode: 'r' to read from file, 'w' to write to file; cannot be mixed
-        control_dtype: '4' for 4-byte control elements, '8' for 8-byte
+        mode: 'r' to read from file, 'w' to write to file; cannot be mixed,
+              except that 'r+' allows parts of existing records to be
+              overwritten (see write_record_parts)
+        control_dtype: '4' for 4-byte control elements, '8' for 8-byte, or
+                       None to detect the size when reading (see below), and
+                       use 4 bytes when writing
+        memmap: if True, and in read mode, records are returned as views of a
+                copy-on-write memory map of the file, rather than being read
+                into memory
+        byteorder: the byte order of the file's control elements and data;
+                   '<' for little-endian, '>' for big-endian, '=' for native,
+                   or None to detect the order when reading (see below), and
+                   use the native order when writing
+
+        When reading, an undetermined control element size and byte order are
+        found when the file is opened, as the first combination, from native
+        4-byte elements, for which the first record's head and tail control
+        elements match. Data read from a file whose byte order is not native
+        are returned as arrays of non-native dtype, which numpy byte-swaps as
+        they are used, rather than being converted when read.
         """
         super(FortranFile, self).__init__()
 
         self.fname = fname
         self._mode = mode
         self._file = None
+        self._use_memmap = memmap
+        self._memmap = None
 
-        if control_bytes == '4':
-            self._control_dtype = np.dtype('i4')
-        elif control_bytes == '8':
-            self._control_dtype = np.dtype('i8')
-        else:
+        if control_bytes not in (None, '4', '8'):
             raise ValueError('Invalid control byte size: ' + str(control_bytes))
+        if byteorder not in (None, '<', '>', '='):
+            raise ValueError('Invalid byte order: ' + str(byteorder))
+        self._control_bytes = control_bytes
+        self._byteorder = byteorder
+        self._control_dtype = None
+        self._control = None
+        if mode not in _read_modes:
+            self._set_format(control_bytes or '4', byteorder or '=')
+
+    @property
+    def byteorder(self):
+        """
+        The byte order of the file: '=' if native, else '<' or '>'.
+
+        None if it is to be detected, but the file has not yet been opened.
+        """
+        return self._byteorder
+
+    @property
+    def control_bytes(self):
+        """
+        The size in bytes of each record control element.
+
+        None if it is to be detected, but the file has not yet been opened.
+        """
+        if self._control_dtype is None:
+            return None
+        return self._control_dtype.itemsize
 
     def __enter__(self):
         """Open the file provided at initialization. Return the file object."""
@@ -48,25 +118,26 @@ class FortranFile(object):
         Read and return a record of numpy type dtype from the current file.
 
         If the record is a single value, it is returned.
-        Otherwise, a numpy.ndarray is returned.
+        Otherwise, a numpy.ndarray is returned. If the file was opened with
+        memmap=True, this is a numpy.memmap view of the record's payload, and
+        no data is read until it is accessed.
 
         dtype is the data type to read (Python type or numpy dtype or string
         identifier).
         """
-        if self._mode != 'r' and self._mode != 'rb':
+        if self._mode not in _read_modes:
             raise FortranIOException('Not in read mode')
 
-        dtype = np.dtype(dtype)
+        dtype = self._file_dtype(dtype)
 
         nbytes = self._read_control()
         nitems = nbytes // dtype.itemsize
         if nbytes % dtype.itemsize != 0:
             raise FortranIOException('Record size not valid for data type')
 
-        if nitems > 1:
-            data = np.fromfile(self._file, dtype, nitems)
-        else:
-            data = np.fromfile(self._file, dtype, nitems)[0]
+        data = self._read_items(dtype, nitems)
+        if nitems <= 1:
+            data = data[0]
 
         nbytes2 = self._read_control()
         if nbytes != nbytes2:
@@ -74,8 +145,85 @@ class FortranFile(object):
 
         return data
 
+    def read_record_parts(self, dtype, ranges, out=None):
+        """
+        Read and return parts of a record of numpy type dtype from the file.
+
+        ranges is a list whose elements are either None, or (begin, end) item
+        indices within the record. A list is returned, containing, for each
+        element of ranges, either None or a numpy.ndarray of the items in
+        [begin, end). Data outside of the given ranges are not read.
+
+        out is an optional list of C-contiguous numpy.ndarrays, one for each
+        non-None element of ranges, of the same size as that range. If
+        provided, data are read directly into these arrays, and out is
+        returned.
+
+        dtype is the data type to read (Python type or numpy dtype or string
+        identifier).
+        """
+        if self._mode not in _read_modes:
+            raise FortranIOException('Not in read mode')
+
+        dtype = self._file_dtype(dtype)
+
+        nbytes = self._read_control()
+        if nbytes % dtype.itemsize != 0:
+            raise FortranIOException('Record size not valid for data type')
+
+        start = self._file.tell()
+        parts = []
+        for rng in ranges:
+            if rng is None:
+                parts.append(None)
+                continue
+            begin, end = rng
+            if begin < 0 or end < begin or end * dtype.itemsize > nbytes:
+                raise FortranIOException('Range exceeds record size')
+            self._file.seek(start + begin * dtype.itemsize)
+            if out is None:
+                parts.append(self._read_items(dtype, end - begin))
+            else:
+                parts.append(self._read_items_into(out[len(parts)], dtype,
+                                                   end - begin))
+
+        self._file.seek(start + nbytes)
+        nbytes2 = self._read_control()
+        if nbytes != nbytes2:
+            raise FortranIOException('Record head and tail mismatch')
+
+        return parts
+
+    def seek(self, offset):
+        """Move to the absolute location offset in the file. Proxy for
+        file.seek() method.
+        """
+        if self._file is None:
+            raise FortranIOException('No file is open')
+
+        self._file.seek(offset)
+
+    def skip_record(self):
+        """
+        Move past the next record in the current file without reading it.
+
+        Only the record's control bytes are read. Return the size of the
+        record's payload in bytes.
+        """
+        if self._mode not in _read_modes:
+            raise FortranIOException('Not in read mode')
+
+        nbytes = self._read_control()
+        self._file.seek(nbytes, 1)
+        nbytes2 = self._read_control()
+        if nbytes != nbytes2:
+            raise FortranIOException('Record head and tail mismatch')
+
+        return nbytes
+
     def tell(self):
-        """Return the current location in the file. Proxy for file.tell() method.
+        """
+        Return the current location in the file. Proxy for file.tell() method.
         """
         if self._file is None:
             raise FortranIOException('No file is open')
@@ -98,23 +246,23 @@ class FortranFile(object):
             # writing the record control bytes.
             raise TypeError('array is not an ndarray')
 
-        if array.nbytes > np.iinfo(self._control_dtype).max:
-            raise FortranIOException('Record size exceeds maximum')
-
-        self._write_control(array.nbytes)
-        array.tofile(self._file)
-        self._write_control(array.nbytes)
+        self.write_ndarrays([array, ])
 
     def write_ndarrays(self, arrays):
         """
         Write multiple numpy.ndarray instances as a single Fortran record.
 
         arrays must be an iterable, containing one or more numpy ndarray
-        instances.
+        instances. The record, including its control bytes, is written with
+        a single vectored write where possible. Arrays need not be contiguous;
+        non-contiguous arrays, and arrays not in the file's byte order, are
+        written through a fixed-size staging buffer, rather than being copied
+        in full.
         """
         if self._mode != 'w' and self._mode != 'wb':
             raise FortranIOException('Not in write mode')
 
+        arrays = list(arrays)
         nbytes = 0
         for array in arrays:
             nbytes += array.nbytes
@@ -122,16 +270,136 @@ class FortranFile(object):
         if nbytes > np.iinfo(self._control_dtype).max:
             raise FortranIOException('Record size exceeds maximum')
 
-        self._write_control(nbytes)
-        for array in arrays:
-            array.tofile(self._file)
-        self._write_control(nbytes)
+        self._control[0] = nbytes
+        self._write_arrays([self._control, ] + arrays + [self._control, ])
+
+    def write_record_parts(self, dtype, ranges, arrays):
+        """
+        Overwrite parts of the next record in the file, in place.
+
+        ranges is a list of (begin, end) item indices within the record, and
+        arrays a list of numpy.ndarrays of numpy type dtype, in any byte
+        order, one for each range, of the same size as that range. The data
+        of each array replace the items in its range; all other data, and the
+        record's size, are unchanged.
+
+        The file must have been opened in mode 'r+' or 'r+b'.
+        """
+        if self._mode not in _read_modes[2:]:
+            raise FortranIOException('Not in read-write mode')
+
+        dtype = self._file_dtype(dtype)
+
+        nbytes = self._read_control()
+        start = self._file.tell()
+        for (rng, array) in zip(ranges, arrays):
+            begin, end = rng
+            if begin < 0 or end < begin or end * dtype.itemsize > nbytes:
+                raise FortranIOException('Range exceeds record size')
+            if (array.dtype.newbyteorder(self._byteorder) != dtype or
+                    array.size != end - begin):
+                raise FortranIOException('Array does not match range')
+            self._file.seek(start + begin * dtype.itemsize)
+            # Written through the file object, so that any data it has
+            # buffered for reading are kept consistent.
+            for buffers in _buffer_runs([array, ], self._byteorder):
+                for buf in buffers:
+                    self._file.write(buf)
+
+        self._file.seek(start + nbytes)
+        nbytes2 = self._read_control()
+        if nbytes != nbytes2:
+            raise FortranIOException('Record head and tail mismatch')
 
     def _close(self):
         if self._file is None:
             raise FortranIOException("File not open")
         self._file.close()
         self._file = None
+        # Arrays returned by read_record hold their own reference to the map.
+        self._memmap = None
+
+    def _detect_format(self):
+        """
+        Set any undetermined control element size and byte order of the file.
+
+        Each candidate size and byte order is tried in turn, native 4-byte
+        elements first, until the first record's head and tail control
+        elements match. If none match, or the file is empty, 4-byte native
+        elements are assumed, and reading will fail as it would otherwise.
+        """
+        sizes = [self._control_bytes] if self._control_bytes else ['4', '8']
+        orders = ([self._byteorder] if self._byteorder else
+                  ['=', _swapped_order])
+        fsize = os.fstat(self._file.fileno()).st_size
+        for size in sizes:
+            for order in orders:
+                dtype = np.dtype('i' + size).newbyteorder(order)
+                self._file.seek(0)
+                head = np.fromfile(self._file, dtype, 1)
+                if len(head) != 1 or head[0] < 0:
+                    continue
+                nbytes = int(head[0])
+                if nbytes + 2 * dtype.itemsize > fsize:
+                    continue
+                self._file.seek(dtype.itemsize + nbytes)
+                tail = np.fromfile(self._file, dtype, 1)
+                if len(tail) == 1 and tail[0] == nbytes:
+                    self._file.seek(0)
+                    self._set_format(size, order)
+                    return
+        self._file.seek(0)
+        self._set_format(sizes[0], orders[0])
+
+    def _file_dtype(self, dtype):
+        """Return numpy type dtype in the byte order of the file."""
+        dtype = np.dtype(dtype)
+        if self._byteorder == '=':
+            return dtype
+        return dtype.newbyteorder(self._byteorder)
+
+    def _read_items(self, dtype, nitems):
+        """
+        Return an ndarray of the next nitems items of type dtype in the file.
+
+        The array is a view of the memory map, if there is one.
+        """
+        if self._memmap is not None:
+            return self._map_payload(dtype, nitems)
+        return np.fromfile(self._file, dtype, nitems)
+
+    def _read_items_into(self, array, dtype, nitems):
+        """
+        Read the next nitems items of type dtype in the file into array.
+
+        Return array.
+        """
+        if array.size != nitems or array.dtype.itemsize != dtype.itemsize:
+            raise FortranIOException('Output array does not match range')
+        if self._memmap is not None:
+            array.reshape(-1)[:] = self._map_payload(dtype, nitems)
+        else:
+            nbytes = nitems * dtype.itemsize
+            if self._file.readinto(array) != nbytes:
+                raise FortranIOException('Unexpected end of file')
+            if array.dtype.isnative != dtype.isnative:
+                # Raw file data were read, so must be converted in place.
+                array.byteswap(True)
+        return array
+
+    def _map_payload(self, dtype, nitems):
+        """
+        Return a view of the next nitems items of type dtype in the memory map.
+
+        The file position is advanced past the mapped items, as though they had
+        been read.
+        """
+        begin = self._file.tell()
+        end = begin + nitems * dtype.itemsize
+        if end > len(self._memmap):
+            raise FortranIOException('Record extends beyond end of file')
+        self._file.seek(end)
+        return self._memmap[begin:end].view(dtype)
 
     def _open(self):
         if self._file is not None:
@@ -139,11 +407,441 @@ class FortranFile(object):
             raise FortranIOException("File already open")
 
         self._file = open(self.fname, self._mode)
+        if self._control_dtype is None:
+            self._detect_format()
+        if self._use_memmap and 'r' in self._mode:
+            # Copy-on-write, so that returned arrays may be modified in-place
+            # without altering the file.
+            self._memmap = np.memmap(self.fname, dtype='u1', mode='c')
 
     def _read_control(self):
         n, = np.fromfile(self._file, self._control_dtype, 1)
-        return n
+        return int(n)
+
+    def _set_format(self, control_bytes, byteorder):
+        """Set the control element size and byte order of the file."""
+        if (byteorder != '=' and
+                np.dtype('i4').newbyteorder(byteorder).isnative):
+            byteorder = '='
+        self._byteorder = byteorder
+        control_dtype = np.dtype('i' + control_bytes)
+        self._control_dtype = control_dtype.newbyteorder(byteorder)
+        # Preallocated, so that writing a record requires no new buffers for
+        # its control bytes.
+        self._control = np.zeros(1, dtype=self._control_dtype)
+
+    def _write_arrays(self, arrays):
+        """
+        Write the data of each ndarray in arrays to the file, in order.
+
+        See _buffer_runs().
+        """
+        # Anything buffered by the file object must precede our writes.
+        self._file.flush()
+        fd = self._file.fileno()
+        for buffers in _buffer_runs(arrays, self._byteorder):
+            _write_buffers(fd, buffers)
 
-    def _write_control(self, n):
-        a = np.array([n, ], dtype=self._control_dtype)
-        a.tofile(self._file)
+
+class PrefetchingFortranFile(FortranFile):
+    """
+    A class for reading a file of Fortran records, reading ahead of the caller.
+
+    Provides the same methods as a FortranFile in read mode. In addition, a
+    background thread, with its own handle on the file, reads the records
+    following the current one, in file order, while the caller processes
+    the current record. read_record() then returns a prefetched record
+    without waiting for the disk, where possible.
+
+    At most budget bytes of record data are held at once, except that a
+    single record larger than budget is still prefetched. Prefetched records
+    which the caller skips over are discarded. Seeking anywhere other than
+    forward restarts prefetching from the new position.
+
+    If offsets is given, only the records at those offsets are prefetched,
+    and all other records are read only when, and if, the caller reads them.
+    The offsets may be replaced once the file is open, with set_offsets(),
+    e.g. after the caller has located the records it needs.
+    """
+
+    def __init__(self, fname, control_bytes=None, byteorder=None,
+                 budget=_PREFETCH_BYTES, offsets=None):
+        """
+        fname: the name of the file to read from
+        control_bytes, byteorder: as for FortranFile
+        budget: the maximum number of bytes of prefetched record data
+        offsets: the file offsets of the only records to prefetch; by
+                 default, all records are prefetched
+        """
+        super(PrefetchingFortranFile, self).__init__(
+            fname, 'rb', control_bytes=control_bytes, byteorder=byteorder)
+        self.budget = budget
+        self.offsets = None if offsets is None else sorted(set(offsets))
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def read_record(self, dtype='b1'):
+        """
+        Read and return a record of numpy type dtype from the current file.
+
+        See FortranFile.read_record().
+        """
+        position = self._file.tell()
+        prefetched = self._take(position)
+        if prefetched is None:
+            return super(PrefetchingFortranFile, self).read_record(dtype)
+
+        data, end = prefetched
+        dtype = self._file_dtype(dtype)
+        if len(data) % dtype.itemsize != 0:
+            raise FortranIOException('Record size not valid for data type')
+        self._file.seek(end)
+        data = np.frombuffer(data, dtype=dtype)
+        if data.size <= 1:
+            data = data[0]
+        return data
+
+    def set_offsets(self, offsets):
+        """
+        Prefetch only the records at offsets, or all records if None.
+
+        Prefetching restarts from the current position in the file, and
+        records already prefetched which are not at offsets are discarded.
+        """
+        with self._cond:
+            self.offsets = None if offsets is None else sorted(set(offsets))
+            if self.offsets is not None:
+                for offset in [o for o in self._records
+                               if o not in self.offsets]:
+                    self._nbytes -= len(self._records.pop(offset)[0])
+            position = self._following(self._file.tell())
+            if position is None:
+                self._restart = None
+                self._next = None
+                self._ended = True
+            elif position not in self._records:
+                self._restart = position
+            self._cond.notify_all()
+
+    def _close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        super(PrefetchingFortranFile, self)._close()
+
+    def _following(self, offset):
+        """
+        Return the offset of the first record to prefetch at or after offset.
+
+        Return None if there is no such record.
+        """
+        if self.offsets is None:
+            return offset
+        i = bisect_left(self.offsets, offset)
+        if i == len(self.offsets):
+            return None
+        return self.offsets[i]
+
+    def _open(self):
+        super(PrefetchingFortranFile, self)._open()
+        # Records prefetched, by file offset, as (data, end offset) pairs.
+        self._records = {}
+        self._nbytes = 0
+        # Where the background thread reads next, whether it may read no
+        # further, and any position from which it should restart.
+        self._next = self._following(self._file.tell())
+        self._ended = self._next is None
+        self._restart = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._prefetch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _prefetch(self):
+        """Read records ahead of the caller. Runs in the background thread."""
+        with open(self.fname, 'rb') as f:
+            while True:
+                with self._cond:
+                    while not self._stopped and self._restart is None and (
+                            self._ended or (self._records and
+                                            self._nbytes >= self.budget)):
+                        self._cond.wait()
+                    if self._stopped:
+                        return
+                    if self._restart is not None:
+                        self._next = self._restart
+                        self._restart = None
+                        self._ended = False
+                    offset = self._next
+
+                record = self._read_at(f, offset)
+
+                with self._cond:
+                    if self._restart is None and self._next == offset:
+                        if record is None:
+                            self._ended = True
+                        else:
+                            data, end = record
+                            self._records[offset] = record
+                            self._nbytes += len(data)
+                            self._next = self._following(end)
+                            self._ended = self._next is None
+                    self._cond.notify_all()
+
+    def _read_at(self, f, offset):
+        """
+        Read the record at offset in the open file f.
+
+        Return a (data, end offset) pair, or None if there is no valid record
+        at offset, in which case the caller reads it directly, and so raises
+        the appropriate exception.
+        """
+        try:
+            f.seek(offset)
+            head = np.fromfile(f, self._control_dtype, 1)
+            if len(head) != 1 or head[0] < 0:
+                return None
+            data = bytearray(int(head[0]))
+            if f.readinto(data) != len(data):
+                return None
+            tail = np.fromfile(f, self._control_dtype, 1)
+            if len(tail) != 1 or tail[0] != head[0]:
+                return None
+        except (IOError, OSError, ValueError, MemoryError):
+            return None
+        return (data, f.tell())
+
+    def _take(self, position):
+        """
+        Return the prefetched (data, end offset) of the record at position.
+
+        Wait for the record if it is yet to be read. Records before position
+        are discarded. Return None if the record cannot be prefetched, or is
+        not among offsets.
+        """
+        if self.offsets is not None and self._following(position) != position:
+            return None
+        with self._cond:
+            for offset in [o for o in self._records if o < position]:
+                self._nbytes -= len(self._records.pop(offset)[0])
+            if position not in self._records and (
+                    self._restart is not None or position != self._next):
+                # Not on the background thread's path, so redirect it.
+                for offset in list(self._records):
+                    self._nbytes -= len(self._records.pop(offset)[0])
+                self._restart = position
+            self._cond.notify_all()
+
+            while position not in self._records:
+                if (self._restart is None and self._next == position and
+                        self._ended):
+                    return None
+                self._cond.wait()
+
+            data, end = self._records.pop(position)
+            self._nbytes -= len(data)
+            self._cond.notify_all()
+            return (data, end)
+
+
+class ParallelFortranWriter(object):
+    """
+    A class for writing a file of Fortran records using multiple threads.
+
+    Provides the same methods for writing as a FortranFile in write mode.
+    However, records are not written as the methods are called. Instead, the
+    location of every record is computed as it is added, and, when the
+    context is exited without error, the file is sized and all records are
+    written concurrently by a pool of threads, using positional writes.
+    Arrays passed to the writer must not be modified until then.
+
+    Large arrays are split into pieces of at most piece_bytes, so that a
+    single large record is also written by many threads.
+
+    Methods:
+        tell
+        write_ndarray
+        write_ndarrays
+    """
+
+    def __init__(self, fname, control_bytes='4', nthreads=None,
+                 piece_bytes=64 * 1024 * 1024):
+        """
+        fname: the name of the file to write to
+        control_dtype: '4' for 4-byte control elements, '8' for 8-byte
+        nthreads: the number of writing threads; by default, one per CPU
+        piece_bytes: the maximum number of bytes written by one positional
+                     write of a contiguous array
+        """
+        super(ParallelFortranWriter, self).__init__()
+
+        if not hasattr(os, 'pwrite'):
+            raise FortranIOException('Positional writes are not supported')
+
+        self.fname = fname
+        self.nthreads = nthreads
+        self._piece_bytes = piece_bytes
+        self._pieces = []
+        self._position = 0
+
+        if control_bytes == '4':
+            self._control_dtype = np.dtype('i4')
+        elif control_bytes == '8':
+            self._control_dtype = np.dtype('i8')
+        else:
+            raise ValueError('Invalid control byte size: ' +
+                             str(control_bytes))
+
+    @property
+    def control_bytes(self):
+        """The size in bytes of each record control element."""
+        return self._control_dtype.itemsize
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._write()
+
+    def tell(self):
+        """Return the location in the file at which the next record begins."""
+        return self._position
+
+    def write_ndarray(self, array):
+        """
+        Add a numpy.ndarray to the file as a Fortran record.
+
+        See FortranFile.write_ndarray().
+        """
+        if not isinstance(array, np.ndarray):
+            raise TypeError('array is not an ndarray')
+        self.write_ndarrays([array, ])
+
+    def write_ndarrays(self, arrays):
+        """
+        Add multiple numpy.ndarray instances to the file as a Fortran record.
+
+        See FortranFile.write_ndarrays().
+        """
+        arrays = list(arrays)
+        nbytes = 0
+        for array in arrays:
+            nbytes += array.nbytes
+
+        if nbytes > np.iinfo(self._control_dtype).max:
+            raise FortranIOException('Record size exceeds maximum')
+
+        control = np.array([nbytes, ], dtype=self._control_dtype)
+        self._add_piece(control)
+        for array in arrays:
+            # Only arrays already in the file's (native) byte order may be
+            # split as raw bytes; others are converted by _buffer_runs().
+            native = array.dtype == array.dtype.newbyteorder('=')
+            if (native and array.flags.c_contiguous and
+                    array.nbytes > self._piece_bytes):
+                data = array.reshape(-1).view('u1')
+                for begin in range(0, data.nbytes, self._piece_bytes):
+                    self._add_piece(data[begin:begin + self._piece_bytes])
+            elif array.nbytes > 0:
+                self._add_piece(array)
+        self._add_piece(control)
+
+    def _add_piece(self, array):
+        self._pieces.append((self._position, array))
+        self._position += array.nbytes
+
+    def _write(self):
+        """Size the file, and write all pieces concurrently."""
+        fd = os.open(self.fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            # A sparse file suffices, as every byte is then written. Unlike
+            # posix_fallocate, which some filesystems emulate by writing
+            # zeros or do not support, this writes no data.
+            os.ftruncate(fd, self._position)
+
+            def write_piece(piece):
+                offset, array = piece
+                for buffers in _buffer_runs([array, ]):
+                    offset = _write_buffers(fd, buffers, offset)
+
+            pool = ThreadPool(self.nthreads)
+            try:
+                pool.map(write_piece, self._pieces)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            os.close(fd)
+        self._pieces = []
+
+
+def _buffer_runs(arrays, byteorder='='):
+    """
+    Generate lists of contiguous byte arrays holding the data of arrays.
+
+    Taken in order, the generated buffers hold the data of each ndarray in
+    arrays in C order and the given byte order, as for ndarray.tofile(). Runs
+    of contiguous arrays already in that byte order are generated as views of
+    their memory. Other arrays are copied, in chunks, to a staging buffer of
+    bounded size, which is reused; each list must therefore be written before
+    the next is generated.
+    """
+    pending = []
+    staging = None
+    for array in arrays:
+        dtype = array.dtype.newbyteorder(byteorder)
+        if array.flags.c_contiguous and array.dtype == dtype:
+            pending.append(array.reshape(-1).view('u1'))
+            continue
+
+        if pending:
+            yield pending
+            pending = []
+        rows = array.reshape((1, ) + array.shape) if array.ndim == 0 else array
+        rowbytes = max(rows[0:1].nbytes, 1)
+        if staging is None or staging.nbytes < rowbytes:
+            staging = np.empty(max(_STAGING_BYTES, rowbytes), 'u1')
+        step = staging.nbytes // rowbytes
+        for begin in range(0, len(rows), step):
+            chunk = rows[begin:begin + step]
+            staged = staging[:chunk.nbytes].view(dtype)
+            staged = staged.reshape(chunk.shape)
+            np.copyto(staged, chunk)
+            yield [staged.reshape(-1).view('u1'), ]
+    if pending:
+        yield pending
+
+def _write_buffers(fd, buffers, offset=None):
+    """
+    Write the contiguous byte arrays in buffers, in order, to file
+    descriptor fd.
+
+    If offset is None, buffers are written at the current file position,
+    using os.writev where available to write many buffers per system call.
+    Otherwise, they are written at offset using positional writes, and the
+    offset following the written data is returned.
+    """
+    buffers = [b for b in buffers if b.nbytes > 0]
+    while buffers:
+        if offset is None:
+            if hasattr(os, 'writev'):
+                written = os.writev(fd, buffers[:_IOV_MAX])
+            else:
+                written = os.write(fd, buffers[0])
+        else:
+            if hasattr(os, 'pwritev'):
+                written = os.pwritev(fd, buffers[:_IOV_MAX], offset)
+            else:
+                written = os.pwrite(fd, buffers[0], offset)
+            offset += written
+        # Drop all fully-written buffers, and trim a partially-written one.
+        while buffers and written >= buffers[0].nbytes:
+            written -= buffers[0].nbytes
+            buffers.pop(0)
+        if written > 0:
+            buffers[0] = buffers[0][written:]
+    return offset
@@ -1,8 +1,11 @@
 from collections import OrderedDict
+import os
 
 import numpy as np
 
-from .snapshot import SnapshotBase, SnapshotIOException
+from . import sidecar
+from .peano import peano_hilbert_keys, PH_BITS
+from .snapshot import SnapshotBase, SnapshotIOException, TOCEntry
 
 # The following numpy shorthand types are used:
 # 'i4' = integer          = 4 bytes.
@@ -37,9 +40,10 @@ _g_header_schema = OrderedDict([
     ('_padding', ('i4', 15)),
 ])
 
-# block_name, (type[, ndims[, particletype[, flag]]]).
+# block_name, (type[, ndims[, particletype[, flag[, precision]]]]).
 # If present, flag may be boolean-like, or a string corresponding to a header
 # schema entry, e.g. 'flag_metals'.
+# If present, precision is as for SnapshotBase.precisions.
 # Gadget IC files need contain data only up to and including internal energy,
 # and in glio are treated as if no further data is present.
 _g_IC_blocks_schema = OrderedDict([
@@ -53,6 +57,38 @@ _g_blocks_schema = OrderedDict([(k, v) for k, v in _g_IC_blocks_schema.items()])
 _g_blocks_schema['rho']  = ('f4', 1, [0,])
 _g_blocks_schema['hsml'] = ('f4', 1, [0,])
 
+# block_name, label.
+# In Gadget format 2 (SnapFormat=2) files, each block, and the header, is
+# preceded by a record holding a four-character label, and the size of the
+# block's record. Blocks not listed here are labelled with the first four
+# characters of their name, in upper case and padded with spaces.
+_g_header_label = 'HEAD'
+_g_block_labels = {
+    'pos': 'POS ',
+    'vel': 'VEL ',
+    'ID': 'ID  ',
+    'mass': 'MASS',
+    'u': 'U   ',
+    'rho': 'RHO ',
+    'hsml': 'HSML',
+}
+# nextblock is the size in bytes of the following record, including its
+# control bytes.
+_g_label_dtype = np.dtype([('label', 'S4'), ('nextblock', 'i4')])
+
+# Constants used by derived fields, in cgs units. The mean molecular weight is
+# that of a fully ionized gas of primordial composition (hydrogen mass fraction
+# 0.76), and the unit of velocity is Gadget's default, 1 km/s.
+_g_gamma = 5 / 3.
+_g_mu = 4 / (3 + 5 * 0.76)
+_g_proton_mass = 1.6726219e-24
+_g_boltzmann = 1.38064852e-16
+_g_unit_velocity = 1e5
+
+# The number of particles per chunk for which the range of Peano-Hilbert keys
+# is recorded, when saving in Peano-Hilbert order.
+_g_ph_chunk_size = 65536
+
 _g_ptype_map = {
     'gas': 0,
     'halo': 1,
@@ -103,6 +139,14 @@ class GadgetSnapshot(SnapshotBase):
         >>> p0.shape
         (3,)
 
+    Where the mass of a particle type is given in the header, rather than in
+    the file's mass block, its mass data is a read-only array of that single
+    value, which requires no memory for its elements. When saving, such arrays
+    are written to the header and not to the mass block. To give these
+    particles individual masses, assign a new array, e.g.
+
+        >>> s.mass[1] = np.array(s.mass[1])
+
     Finally, the Gadget-2 particle types are aliased as follows:
 
         0: gas
@@ -128,6 +172,21 @@ class GadgetSnapshot(SnapshotBase):
     indices, is accessible via the s.ptype_aliases attribute.
 
 
+    Derived fields
+    --------------
+
+    The following derived fields (see SnapshotBase) are available,
+
+        temperature: gas temperature in K, from u, for a fully ionized gas of
+                     primordial composition and Gadget's default units
+        specific_kinetic_energy: 0.5 * |vel|^2, in the units of u
+        radius: distance from s.centre, or from the centre of the box if
+                s.centre is None; in a periodic box, that of the nearest
+                periodic image
+
+    and may be accessed as, e.g., s.temperature[0] or s.gas.temperature.
+
+
     Acessing metadata
     -----------------
 
@@ -139,11 +198,29 @@ class GadgetSnapshot(SnapshotBase):
         >>> s.header
 
     For the latter, see the SnapshotHeader class.
+
+
+    File formats
+    ------------
+
+    Both the original Gadget file format (SnapFormat=1), in which blocks are
+    identified by their position in the file, and format 2 (SnapFormat=2), in
+    which each block is preceded by a four-character label, are supported.
+    The format of a file is detected when it is loaded, and is available as
+
+        >>> s.snap_format
+        2
+
+    For format 2 files, blocks are located by their labels, so that blocks
+    may be loaded in any order and unknown blocks are ignored. A snapshot is
+    saved in the format given by s.snap_format, which may be assigned to, and
+    which is 1 if no format has been set or detected. Block labels may be
+    customized by passing a {block_name: label} dict as block_labels.
     """
 
     def __init__(self, fname, header_schema=_g_header_schema,
                  blocks_schema=_g_blocks_schema, ptype_aliases=_g_ptype_map,
-                 ICfile=False, **kwargs):
+                 ICfile=False, snap_format=None, block_labels=None, **kwargs):
         """Initializes a Gadget snapshot."""
         if ICfile:
             blocks_schema = _g_IC_blocks_schema
@@ -152,11 +229,86 @@ class GadgetSnapshot(SnapshotBase):
                                              blocks_schema=blocks_schema,
                                              ptype_aliases=ptype_aliases,
                                              **kwargs)
+        self.snap_format = snap_format
+        self._labels = self._block_labels(block_labels)
+        # The centre from which the derived 'radius' field is measured.
+        self.centre = None
+
+    def save(self, fname=None, nthreads=1, peano_hilbert=False):
+        """
+        Write header and snapshot to the current file, overwriting the file.
+
+        See SnapshotBase.save().
 
-    def save(self, fname=None):
+        If peano_hilbert is True, the particles of each type are first sorted
+        along a Peano-Hilbert curve, with sort_peano_hilbert(). The first and
+        last keys of each chunk of particles are then saved in a JSON sidecar
+        file alongside the file, with the suffix 'phkeys', as
+
+            {'bits': bits, 'origin': origin, 'size': size,
+             'chunk_size': chunk_size, 'ranges': ranges}
+
+        where ranges has, for each particle type, either None or a list of
+        [first key, last key] pairs for particles [0, chunk_size),
+        [chunk_size, 2 * chunk_size), and so on, so that the particles in a
+        region of space may be located in the file from their keys. See
+        peano.peano_hilbert_keys().
+        """
         if self.header.num_files != 1:
             raise SnapshotIOException("header num_files must be np.int32(1)")
-        super(GadgetSnapshot, self).save(fname)
+        if peano_hilbert:
+            # Checked first, so that a snapshot which cannot be saved is not
+            # left reordered.
+            self._verify_save()
+            keys = self.sort_peano_hilbert()
+        super(GadgetSnapshot, self).save(fname, nthreads)
+
+        if peano_hilbert:
+            origin, size = self._ph_cube()
+            self._save_ph_ranges(fname or self.fname, keys, origin, size)
+
+    def sort_peano_hilbert(self):
+        """
+        Sort the particles of each type along a Peano-Hilbert curve of pos.
+
+        The data of every block are permuted consistently for each particle
+        type, so that particles close along the curve, and so in space, are
+        close in the snapshot's arrays, and in any file it is saved to. The
+        curve spans the periodic box if header.BoxSize is positive, and
+        otherwise the cube bounding all particles.
+
+        A list is returned with, for each particle type, either None, if the
+        type has no position data, or the sorted array of its keys.
+
+        raise a SnapshotIOException if a block's particle count is
+        inconsistent with that of pos.
+        """
+        # All types are checked before any is sorted, so that the snapshot is
+        # unchanged if any is inconsistent.
+        for (p, pos) in enumerate(self.pos):
+            if pos is None:
+                continue
+            for name in self.fields:
+                parray = getattr(self, name)[p]
+                if parray is not None and len(parray) not in (0, len(pos)):
+                    message = "npart mismatch for particle type " + str(p)
+                    raise SnapshotIOException(message)
+
+        origin, size = self._ph_cube()
+        keys = [None for _ in self.ptype_indices]
+        for (p, pos) in enumerate(self.pos):
+            if pos is None:
+                continue
+            pkeys = peano_hilbert_keys(pos, origin, size)
+            order = np.argsort(pkeys, kind='mergesort')
+            keys[p] = pkeys[order]
+            for name in self.fields:
+                parray = getattr(self, name)[p]
+                if parray is None or len(parray) == 0:
+                    continue
+                if not self._is_header_mass_array(parray):
+                    getattr(self, name)[p] = parray[order]
+        return keys
 
     def update_header(self):
         """
@@ -165,11 +317,144 @@ class GadgetSnapshot(SnapshotBase):
         raise a SnapshotIOException if an inconsistency is found.
         """
         self._update_npars()
+        self._update_header_masses()
+
+    def verify(self):
+        """
+        Return a list of fields which do not conform to the schema.
+
+        See SnapshotBase.verify(). Mass data given in the header are of the
+        type of header.mass, rather than of the mass block, and are valid.
+        """
+        malformed = super(GadgetSnapshot, self).verify()
+        if 'mass' in malformed:
+            dtype = self._schema['mass'][0]
+            if all(a.dtype.newbyteorder('=') == dtype or
+                   self._is_header_mass_array(a)
+                   for a in self.mass if a is not None):
+                malformed.remove('mass')
+        return malformed
 
     def _block_exists(self, name, ptypes):
         """Return True if specified particle types exist for specified block."""
         return any(self.header.npart[i] > 0 for i in ptypes)
 
+    def _block_labels(self, block_labels=None):
+        """
+        Return a dict of format 2 labels for all blocks in the schema.
+
+        raise a SnapshotIOException if a label is invalid or not unique.
+        """
+        labels = {}
+        for name in self.fields:
+            labels[name] = name.upper()[:4].ljust(4)
+        labels.update((k, v) for (k, v) in _g_block_labels.items()
+                      if k in labels)
+        if block_labels is not None:
+            labels.update(block_labels)
+
+        values = list(labels.values())
+        for (name, label) in labels.items():
+            if len(label) != 4 or values.count(label) > 1:
+                message = ("Label '%s' for block '%s' is invalid" %
+                           (label, name))
+                raise SnapshotIOException(message)
+        return labels
+
+    def _block_layout(self, name, ndims, ptypes):
+        """
+        Return the location of each particle type's data within a block.
+
+        A list is returned with, for each particle type, either a (begin, end)
+        pair of item indices within the block's record, or None if the block
+        holds no data for that particle type. The latter is the case for
+        particle types not valid for the block and, for the mass block, for
+        particle types whose mass is given in the header.
+        """
+        begin = 0
+        layout = []
+        for (p, n) in zip(self.ptype_indices, self.header.npart):
+            if p not in ptypes or (name == 'mass' and
+                                   self.header.mass[p] != 0):
+                layout.append(None)
+            else:
+                end = begin + n * ndims
+                layout.append((begin, end))
+                begin = end
+        return layout
+
+    def _block_offsets(self, ffile):
+        """
+        Return the offset of each block present in the open FortranFile ffile.
+
+        For format 2 files, offsets are found from the block labels.
+        """
+        if self.snap_format != 2:
+            return super(GadgetSnapshot, self)._block_offsets(ffile)
+        return self._toc_offsets(self._toc_entries(ffile))
+
+    def _has_mass_block(self):
+        """
+        Return True if the mass block exists in the file, False otherwise.
+
+        A value of False implies that all masses are specified in the header.
+        """
+        n = np.logical_and(self.header.npart > 0, self.header.mass == 0).sum()
+        return n > 0
+
+    def _header_mass_array(self, mass, n):
+        """
+        Return a read-only array of n elements of value mass.
+
+        The array is a broadcast view of a single value, and so requires no
+        memory for its elements. Its type is that of header.mass, so that the
+        header's value is kept exactly. When saving, such arrays are written
+        to the header rather than to the mass block.
+        """
+        dtype = self.header._schema['mass'][0]
+        return np.broadcast_to(np.asarray(mass, dtype=dtype), (n, ))
+
+    def _incomplete_blocks(self):
+        """
+        Return the names of blocks lacking data for types with particles.
+
+        See SnapshotBase._incomplete_blocks(). Types whose masses are given in
+        the header need no mass data.
+        """
+        incomplete = super(GadgetSnapshot, self)._incomplete_blocks()
+        if 'mass' in incomplete:
+            if all(m != 0 or a is not None and len(a) == n
+                   for (a, m, n) in zip(self.mass, self.header.mass,
+                                        self.header.npart) if n > 0):
+                incomplete.remove('mass')
+        return incomplete
+
+    def _is_header_mass_array(self, array):
+        """Return True if array was created by _header_mass_array()."""
+        return array.ndim == 1 and array.strides == (0, )
+
+    def _load(self, ffile, fields=None, load_ptypes=None):
+        """
+        Load data for each block in the schema from the open FortranFile ffile.
+
+        For format 2 files, blocks are located by their labels, and blocks not
+        present in the file are set to null blocks.
+        """
+        if self.snap_format != 2:
+            return super(GadgetSnapshot, self)._load(ffile, fields,
+                                                     load_ptypes)
+
+        offsets = self._block_offsets(ffile)
+        for (name, fmt) in self._schema.items():
+            dtype, ndims, ptypes, _ = fmt
+            if name in offsets and (fields is None or name in fields):
+                if offsets[name] is not None:
+                    ffile.seek(offsets[name])
+                pdata = self._read_block(ffile, name, load_ptypes)
+            else:
+                pdata = self._null_block(dtype, ndims, ptypes)
+            setattr(self, name, pdata)
+
     def _load_block(self, ffile, name, dtype):
         """
         Return the next block from the open FortranFile ffile as an ndarray.
@@ -182,6 +467,45 @@ class GadgetSnapshot(SnapshotBase):
         else:
             return super(GadgetSnapshot, self)._load_block(ffile, name, dtype)
 
+    def _load_block_ptypes(self, ffile, name, dtype, ndims, ptypes,
+                           load_ptypes):
+        """
+        Return a list of data for each particle type in the next block.
+
+        Only the data for particle types in load_ptypes are read from ffile;
+        the file position is moved past the remainder of the record.
+        """
+        if name == 'mass' and not self._has_mass_block():
+            parts = [None for _ in self.ptype_indices]
+        else:
+            layout = self._block_layout(name, ndims, ptypes)
+            ranges = [rng if p in load_ptypes else None
+                      for (p, rng) in enumerate(layout)]
+            parts = ffile.read_record_parts(dtype, ranges)
+        pdata = self._parse_parts(parts, name, dtype, ndims, ptypes)
+        for p in self.ptype_indices:
+            if pdata[p] is not None and p not in load_ptypes:
+                pdata[p] = self._null_block(dtype, ndims, [p, ])[p]
+        return pdata
+
+    def _load_header(self, ffile):
+        """
+        Load the header from the open FortranFile ffile.
+
+        The file format is detected from the first record, which for format 2
+        files is the header's label.
+        """
+        if ffile.skip_record() == _g_label_dtype.itemsize:
+            ffile.seek(0)
+            label = self._read_label(ffile)
+            if label != _g_header_label:
+                raise SnapshotIOException("Invalid header label '%s'" % label)
+            self.snap_format = 2
+        else:
+            ffile.seek(0)
+            self.snap_format = 1
+        super(GadgetSnapshot, self)._load_header(ffile)
+
     def _load_mass_block(self, ffile, dtype):
         """
         Load the mass block from the open FortranFile ffile.
@@ -193,22 +517,12 @@ class GadgetSnapshot(SnapshotBase):
         ffile.read_record() must return the mass data, if it is present.
         """
         if self._has_mass_block():
-            return super(GadgetSnapshot, self)._load_block(ffile, 'mass', dtype)
+            return super(GadgetSnapshot, self)._load_block(ffile, 'mass',
+                                                           dtype)
         else:
             # We'll deal with this in _parse_block, _parse_mass_block.
             return self._null_array(dtype)
 
-    def _has_mass_block(self):
-        """
-        Return True if the mass block exists in the file, False otherwise.
-
-        A value of False implies that all masses are specified in the header.
-        The return value of this function may be inaccurate after .load() has
-        been called.
-        """
-        n = np.logical_and(self.header.npart > 0, self.header.mass == 0).sum()
-        return n > 0
-
     def _npars(self, pdata):
         """
         Return the list of particle counts for particle block data pdata.
@@ -223,6 +537,34 @@ class GadgetSnapshot(SnapshotBase):
             npars[p] = len(array)
         return npars
 
+    def _npart_counts(self):
+        """Return the list of particle counts given by the current block data.
+
+        raise a SnapshotIOException if an inconsistency is found.
+        """
+        npars = [None for _ in self.ptype_indices]
+        for (name, fmt) in self._schema.items():
+            pdata = getattr(self, name)
+            npars2 = self._npars(pdata)
+            for p, (n, n2) in enumerate(zip(npars, npars2)):
+                # None value for n2 implies that particle type p is not valid
+                # for block specified by name.
+                # 0 value for n2 implies there are no particles of type p for
+                # block specified by name.
+                if ((n != n2) and (n is not None) and (n2 is not None) and
+                        (n2 != 0)):
+                    message = "npart mismatch for particle type " + str(p)
+                    raise SnapshotIOException(message)
+
+                if n is not None and n2 is not None:
+                    npars[p] = max(n, n2)
+                elif n2 is not None:
+                    # n is None
+                    npars[p] = n2
+                # else npars[p] = n, but that is already true.
+
+        return [n if n is not None else 0 for n in npars]
+
     def _parse_block(self, block_data, name, dtype, ndims, ptypes):
         """
         Return a list of data for each particle type in the block.
@@ -233,77 +575,284 @@ class GadgetSnapshot(SnapshotBase):
         For the mass block, generate mass arrays from the header data where
         appropriate.
         """
+        layout = self._block_layout(name, ndims, ptypes)
+        parts = [None if rng is None else block_data[rng[0]:rng[1]]
+                 for rng in layout]
+        return self._parse_parts(parts, name, dtype, ndims, ptypes)
+
+    def _parse_mass_block(self, parts, dtype, ptypes):
+        """Return a list of mass-data ndarrays for each particle type.
+
+        Generate mass-data arrays from the header where appropriate.
+        """
+        pmasses = []
+        for (p, n, mass, parray) in zip(self.ptype_indices, self.header.npart,
+                                        self.header.mass, parts):
+            if p not in ptypes:
+                parray = None
+            elif mass != 0:
+                parray = self._header_mass_array(mass, n)
+            elif parray is None:
+                parray = self._null_array(dtype)
+            pmasses.append(parray)
+        return pmasses
+
+    def _parse_parts(self, parts, name, dtype, ndims, ptypes):
+        """
+        Return a list of data for each particle type in the block.
+
+        parts contains the raw file data for each particle type, or None where
+        no data was read. Valid particle types with no data are set to empty
+        arrays.
+        """
         if name == 'mass':
-            return self._parse_mass_block(block_data, dtype)
-        begin = 0
+            return self._parse_mass_block(parts, dtype, ptypes)
         pdata = []
-        for (p, np) in zip(self.ptype_indices, self.header.npart):
+        for (p, n, parray) in zip(self.ptype_indices, self.header.npart,
+                                  parts):
             if p not in ptypes:
                 parray = None
-            else:
-                end = begin + np * ndims
-                parray = block_data[begin:end]
-                begin = end
-                if ndims > 1:
-                    # Assigning to .shape does not modify the underlying data.
-                    # This is important for when we save to file, since ordering
-                    # of terms in ndim > 1 arrays must be preserved.
-                    parray.shape = (np, ndims)
+            elif parray is None:
+                parray = self._null_block(dtype, ndims, [p, ])[p]
+            elif ndims > 1:
+                # Assigning to .shape does not modify the underlying data.
+                # This is important for when we save to file, since ordering
+                # of terms in ndim > 1 arrays must be preserved.
+                parray.shape = (n, ndims)
             pdata.append(parray)
         return pdata
 
-    def _parse_mass_block(self, file_data, dtype):
-        """Return a list of mass-data ndarrays for each particle type.
+    def _ph_cube(self):
+        """
+        Return the origin and side length of the cube of Peano-Hilbert keys.
 
-        Generate mass-data arrays from the header where appropriate.
+        This is the periodic box if header.BoxSize is positive, and otherwise
+        the cube bounding all particles.
         """
-        begin = 0
-        pmasses = []
-        for (n, mass) in zip(self.header.npart, self.header.mass):
-            if n > 0 and mass == 0:
-                # A zero in masses means mass is to be read in from file.
-                end = begin + n
-                parray = file_data[begin:end]
-                begin = end
-            else:
-                parray = mass * np.ones(n, dtype=dtype)
-            pmasses.append(parray)
+        box = float(self.header.BoxSize)
+        if box > 0:
+            return ([0.0, 0.0, 0.0], box)
+        pos = [a for a in self.pos if a is not None and len(a) > 0]
+        if not pos:
+            return ([0.0, 0.0, 0.0], 1.0)
+        lower = np.min([a.min(axis=0) for a in pos], axis=0).astype('f8')
+        upper = np.max([a.max(axis=0) for a in pos], axis=0).astype('f8')
+        size = float((upper - lower).max())
+        return ([float(x) for x in lower], size if size > 0 else 1.0)
+
+    def _ptype_count(self, ptype):
+        """Return the number of particles of type ptype in the current file."""
+        return int(self.header.npart[ptype])
+
+    def _read_chunk(self, ffile, offsets, name, ptype, begin, end):
+        """
+        Return the data for particles [begin, end) of type ptype in block name.
 
-        # FIXME: We're currently just reading-in, and then overwriting the
-        # compacted mass representation. It would be better not to!
-        self._zero_header_masses()
-        return pmasses
+        Generate mass data from the header where appropriate.
+        """
+        if name == 'mass' and self.header.mass[ptype] != 0:
+            return self._header_mass_array(self.header.mass[ptype],
+                                           end - begin)
+        return super(GadgetSnapshot, self)._read_chunk(ffile, offsets, name,
+                                                       ptype, begin, end)
+
+    def _read_label(self, ffile):
+        """Read and return the next format 2 label in the FortranFile ffile."""
+        record = ffile.read_record(_g_label_dtype)
+        return record['label'].decode('ascii')
+
+    def _save(self, ffile):
+        """
+        Write all blocks to the open FortranFile ffile.
+
+        For format 2, each block is preceded by its label, and blocks with no
+        data are not written.
+        """
+        if (self.snap_format or 1) != 2:
+            return super(GadgetSnapshot, self)._save(ffile)
+
+        for name in self.fields:
+            arrays = self._save_arrays(name)
+            if arrays is None:
+                continue
+            nbytes = sum(a.nbytes for a in arrays)
+            if nbytes > 0:
+                self._write_label(ffile, self._labels[name], nbytes)
+                ffile.write_ndarrays(arrays)
+
+    def _save_arrays(self, name):
+        """
+        Return the list of arrays to write to file as the record for block
+        name.
+
+        For the mass block, only the data for particle types whose masses are
+        not given in the header are written. If there are none, the mass block
+        is not written.
+        """
+        if name == 'mass':
+            if not self._has_mass_block():
+                return None
+            return [a for (a, m) in zip(self.mass, self.header.mass)
+                    if a is not None and m == 0]
+        return super(GadgetSnapshot, self)._save_arrays(name)
+
+    def _save_header(self, ffile):
+        """
+        Write the header to the open FortranFile ffile.
+
+        For format 2, the header is preceded by its label.
+        """
+        if (self.snap_format or 1) == 2:
+            nbytes = self.header.to_array().nbytes
+            self._write_label(ffile, _g_header_label, nbytes)
+        super(GadgetSnapshot, self)._save_header(ffile)
+
+    def _save_ph_ranges(self, fname, keys, origin, size):
+        """
+        Write the sidecar file of Peano-Hilbert key ranges for file fname.
+
+        keys are, for each particle type, None or its sorted keys, in the cube
+        of side length size whose minimum corner is origin. See save().
+        """
+        ranges = []
+        for pkeys in keys:
+            if pkeys is None:
+                ranges.append(None)
+                continue
+            chunks = range(0, len(pkeys), _g_ph_chunk_size)
+            ranges.append([[int(pkeys[b]),
+                            int(pkeys[min(b + _g_ph_chunk_size,
+                                          len(pkeys)) - 1])]
+                           for b in chunks])
+        content = {'bits': PH_BITS, 'origin': list(origin), 'size': size,
+                   'chunk_size': _g_ph_chunk_size, 'ranges': ranges}
+        sidecar.save_json(fname, 'phkeys', content)
+
+    def _sidecar_key(self):
+        """
+        Return the key of this snapshot's sidecar files.
+
+        See SnapshotBase._sidecar_key(). The file's format and the block
+        labels also determine how it is read.
+        """
+        key = super(GadgetSnapshot, self)._sidecar_key()
+        key.update(snap_format=self.snap_format, labels=self._labels)
+        return key
+
+    def _skip_block(self, ffile, name):
+        """
+        Move past the next block in the open FortranFile ffile without reading.
+
+        The mass block is only skipped if it is present in the file.
+        """
+        if name != 'mass' or self._has_mass_block():
+            return super(GadgetSnapshot, self)._skip_block(ffile, name)
+        return None
+
+    def _toc_entries(self, ffile):
+        """
+        Scan the open FortranFile ffile and return its table of contents.
+
+        For format 2 files, the label records are not included. Blocks with
+        unknown labels are included, named by their label and with type 'b1'.
+        """
+        if self.snap_format != 2:
+            return super(GadgetSnapshot, self)._toc_entries(ffile)
+
+        names = dict((label, name) for (name, label) in self._labels.items())
+        names[_g_header_label] = 'header'
+        size = os.path.getsize(ffile.fname)
+        toc = []
+        ffile.seek(0)
+        while ffile.tell() < size:
+            label = self._read_label(ffile)
+            name = names.get(label, label.strip())
+            offset = ffile.tell()
+            nbytes = ffile.skip_record()
+            dtype = self._schema[name][0].str if name in self._schema else 'b1'
+            toc.append(TOCEntry(name, offset, nbytes, dtype))
+        return toc
+
+    def _toc_offsets(self, toc):
+        """
+        Return the offset of each block present in the file, given its toc.
+
+        Blocks with no record are included only if they may be generated from
+        the header; that is, only the mass block may be included.
+        """
+        offsets = super(GadgetSnapshot, self)._toc_offsets(toc)
+        for (name, offset) in list(offsets.items()):
+            if offset is None and (name != 'mass' or self._has_mass_block()):
+                del offsets[name]
+        return offsets
+
+    def _update_header_masses(self):
+        """
+        Update the header.mass list based on the current mass block data.
+
+        Particle types whose mass data is a constant array (see
+        _header_mass_array) have their mass set in the header, unless the
+        header mass already equals it at the precision of the mass block, in
+        which case the more precise header mass is kept. All others have a
+        header mass of zero, and are written to the mass block, unless they
+        have no particles, in which case the header mass is unchanged.
+        """
+        dtype = self._schema['mass'][0]
+        masses = np.array(self.header.mass)
+        for (p, parray) in enumerate(self.mass):
+            if parray is None or len(parray) == 0:
+                continue
+            if self._is_header_mass_array(parray):
+                value = parray[0]
+                current = np.asarray(masses[p], dtype=dtype)
+                if current != np.asarray(value, dtype=dtype):
+                    masses[p] = value
+            else:
+                masses[p] = 0
+        self.header.mass = masses
 
     def _update_npars(self):
         """Update the header.npart list based on the current block data.
 
         raise a SnapshotIOException if an inconsistency is found.
         """
-        npars = [None for _ in self.ptype_indices]
-        for (name, fmt) in self._schema.items():
-            pdata = getattr(self, name)
-            npars2 = self._npars(pdata)
-            for p, (n, n2) in enumerate(zip(npars, npars2)):
-                # None value for n2 implies that particle type p is not valid
-                # for block specified by name.
-                # 0 value for n2 implies there are no particles of type p for
-                # block specified by name.
-                if (n != n2) and (n is not None) and (n2 is not None) and (n2 != 0):
-                    message = "npart mismatch for particle type " + str(p)
-                    raise SnapshotIOException(message)
-
-                if n is not None and n2 is not None:
-                    npars[p] = max(n, n2)
-                elif n2 is not None:
-                    # n is None
-                    npars[p] = n2
-                # else npars[p] = n, but that is already true.
-
-        npars = [n if n is not None else 0 for n in npars]
         dtype, _ = self.header._schema['npart']
-        self.header.npart = np.array(npars, dtype=dtype)
+        self.header.npart = np.array(self._npart_counts(), dtype=dtype)
 
-    def _zero_header_masses(self):
-        new_masses = [0 for _ in self.header.mass]
-        dtype = self.header._schema['mass'][0]
-        self.header.mass = np.array(new_masses, dtype=dtype)
+    def _write_label(self, ffile, label, nbytes):
+        """
+        Write a format 2 label to the open FortranFile ffile.
+
+        nbytes is the size of the payload of the labelled record.
+        """
+        nextblock = nbytes + 2 * ffile.control_bytes
+        record = np.array([(label.encode('ascii'), nextblock)],
+                          dtype=_g_label_dtype)
+        ffile.write_ndarray(record)
+
+def _g_radius(s, ptype):
+    """Return the distance of each particle of type ptype from s.centre."""
+    box = float(s.header.BoxSize)
+    centre = s.centre
+    if centre is None:
+        centre = np.full(3, box / 2.)
+    offset = s.pos[ptype] - np.asarray(centre, dtype=s.pos[ptype].dtype)
+    if box > 0:
+        offset -= box * np.round(offset / box)
+    return np.sqrt((offset ** 2).sum(axis=1))
+
+def _g_specific_kinetic_energy(s, ptype):
+    """Return the specific kinetic energy of each particle of type ptype."""
+    vel = s.vel[ptype]
+    return 0.5 * (vel ** 2).sum(axis=1)
+
+def _g_temperature(s, ptype):
+    """Return the temperature of each particle of type ptype, in K."""
+    factor = ((_g_gamma - 1) * _g_mu * _g_proton_mass / _g_boltzmann *
+              _g_unit_velocity ** 2)
+    return s.u[ptype] * np.asarray(factor, dtype=s.u[ptype].dtype)
+
+GadgetSnapshot.register_derived('radius', _g_radius, ['pos', 'centre'])
+GadgetSnapshot.register_derived('specific_kinetic_energy',
+                                _g_specific_kinetic_energy, ['vel'])
+GadgetSnapshot.register_derived('temperature', _g_temperature, ['u'])
@@ -0,0 +1,231 @@
+"""
+Deposition of particle data onto periodic meshes.
+
+Particles are assigned to the cells of a cubic mesh spanning the periodic box
+[0, BoxSize) with one of the schemes
+
+    'ngp': nearest grid point, to the one cell containing the particle
+    'cic': cloud in cell, to the 2^3 cells nearest the particle
+    'tsc': triangular shaped cloud, to the 3^3 cells nearest the particle
+
+where cells are centred at (i + 0.5) * BoxSize / ngrid, and each particle's
+weight is shared between the cells so that the total weight is conserved.
+
+Particles are processed in chunks, so that, beyond the mesh itself, only
+arrays of the size of one chunk are allocated. A large mesh is split into
+slabs of cells along its z axis, each deposited into by a separate worker
+process. The mesh is shared with the workers, and each chunk's particles are
+divided between them by the slabs they reach.
+"""
+import mmap
+from multiprocessing import cpu_count, get_all_start_methods, get_context
+
+import numpy as np
+
+# The number of particles deposited at once.
+_CHUNK_SIZE = 262144
+# The number of cells of the smallest mesh split into slabs by default.
+_SLAB_MIN_CELLS = 128 ** 3
+
+# The assignment schemes, and the number of cells along each axis to which
+# each assigns a particle.
+_schemes = {'ngp': 1, 'cic': 2, 'tsc': 3}
+
+# The shared mesh, and (ngrid, scheme), of each worker process. Set by
+# _init_worker().
+_worker_mesh = None
+_worker_job = None
+
+def deposit(snapshot, ngrid, scheme='cic', ptypes=None, weights='mass',
+            density=False, chunk_size=_CHUNK_SIZE, nprocs=None):
+    """
+    Return a mesh of the particles of snapshot, deposited with scheme.
+
+    The mesh is a float64 array of shape (ngrid, ngrid, ngrid), indexed as
+    mesh[x, y, z], spanning the periodic box [0, header.BoxSize). Each cell
+    holds the total weight assigned to it, or, if density is True, that total
+    divided by the cell's volume.
+
+    ptypes are the particle types to deposit (by default, all types with
+    positions), and may be given as aliases. weights is the name of the block
+    holding each particle's weight, by default its mass, or None to give every
+    particle unit weight, so that the mesh holds particle counts.
+
+    Particles are deposited chunk_size at a time. Block data may be memory
+    maps (see SnapshotBase.load()), so that only chunks, and never whole
+    blocks, are read into memory. If nprocs is not 1, the mesh is split into
+    nprocs slabs along its z axis, each deposited into by a separate process.
+    By default, meshes of at least 128^3 cells are split between one process
+    per CPU, and smaller meshes are deposited by the calling process.
+
+    Processes are started by fork, and share the mesh, which is allocated in
+    shared memory, with the calling process. The calling process divides each
+    chunk's particles between the slabs they reach, and sends each process
+    only those of its slab, so that each particle is sent, and deposited,
+    once for each slab it reaches. Where fork is not available, the mesh is
+    deposited by the calling process.
+
+    raise a ValueError if scheme is invalid or header.BoxSize is not
+    positive.
+    """
+    if scheme not in _schemes:
+        raise ValueError('Invalid deposition scheme: ' + str(scheme))
+    box = float(snapshot.header.BoxSize)
+    if box <= 0:
+        raise ValueError('Deposition requires a positive header.BoxSize')
+
+    chunks = _chunks(snapshot, _ptypes(snapshot, ptypes), weights,
+                     ngrid / box, chunk_size)
+    if nprocs is None:
+        nprocs = cpu_count() if ngrid ** 3 >= _SLAB_MIN_CELLS else 1
+    if 'fork' not in get_all_start_methods():
+        nprocs = 1
+    nprocs = max(1, min(nprocs, ngrid))
+    if nprocs == 1:
+        mesh = np.zeros((ngrid, ngrid, ngrid), dtype='f8')
+        for (coords, w) in chunks:
+            _deposit_rows(mesh, coords, w, ngrid, scheme, 0, ngrid)
+    else:
+        # An anonymous shared map, which is zero-filled, and which forked
+        # workers inherit.
+        shared = mmap.mmap(-1, 8 * ngrid ** 3)
+        mesh = np.frombuffer(shared, dtype='f8').reshape((ngrid, ) * 3)
+        bounds = np.linspace(0, ngrid, nprocs + 1).astype('i8')
+        pool = get_context('fork').Pool(nprocs, initializer=_init_worker,
+                                        initargs=(mesh, (ngrid, scheme)))
+        try:
+            # Each slab is deposited into by one worker at a time, as each
+            # chunk's jobs complete before the next chunk's are sent. The next
+            # chunk is divided between slabs meanwhile.
+            pending = None
+            for (coords, w) in chunks:
+                jobs = _slab_jobs(coords, w, ngrid, scheme, bounds)
+                if pending is not None:
+                    pending.get()
+                pending = pool.map_async(_deposit_worker, jobs)
+            if pending is not None:
+                pending.get()
+        finally:
+            pool.close()
+            pool.join()
+
+    if density:
+        mesh /= (box / ngrid) ** 3
+    return mesh
+
+def _assign(coords, ngrid, scheme):
+    """
+    Return the cells and weights to which coords are assigned along one axis.
+
+    coords are in units of the cell size. A pair (cells, weights) of arrays of
+    shape (k, N) is returned, for the k cells of the scheme, and cells are
+    wrapped into [0, ngrid).
+    """
+    if scheme == 'ngp':
+        cells = np.floor(coords)[np.newaxis]
+        weights = np.ones_like(cells)
+    elif scheme == 'cic':
+        left = np.floor(coords - 0.5)
+        d = coords - 0.5 - left
+        cells = np.array([left, left + 1])
+        weights = np.array([1 - d, d])
+    else:
+        centre = np.floor(coords)
+        d = coords - centre - 0.5
+        cells = np.array([centre - 1, centre, centre + 1])
+        weights = np.array([0.5 * (0.5 - d) ** 2, 0.75 - d ** 2,
+                            0.5 * (0.5 + d) ** 2])
+    return (cells.astype('i8') % ngrid, weights)
+
+def _chunks(snapshot, ptypes, weights, scale, chunk_size):
+    """
+    Generate the coordinates and weights of chunks of particles.
+
+    Coordinates are in units of the cell size, scale cells per unit length,
+    and weights are None if weights is None.
+    """
+    for p in ptypes:
+        pos = snapshot.pos[p]
+        weight = None
+        if weights is not None:
+            weight = getattr(snapshot, weights)[p]
+        for begin in range(0, len(pos), chunk_size):
+            end = min(begin + chunk_size, len(pos))
+            coords = np.asarray(pos[begin:end], dtype='f8') * scale
+            w = None
+            if weight is not None:
+                w = np.asarray(weight[begin:end], dtype='f8')
+            yield (coords, w)
+
+def _deposit_rows(mesh, coords, w, ngrid, scheme, z0, z1):
+    """
+    Deposit particles into the z-slab of cells [z0, z1) of mesh.
+
+    coords are in units of the cell size, and w are the particles' weights,
+    or None for unit weights. Assignments to cells outside the slab are
+    discarded.
+    """
+    flat = mesh.reshape(-1)
+    xcells, xweights = _assign(coords[:, 0], ngrid, scheme)
+    ycells, yweights = _assign(coords[:, 1], ngrid, scheme)
+    zcells, zweights = _assign(coords[:, 2], ngrid, scheme)
+    if w is None:
+        w = 1.0
+    for (zc, zw) in zip(zcells, zweights):
+        inside = (zc >= z0) & (zc < z1)
+        for (xc, xw) in zip(xcells, xweights):
+            for (yc, yw) in zip(ycells, yweights):
+                cells = (xc * ngrid + yc) * ngrid + zc
+                values = xw * yw * zw * w
+                np.add.at(flat, cells[inside], values[inside])
+
+def _deposit_worker(job):
+    """Deposit particles into one z-slab of the mesh. Runs in a worker."""
+    z0, z1, coords, w = job
+    ngrid, scheme = _worker_job
+    _deposit_rows(_worker_mesh, coords, w, ngrid, scheme, z0, z1)
+
+def _init_worker(mesh, job):
+    global _worker_mesh, _worker_job
+    _worker_mesh = mesh
+    _worker_job = job
+
+def _slab_jobs(coords, w, ngrid, scheme, bounds):
+    """
+    Return a job for each z-slab, of the particles assigned to a cell of it.
+
+    Each job is (z0, z1, coords, weights) for the slab [z0, z1), where bounds
+    are the edges of all slabs. A particle assigned to cells of several slabs
+    is in the job of each.
+    """
+    zcells, _ = _assign(coords[:, 2], ngrid, scheme)
+    slabs = np.searchsorted(bounds, zcells, side='right') - 1
+    # Each particle once per distinct slab of its cells.
+    distinct = np.ones(slabs.shape, dtype=bool)
+    for j in range(1, len(slabs)):
+        for i in range(j):
+            distinct[j] &= slabs[j] != slabs[i]
+    _, rows = np.nonzero(distinct)
+    slabs = slabs[distinct]
+    order = np.argsort(slabs, kind='mergesort')
+    rows = rows[order]
+    starts = np.searchsorted(slabs[order], np.arange(len(bounds)))
+
+    jobs = []
+    for (z, (b0, b1)) in enumerate(zip(starts[:-1], starts[1:])):
+        r = rows[b0:b1]
+        jobs.append((bounds[z], bounds[z + 1], coords[r],
+                     None if w is None else w[r]))
+    return jobs
+
+def _ptypes(snapshot, ptypes):
+    """Return the indices of ptypes, or of all types with positions."""
+    pos = snapshot.pos
+    if ptypes is None:
+        return [p for (p, a) in enumerate(pos) if a is not None]
+    aliases = snapshot.ptype_aliases
+    indices = [aliases[p] if aliases and p in aliases else p for p in ptypes]
+    for p in indices:
+        if pos[p] is None:
+            raise ValueError("No position data for particle type %d" % p)
+    return indices
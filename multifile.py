@@ -0,0 +1,477 @@
+from multiprocessing import cpu_count, get_all_start_methods, get_context
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from .fortranio import FortranFile
+from .gadget import GadgetSnapshot
+from .peano import peano_hilbert_keys
+from .snapshot import SnapshotBase, SnapshotIOException
+
+# The strategies by which particles may be divided between sub-files on saving.
+_split_strategies = ('contiguous', 'id', 'slab')
+
+def subfile_names(fname, num_files):
+    """Return the file names of the sub-files of a multi-file snapshot."""
+    return ['%s.%d' % (fname, i) for i in range(num_files)]
+
+def _index_size(index):
+    """Return the number of elements selected by a slice or index array."""
+    if isinstance(index, slice):
+        return index.stop - index.start
+    return len(index)
+
+def _init_save_worker(source):
+    global _save_source
+    _save_source = source
+
+def _process_context():
+    """
+    Return the context in which to start save worker processes.
+
+    Workers are forked where possible, so that block data are inherited
+    rather than pickled; otherwise, the platform's default start method is
+    used.
+    """
+    if 'fork' in get_all_start_methods():
+        return get_context('fork')
+    return get_context()
+
+def _save_subfile(job):
+    """
+    Create and save one sub-file. Runs in a worker process.
+
+    job is (fname, index), where index holds, for each particle type, the
+    slice or index array of the sub-file's particles. All other data are
+    from _save_source; see GadgetMultiSnapshot.save(). Masses given in the
+    header are rebuilt here as header mass arrays.
+    """
+    fname, index = job
+    header, blocks, kwargs, snap_format, nthreads, cube = _save_source
+    sub = GadgetSnapshot(fname, **kwargs)
+    sub.snap_format = snap_format
+    for (name, value) in header.items():
+        setattr(sub.header, name, value)
+    for (name, pdata) in blocks.items():
+        sub_pdata = []
+        for (p, (parray, idx)) in enumerate(zip(pdata, index)):
+            if name == 'mass' and sub.header.mass[p] != 0:
+                parray = sub._header_mass_array(sub.header.mass[p],
+                                                _index_size(idx))
+            elif parray is not None and len(parray) > 0:
+                parray = parray[idx]
+            sub_pdata.append(parray)
+        setattr(sub, name, sub_pdata)
+
+    # GadgetSnapshot.save() permits only single-file snapshots.
+    SnapshotBase.save(sub, nthreads=nthreads)
+    if cube is not None:
+        # Particles are already in Peano-Hilbert order of the whole snapshot.
+        origin, size = cube
+        keys = [None if pos is None else peano_hilbert_keys(pos, origin, size)
+                for pos in sub.pos]
+        sub._save_ph_ranges(fname, keys, origin, size)
+
+# The data of the snapshot being saved, in each worker process. Set by
+# _init_save_worker().
+_save_source = None
+
+
+class GadgetMultiSnapshot(GadgetSnapshot):
+    """
+    A class for Gadget snapshots split over multiple files.
+
+    See also GadgetSnapshot.
+
+    Gadget writes a snapshot with header num_files > 1 as the sub-files
+    'file_name.0', 'file_name.1', ..., each with its own header. To read in
+    all sub-files of such a snapshot:
+
+        >>> from glio import GadgetMultiSnapshot
+        >>> s = GadgetMultiSnapshot('file_name')
+        >>> s.load()
+
+    Block data then hold, for each particle type, the particles of all
+    sub-files, in sub-file order. The header is that of the first sub-file,
+    except that header.npart holds the total number of particles of each type
+    across all sub-files, as 64-bit integers. The headers of the individual
+    sub-files are available as s.subheaders.
+
+    Sub-files are read concurrently by a pool of nthreads threads (by default,
+    one per sub-file). The output arrays for each block are allocated before
+    reading, and each sub-file's data are read directly into their slots.
+
+    A snapshot may be saved as any number of sub-files,
+
+        >>> s.save('new_file_name', num_files=8, split='slab')
+
+    where split determines which particles are written to each sub-file:
+
+        'contiguous': each particle type is divided into num_files runs of
+                      (almost) equal length, in their current order.
+        'id': particles are divided by ID, such that each sub-file holds a
+              range of IDs, and the total numbers of particles in all
+              sub-files are (almost) equal.
+        'slab': particles are divided by their x coordinate into num_files
+                slabs of equal width, spanning the periodic box if
+                header.BoxSize is positive, or else the particles' extent.
+
+    Each sub-file is written by its own process, from a pool of nprocs
+    processes (by default, one per sub-file, up to one per CPU). The headers
+    of all sub-files hold the particle counts of that sub-file in npart, and
+    the total particle counts in npartTotal and npartTotalHighWord.
+
+    Methods which read from or write to a single file are not supported:
+    aload(), iter_chunks(), save_block(), table_of_contents(), index_ids()
+    with cache, and load() with memmap, lazy, toc_cache or prefetch. Each
+    raises a SnapshotIOException.
+    """
+
+    def __init__(self, fname, nthreads=None, **kwargs):
+        """Initializes a multi-file Gadget snapshot."""
+        super(GadgetMultiSnapshot, self).__init__(fname, **kwargs)
+        self.nthreads = nthreads
+        self.subheaders = []
+
+    @property
+    def fnames(self):
+        """The file names of all sub-files, as given by the first sub-file."""
+        first = self._subfile(subfile_names(self.fname, 1)[0])
+        with FortranFile(first.fname, 'rb') as ffile:
+            first._load_header(ffile)
+        return subfile_names(self.fname, int(first.header.num_files))
+
+    def aload(self, fields=None, ptypes=None, memmap=False, toc_cache=False,
+              executor=None):
+        """Not supported; raise a SnapshotIOException."""
+        self._unsupported('aload()')
+
+    def index_ids(self, ptypes=None, cache=False):
+        """
+        Build the index of particle IDs. See SnapshotBase.index_ids().
+
+        raise a SnapshotIOException if cache is True.
+        """
+        if cache:
+            self._unsupported('index_ids() with cache')
+        super(GadgetMultiSnapshot, self).index_ids(ptypes)
+
+    def iter_chunks(self, fields, ptype, chunk_size):
+        """Not supported; raise a SnapshotIOException."""
+        self._unsupported('iter_chunks()')
+
+    def load(self, fields=None, ptypes=None, memmap=False, lazy=False,
+             toc_cache=False, prefetch=False):
+        """
+        Load in snapshot data from all sub-files.
+
+        fields and ptypes are as for SnapshotBase.load().
+
+        raise a SnapshotIOException if the sub-file headers are inconsistent,
+        or if any of memmap, lazy, toc_cache or prefetch is given.
+        """
+        for (option, value) in (('memmap', memmap), ('lazy', lazy),
+                                ('toc_cache', toc_cache),
+                                ('prefetch', prefetch)):
+            if value:
+                self._unsupported('load() with %s' % option)
+        if ptypes is None:
+            ptypes = self.ptype_indices
+        ptypes = list(ptypes)
+
+        subs = [self._subfile(f) for f in self.fnames]
+        nthreads = self.nthreads or len(subs)
+        pool = ThreadPool(nthreads)
+        try:
+            offsets = pool.map(self._scan_subfile, subs)
+            self._combine_headers(subs)
+            fields = [name for name in self._present_blocks(subs, offsets)
+                      if fields is None or name in fields]
+            self._allocate(fields, ptypes)
+            starts = self._subfile_starts(subs)
+            jobs = [(sub, off, start, fields, ptypes)
+                    for (sub, off, start) in zip(subs, offsets, starts)]
+            pool.map(self._read_subfile, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    def save(self, fname=None, nthreads=1, peano_hilbert=False,
+             num_files=None, split='contiguous', nprocs=None):
+        """
+        Write header and snapshot to num_files sub-files of fname.
+
+        fname defaults to the current file name, and num_files to the
+        header's num_files. The sub-files are named as for loading, and
+        are overwritten. split is one of 'contiguous', 'id' or 'slab'.
+
+        Sub-files are written by a pool of nprocs processes (by default, one
+        per sub-file, up to one per CPU), each of which writes with nthreads
+        threads; see SnapshotBase.save(). Processes are forked where possible,
+        and so inherit block data, which are otherwise sent once to each
+        process; each sub-file's particles are selected there. If
+        peano_hilbert is True, particles are first sorted as for
+        GadgetSnapshot.save(), and each sub-file has its own sidecar file of
+        key ranges.
+
+        The method will raise a SnapshotIOException if the header or any field
+        is not valid, if any block to be written has no data for a particle
+        type with particles, or if the data required by split have not been
+        loaded.
+        """
+        if fname is None:
+            fname = self.fname
+        if num_files is None:
+            num_files = int(self.header.num_files)
+        if num_files < 1:
+            raise ValueError('num_files must be at least one')
+        if split not in _split_strategies:
+            raise ValueError('Invalid split strategy: ' + str(split))
+
+        # Checked before sorting, so that a snapshot which cannot be saved is
+        # not left reordered.
+        self._verify_save()
+        cube = None
+        if peano_hilbert:
+            self.sort_peano_hilbert()
+            cube = self._ph_cube()
+
+        totals = np.asarray(self.header.npart, dtype='i8')
+        self.header.num_files = np.int32(num_files)
+        self.header.npartTotal = (totals & 0xffffffff).astype('u4')
+        self.header.npartTotalHighWord = (totals >> 32).astype('u4')
+
+        indices = self._split(split, num_files)
+        fnames = subfile_names(fname, num_files)
+        kwargs = dict(header_schema=self.header._schema,
+                      blocks_schema=self._schema, ptype_aliases=self._aliases,
+                      block_labels=self._labels)
+        blocks = dict(self.iterfields())
+        if 'mass' in blocks:
+            # Sent as the header's masses rather than as arrays, which would
+            # be pickled in full, and lose their broadcast strides, when not
+            # inherited by a forked process.
+            blocks['mass'] = [None if m != 0 else a for (a, m)
+                              in zip(self.mass, self.header.mass)]
+        source = (dict(self.header.iterfields()), blocks, kwargs,
+                  self.snap_format, nthreads, cube)
+        jobs = [(sub_fname, [idx[i] for idx in indices])
+                for (i, sub_fname) in enumerate(fnames)]
+
+        pool = _process_context().Pool(nprocs or min(num_files, cpu_count()),
+                                       initializer=_init_save_worker,
+                                       initargs=(source, ))
+        try:
+            pool.map(_save_subfile, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    def save_block(self, name, ptypes=None, fname=None):
+        """Not supported; raise a SnapshotIOException."""
+        self._unsupported('save_block()')
+
+    def table_of_contents(self, cache=False):
+        """Not supported; raise a SnapshotIOException."""
+        self._unsupported('table_of_contents()')
+
+    def _allocate(self, fields, load_ptypes):
+        """
+        Set each block in fields to arrays of the total size, ready to be read
+        into. All other blocks are set to null blocks.
+
+        Masses given in the header are filled in here.
+        """
+        npart = self.header.npart
+        for (name, fmt) in self._schema.items():
+            dtype, ndims, ptypes, flag = fmt
+            pdata = self._null_block(dtype, ndims, ptypes)
+            if name in fields:
+                for p in load_ptypes:
+                    if pdata[p] is None:
+                        continue
+                    if name == 'mass' and self.header.mass[p] != 0:
+                        pdata[p] = self._header_mass_array(self.header.mass[p],
+                                                           npart[p])
+                    elif ndims > 1:
+                        pdata[p] = np.empty((npart[p], ndims), dtype=dtype)
+                    else:
+                        pdata[p] = np.empty(npart[p], dtype=dtype)
+            setattr(self, name, pdata)
+
+    def _combine_headers(self, subs):
+        """
+        Set the header from those of the sub-files subs.
+
+        raise a SnapshotIOException if the headers are inconsistent.
+        """
+        first = subs[0].header
+        for sub in subs:
+            h = sub.header
+            if (h.num_files != len(subs) or
+                    np.any(h.npartTotal != first.npartTotal) or
+                    np.any(h.npartTotalHighWord != first.npartTotalHighWord)):
+                message = "Header of sub-file %s is inconsistent" % h.fname
+                raise SnapshotIOException(message)
+
+        npart = np.array([sub.header.npart for sub in subs], dtype='i8')
+        totals = npart.sum(axis=0)
+        expected = (first.npartTotal.astype('i8') +
+                    (first.npartTotalHighWord.astype('i8') << 32))
+        if np.any(totals != expected):
+            message = "Sub-file particle counts do not sum to npartTotal"
+            raise SnapshotIOException(message)
+
+        for (name, value) in first.iterfields():
+            setattr(self.header, name, value)
+        self.header.npart = totals
+        self.snap_format = subs[0].snap_format
+        self.subheaders = [sub.header for sub in subs]
+
+    def _present_blocks(self, subs, offsets):
+        """
+        Return the names of the blocks present in the sub-files subs.
+
+        offsets holds the block offsets of each sub-file. A block is present
+        if it is found in every sub-file with particles for it; format 2
+        files, for example initial conditions, may omit blocks entirely.
+        """
+        present = []
+        for (name, fmt) in self._schema.items():
+            _, _, ptypes, flag = fmt
+            if not (self._block_exists(name, ptypes) and self._get_flag(flag)):
+                continue
+            if all(name in off for (sub, off) in zip(subs, offsets)
+                   if sub._block_exists(name, ptypes)):
+                present.append(name)
+        return present
+
+    def _read_subfile(self, job):
+        """Read all required data from one sub-file into its output slots."""
+        sub, offsets, start, fields, load_ptypes = job
+        with FortranFile(sub.fname, 'rb') as ffile:
+            for (name, offset) in offsets.items():
+                if fields is not None and name not in fields:
+                    continue
+                if name == 'mass' and not sub._has_mass_block():
+                    continue
+                dtype, ndims, ptypes, _ = self._schema[name]
+                pdata = getattr(self, name)
+                layout = sub._block_layout(name, ndims, ptypes)
+                ranges = []
+                out = []
+                for (p, rng) in enumerate(layout):
+                    if rng is None or p not in load_ptypes:
+                        continue
+                    end = start[p] + sub.header.npart[p]
+                    ranges.append(rng)
+                    out.append(pdata[p][start[p]:end])
+                if ranges:
+                    ffile.seek(offset)
+                    ffile.read_record_parts(dtype, ranges, out)
+
+    def _scan_subfile(self, sub):
+        """Load the header of sub, and return its block offsets."""
+        with FortranFile(sub.fname, 'rb') as ffile:
+            sub._load_header(ffile)
+            return sub._block_offsets(ffile)
+
+    def _split(self, split, num_files):
+        """
+        Return, for each particle type, the indices of each sub-file's
+        particles.
+
+        Each particle type's element is a list of num_files slices or index
+        arrays, one per sub-file. See save() for the meaning of split.
+
+        raise a SnapshotIOException if the data required by split are absent.
+        """
+        npart = np.asarray(self.header.npart, dtype='i8')
+        # With no particles, there is nothing to split by.
+        if split == 'contiguous' or npart.sum() == 0:
+            indices = []
+            for n in npart:
+                bounds = (n * np.arange(num_files + 1)) // num_files
+                indices.append([slice(b0, b1) for (b0, b1)
+                                in zip(bounds[:-1], bounds[1:])])
+            return indices
+
+        if split == 'id':
+            keys = self._split_data('ID', npart)
+            ids = np.sort(np.concatenate([k for k in keys if k is not None]))
+            edges = ids[(len(ids) * np.arange(1, num_files)) // num_files]
+            dests = [None if k is None else np.searchsorted(edges, k, 'right')
+                     for k in keys]
+        else:
+            keys = self._split_data('pos', npart)
+            keys = [None if k is None else k[:, 0] for k in keys]
+            box = float(self.header.BoxSize)
+            if box > 0:
+                dests = [None if x is None else
+                         np.floor(x / box * num_files).astype('i8') % num_files
+                         for x in keys]
+            else:
+                x = np.concatenate([x for x in keys if x is not None])
+                lo, width = x.min(), max(x.max() - x.min(), 1e-300)
+                dests = [None if x is None else
+                         np.clip(np.floor((x - lo) / width * num_files),
+                                 0, num_files - 1).astype('i8')
+                         for x in keys]
+
+        indices = []
+        for dest in dests:
+            if dest is None:
+                indices.append([slice(0, 0)] * num_files)
+                continue
+            order = np.argsort(dest, kind='mergesort')
+            bounds = np.zeros(num_files + 1, dtype='i8')
+            bounds[1:] = np.cumsum(np.bincount(dest, minlength=num_files))
+            indices.append([order[b0:b1] for (b0, b1)
+                            in zip(bounds[:-1], bounds[1:])])
+        return indices
+
+    def _split_data(self, name, npart):
+        """
+        Return the data of block name for each particle type, for splitting.
+
+        The element for a particle type with no particles is None.
+
+        raise a SnapshotIOException if the data of any particle are absent.
+        """
+        pdata = getattr(self, name)
+        keys = []
+        for (p, n) in enumerate(npart):
+            if n == 0:
+                keys.append(None)
+            elif pdata[p] is None or len(pdata[p]) != n:
+                message = "Block '%s' is required to split particles" % name
+                raise SnapshotIOException(message)
+            else:
+                keys.append(pdata[p])
+        return keys
+
+    def _subfile(self, fname):
+        """Return a GadgetSnapshot for sub-file fname, with the same schema."""
+        return GadgetSnapshot(fname, header_schema=self.header._schema,
+                              blocks_schema=self._schema,
+                              ptype_aliases=self._aliases,
+                              block_labels=self._labels)
+
+    def _subfile_starts(self, subs):
+        """Return, for each sub-file, the first index of each particle type."""
+        npart = np.array([sub.header.npart for sub in subs], dtype='i8')
+        starts = np.zeros_like(npart)
+        starts[1:] = np.cumsum(npart, axis=0)[:-1]
+        return starts
+
+    def _unsupported(self, method):
+        """raise a SnapshotIOException for an unsupported method."""
+        message = "%s is not supported for multi-file snapshots" % method
+        raise SnapshotIOException(message)
+
+    def _update_npars(self):
+        """Update header.npart, as 64-bit totals, based on the block data.
+
+        raise a SnapshotIOException if an inconsistency is found.
+        """
+        self.header.npart = np.array(self._npart_counts(), dtype='i8')
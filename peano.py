@@ -0,0 +1,61 @@
+"""
+Peano-Hilbert space-filling curve keys for particle positions.
+
+Keys are computed with the algorithm of Skilling (2004), "Programming the
+Hilbert curve", AIP Conf. Proc. 707, 381, vectorized over particles.
+"""
+import numpy as np
+
+# The default number of bits per dimension, such that a key fits in 63 bits.
+PH_BITS = 21
+
+def peano_hilbert_keys(pos, origin, size, bits=PH_BITS):
+    """
+    Return the Peano-Hilbert key of each position in pos.
+
+    pos is an (N, 3) array of positions within the cube of side length size
+    whose minimum corner is origin. The cube is divided into 2^bits cells
+    along each side, and the key of a position is the index along the curve
+    of the cell containing it. Positions outside the cube are placed in the
+    nearest cell. A uint64 array of N keys is returned.
+    """
+    if not 0 < bits <= PH_BITS:
+        raise ValueError('bits must be in [1, %d]' % PH_BITS)
+
+    ncells = 1 << bits
+    cells = np.floor((np.asarray(pos, dtype='f8') - origin) * (ncells / size))
+    np.clip(cells, 0, ncells - 1, out=cells)
+    x = [cells[:, i].astype('u8') for i in range(3)]
+
+    # Inverse undo excess work.
+    q = 1 << (bits - 1)
+    while q > 1:
+        p = np.uint64(q - 1)
+        for i in range(3):
+            high = (x[i] & np.uint64(q)) != 0
+            if i == 0:
+                x[0] = np.where(high, x[0] ^ p, x[0])
+                continue
+            t = (x[0] ^ x[i]) & p
+            x[0] = np.where(high, x[0] ^ p, x[0] ^ t)
+            x[i] = np.where(high, x[i], x[i] ^ t)
+        q >>= 1
+
+    # Gray encode.
+    for i in range(1, 3):
+        x[i] ^= x[i - 1]
+    t = np.zeros_like(x[0])
+    q = 1 << (bits - 1)
+    while q > 1:
+        t = np.where((x[2] & np.uint64(q)) != 0, t ^ np.uint64(q - 1), t)
+        q >>= 1
+    for i in range(3):
+        x[i] ^= t
+
+    # Interleave the transposed bits, most significant first.
+    keys = np.zeros_like(x[0])
+    for b in range(bits - 1, -1, -1):
+        for i in range(3):
+            bit = (x[i] >> np.uint64(b)) & np.uint64(1)
+            keys = (keys << np.uint64(1)) | bit
+    return keys
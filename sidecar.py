@@ -0,0 +1,104 @@
+"""
+Sidecar files, which cache data derived from a snapshot file alongside it.
+
+Each sidecar records the size and modification time of the file from which it
+was derived, and is ignored if either no longer matches. A sidecar may also
+record a key, any data serializable as JSON, describing how its data were
+derived, e.g. the class and schema of the snapshot which read the file, and is
+then ignored if read with a different key.
+"""
+import json
+import os
+
+import numpy as np
+
+def file_signature(fname):
+    """Return a [size, mtime] list identifying the current state of fname."""
+    stat = os.stat(fname)
+    return [stat.st_size, stat.st_mtime]
+
+def sidecar_name(fname, suffix):
+    """Return the file name of the sidecar to fname with the given suffix."""
+    return '%s.%s' % (fname, suffix)
+
+def load_arrays(fname, suffix, key=None):
+    """
+    Return a dict of the arrays in the sidecar to fname, or None.
+
+    None is returned if the sidecar does not exist, cannot be read, is out of
+    date, or was written with a key other than key.
+    """
+    try:
+        with np.load(sidecar_name(fname, suffix)) as data:
+            arrays = dict((k, data[k]) for k in data.files)
+    except (IOError, OSError, ValueError):
+        return None
+    signature = arrays.pop('_signature', None)
+    if signature is None or list(signature) != file_signature(fname):
+        return None
+    if str(arrays.pop('_key', '')) != _key_string(key):
+        return None
+    return arrays
+
+def load_json(fname, suffix, key=None):
+    """
+    Return the data in the JSON sidecar to fname, or None.
+
+    None is returned if the sidecar does not exist, cannot be read, is out of
+    date, or was written with a key other than key.
+    """
+    try:
+        with open(sidecar_name(fname, suffix), 'r') as f:
+            content = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if content.get('signature') != file_signature(fname):
+        return None
+    if content.get('key', '') != _key_string(key):
+        return None
+    return content.get('data')
+
+def save_arrays(fname, suffix, arrays, key=None):
+    """
+    Write the dict of arrays, and key, to the sidecar to fname.
+
+    Failure to write the sidecar is not an error, and False is returned.
+    """
+    arrays = dict(arrays)
+    arrays['_signature'] = np.array(file_signature(fname), dtype='f8')
+    arrays['_key'] = np.array(_key_string(key))
+    def write(f):
+        np.savez(f, **arrays)
+    return _write(sidecar_name(fname, suffix), write)
+
+def save_json(fname, suffix, data, key=None):
+    """
+    Write data, and key, to the sidecar to fname.
+
+    data and key must be serializable as JSON. Failure to write the sidecar
+    is not an error, and False is returned.
+    """
+    content = {'signature': file_signature(fname), 'key': _key_string(key),
+               'data': data}
+    def write(f):
+        f.write(json.dumps(content).encode('utf-8'))
+    return _write(sidecar_name(fname, suffix), write)
+
+def _key_string(key):
+    """Return key as a canonical JSON string, or '' if key is None."""
+    if key is None:
+        return ''
+    return json.dumps(key, sort_keys=True)
+
+def _write(sidecar, write):
+    """Atomically write sidecar with the function write. Return success."""
+    tmp = '%s.%d.tmp' % (sidecar, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            write(f)
+        os.rename(tmp, sidecar)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    return True
@@ -1,9 +1,33 @@
+from collections import namedtuple, OrderedDict
 from copy import copy
+import os
+import weakref
 
 import numpy as np
 
-from .fortranio import FortranFile
-from .snapview import SnapshotView
+from . import sidecar
+from .fortranio import (FortranFile, ParallelFortranWriter,
+                        PrefetchingFortranFile)
+from .snapview import DerivedBlock, SnapshotView
+
+# An entry in a snapshot file's table of contents. offset is the location of
+# the record's leading control bytes, and nbytes the size of its payload.
+TOCEntry = namedtuple('TOCEntry', ['name', 'offset', 'nbytes', 'dtype'])
+
+# A field computed from other fields. See SnapshotBase.register_derived().
+DerivedField = namedtuple('DerivedField', ['name', 'func', 'depends',
+                                           'ptypes'])
+
+# The default maximum size, in bytes, of a snapshot's cache of derived data.
+_DERIVED_CACHE_BYTES = 256 * 1024 * 1024
+
+# The rank of each numeric numpy type kind, indexed by the kind's character
+# code. Header data may be stored as a type of the same or a higher rank, e.g.
+# integers as floating point; signed and unsigned integers are of one rank.
+# Data of other kinds may be stored only as their own kind.
+_kind_ranks = np.full(128, 127, dtype='i1')
+for (_kind, _rank) in (('b', 0), ('i', 1), ('u', 1), ('f', 2), ('c', 3)):
+    _kind_ranks[ord(_kind)] = _rank
 
 class SnapshotIOException(Exception):
     """Base class for exceptions in the the snapshot module."""
@@ -49,6 +73,11 @@ class SnapshotHeader(object):
         self.verify_schema()
         self.init_fields()
 
+    @property
+    def dtype(self):
+        """The numpy structured data type of a header record."""
+        return self._dtype
+
     @property
     def fields(self):
         return self._fields
@@ -81,9 +110,8 @@ class SnapshotHeader(object):
 
     def to_array(self):
         """Return a structured array representing the header data."""
-        dtype = [(k, dt, size) for k, (dt, size) in self._schema.items()]
         values = tuple(getattr(self, name) for name in self.fields)
-        return np.array(values, dtype=dtype)
+        return np.array(values, dtype=self.dtype)
 
     def save(self, fname=None):
         """
@@ -109,27 +137,19 @@ class SnapshotHeader(object):
         """
         Return a list of header attributes which do not conform to the schema.
 
-        An empty list indicates that the header is valid.
+        An empty list indicates that the header is valid. An attribute is
+        malformed if its size differs from the schema's, or if its data are
+        of a different kind to the schema's type, such as floating-point data
+        for an integer entry, and so would not be stored unchanged.
         """
-        malformed = []
-        for (name, fmt) in self._schema.items():
-            dtype, size = fmt
-            data = getattr(self, name)
-
-            try:
-                count = len(data)
-            except TypeError:
-                count = 1
-
-            if count != size:
-                malformed.append(name)
-            else:
-                try:
-                    converted = np.asarray(data).view(dtype=dtype)
-                except ValueError:
-                    malformed.append(name)
-
-        return malformed
+        data = [np.asarray(getattr(self, name)) for name in self.fields]
+        sizes = np.array([a.size for a in data], dtype='i8')
+        kinds = np.frombuffer(''.join(a.dtype.kind for a in data).encode(),
+                              dtype='u1')
+        valid = ((sizes == self._sizes) &
+                 ((kinds == self._kinds) |
+                  (_kind_ranks[kinds] <= self._ranks)))
+        return [name for (name, v) in zip(self.fields, valid) if not v]
 
     def verify_schema(self):
         """
@@ -176,23 +196,31 @@ class SnapshotHeader(object):
             self._ptypes = max(size, self._ptypes)
 
         self._fields = self._schema.keys()
+        # Compile the schema once, so that a header record may be parsed in a
+        # single operation.
+        self._dtype = np.dtype([(k, dt) if size == 1 else (k, dt, (size, ))
+                                for (k, (dt, size)) in self._schema.items()])
+        # The size and kind of every entry, against which all attributes are
+        # checked at once by verify().
+        self._sizes = np.array([size for (_, size) in self._schema.values()],
+                               dtype='i8')
+        kinds = ''.join(dt.kind for (dt, _) in self._schema.values())
+        self._kinds = np.frombuffer(kinds.encode(), dtype='u1')
+        # Entries of other kinds accept only data of their own kind.
+        ranks = _kind_ranks[self._kinds]
+        self._ranks = np.where(ranks == _kind_ranks.max(), -1, ranks)
 
     def _load(self, ffile):
         raw_header = ffile.read_record('b1')
-        offset = 0
-        for (name, fmt) in self._schema.items():
-            dtype, size = fmt
-            bytewords = dtype.itemsize * size
-            # Must be non-scalar ndarray, hence wrap in np.array()
-            raw_data = np.array(raw_header[offset:offset + bytewords])
-            try:
-                data = raw_data.view(dtype=dtype)
-            except ValueError:
-                raise SnapshotIOException('Could not reinterpret')
-            if size == 1:
-                data = data[0]
-            offset += bytewords
-            setattr(self, name, data)
+        if raw_header.nbytes != self._dtype.itemsize:
+            raise SnapshotIOException('Header size does not match schema')
+        # Array entries are views of a copy of raw_header, in the file's byte
+        # order, and so are never views of a memory-mapped file; scalar
+        # entries are copies.
+        dtype = self._dtype.newbyteorder(ffile.byteorder)
+        record = np.array(raw_header).view(dtype)[0]
+        for name in self.fields:
+            setattr(self, name, record[name])
 
     def _save(self, ffile):
         array = self.to_array()
@@ -266,6 +294,27 @@ class SnapshotBase(object):
 
     The indices of all valid particle types for this snapshot are stored in the
     list s.ptype_indices.
+
+
+    Derived Fields
+    --------------
+
+    Fields computed from blocks, e.g. a temperature from internal energies,
+    may be registered for a snapshot class with register_derived(). They are
+    then accessed as blocks are,
+
+        >>> s.temperature[0] is s.gas.temperature
+        True
+
+    but each particle type's data are computed only when first accessed, and
+    are kept in a least-recently-used cache of at most s.derived_cache_bytes
+    bytes. The cache holds no references to the data the fields depend on.
+    Cached data are recomputed once any field they depend on is reassigned,
+    either as an attribute or as one particle type's array, as is done by
+    load(), and are discarded at once on reassignment of an attribute.
+    Neither in-place modification of a dependency's data nor modification of
+    the header is detected; call clear_derived() after either. All derived
+    fields are listed in s.derived_fields.
     """
 
     def __init__(self, fname, header_schema=None, blocks_schema=None,
@@ -288,21 +337,70 @@ class SnapshotBase(object):
         self._aliases = ptype_aliases
         self.header = SnapshotHeader(fname, header_schema)
         self._fields = []
+        # Block name to file offset, for blocks not yet read by a lazy load.
+        self._lazy_blocks = {}
+        self._lazy_source = None
+        # Particle type to (reference to ID array, sorting permutation, sorted
+        # IDs). See _reference().
+        self._id_index = {}
+        # The file name, and references to the ID arrays, of the ID block as
+        # last read from file, or None.
+        self._file_ids = None
+        # (Derived field name, particle type) to (data, dependency references),
+        # in order of least recent use. See _derived_references().
+        self._derived_cache = OrderedDict()
+        self.derived_cache_bytes = _DERIVED_CACHE_BYTES
 
         # Use copy so that reference schema is not altered.
         self._schema = copy(blocks_schema)
+        self._precisions = {}
         self._ptypes = 0
         self.verify_schema()
         self.init_fields()
 
     def __getattr__(self, name):
-        if self._aliases and name in self._aliases:
-            idx = self._aliases[name]
+        # Only called when normal attribute lookup fails, so blocks pending
+        # from a lazy load are absent from the instance dictionary.
+        lazy_blocks = self.__dict__.get('_lazy_blocks')
+        aliases = self.__dict__.get('_aliases')
+        if lazy_blocks and name in lazy_blocks:
+            return self._load_lazy_block(name)
+        elif aliases and name in aliases:
+            idx = aliases[name]
             return self._ptype_view(idx)
+        elif '_derived_cache' in self.__dict__ and name in self.derived_fields:
+            return DerivedBlock(self, name)
         else:
             msg = "'%s' object has no attribute %s" % (type(self).__name__, name)
             raise AttributeError(msg)
 
+    def __setattr__(self, name, value):
+        super(SnapshotBase, self).__setattr__(name, value)
+        # So that the ID index does not outlive the arrays it indexes.
+        if name == 'ID' and '_id_index' in self.__dict__:
+            self._id_index.clear()
+        # So that cached derived data do not outlive the data they depend on.
+        cache = self.__dict__.get('_derived_cache')
+        if cache:
+            for key in list(cache):
+                if name in self._derived_depends(key[0]):
+                    del cache[key]
+
+    @property
+    def derived_fields(self):
+        """
+        A tuple of the names of all derived fields of this snapshot.
+
+        Includes the fields registered for this class and its base classes,
+        but not those whose names are also those of blocks.
+        """
+        names = []
+        for klass in reversed(type(self).__mro__):
+            registry = klass.__dict__.get('_derived_registry', {})
+            names.extend(n for n in registry
+                         if n not in names and n not in self._schema)
+        return tuple(names)
+
     @property
     def fields(self):
         return self._fields
@@ -316,6 +414,25 @@ class SnapshotBase(object):
         self.header.fname = fname
         self._fname = fname
 
+    @property
+    def precisions(self):
+        """
+        A dict of the precision to which each block may be stored, or None.
+
+        Precisions are given by the optional fifth element of a block's schema,
+        and are used only by lossy storage formats (see columnar). A precision
+        is a (kind, error) pair, where kind is one of
+
+            'box': data are stored as fixed-point integers in units of the
+                   periodic box, with absolute error at most error * BoxSize
+            'relative': floating-point data are stored with their mantissas
+                        rounded, with relative error at most error
+
+        and error is in (0, 1). Decoded 'box' data are also rounded to the
+        block's type. A block with precision None is stored exactly.
+        """
+        return dict(self._precisions)
+
     @property
     def ptype_aliases(self):
         return self._aliases
@@ -340,6 +457,31 @@ class SnapshotBase(object):
         """
         self._ptypes = max(value)
 
+    def aload(self, fields=None, ptypes=None, memmap=False, toc_cache=False,
+              executor=None):
+        """
+        Return a coroutine which loads in snapshot data from the current file.
+
+        fields, ptypes, memmap and toc_cache are as for load(). All file I/O
+        is run on executor (by default, the event loop's default executor),
+        so that many snapshots may be loaded concurrently from one event
+        loop:
+
+            >>> await asyncio.gather(*[s.aload(fields=['pos']) for s in snaps])
+
+        Blocks are read one at a time, and the load may be cancelled between
+        any two. The snapshot's block data are set only once all blocks have
+        been read; if the load is cancelled, only the header may have changed.
+
+        Requires Python 3.7 or later.
+        """
+        from .aio import aload
+        return aload(self, fields, ptypes, memmap, toc_cache, executor)
+
+    def clear_derived(self):
+        """Discard all cached derived field data."""
+        self._derived_cache.clear()
+
     def init_fields(self):
         """Reset all data attributes to zero-like values."""
         for (name, fmt) in self._schema.items():
@@ -347,17 +489,191 @@ class SnapshotBase(object):
             pdata = self._null_block(dtype, ndims, ptypes)
             setattr(self, name, pdata)
 
+    def index_ids(self, ptypes=None, cache=False):
+        """
+        Build the index of particle IDs used by select_ids() and match_ids().
+
+        For each particle type in ptypes (by default, all types with ID
+        data), the index is the permutation which sorts the type's IDs. An
+        index is otherwise built when first needed, and is kept until the
+        type's ID array is reassigned. It is not updated if the array is
+        modified in place, in which case index_ids() must be called again.
+
+        If cache is True, the index is read from a sidecar file alongside the
+        current file when that is valid for this snapshot (see
+        table_of_contents()), or else written to it. The cache is
+        used only for types whose ID arrays are those read from the current
+        file, and not since reassigned, e.g. by sort_peano_hilbert(), and is
+        written only for types all of whose IDs are loaded, so not for types
+        omitted from load() with ptypes. It is not used after in-place
+        modification of the IDs.
+
+        raise a SnapshotIOException if cache is True and the snapshot has no
+        file.
+        """
+        if cache and self.fname is None:
+            raise SnapshotIOException("Snapshot has no file to cache IDs of")
+        ptypes = self._id_ptypes(ptypes)
+        from_file = [p for p in ptypes if self._ids_from_file(p)]
+        cached = {}
+        if cache and from_file:
+            cached = sidecar.load_arrays(self.fname, 'ids',
+                                         self._sidecar_key()) or {}
+
+        built = []
+        for p in ptypes:
+            ids = self.ID[p]
+            order = cached.get('order%d' % p) if p in from_file else None
+            if order is None or len(order) != len(ids):
+                order = np.argsort(ids, kind='mergesort')
+                built.append(p)
+            self._id_index[p] = (_reference(ids), order, ids[order])
+
+        writable = [p for p in built if p in from_file and
+                    len(self.ID[p]) == self._ptype_count(p)]
+        if cache and writable:
+            orders = dict(cached)
+            for p in writable:
+                orders['order%d' % p] = self._id_index[p][1]
+            sidecar.save_arrays(self.fname, 'ids', orders, self._sidecar_key())
+
+    def iter_chunks(self, fields, ptype, chunk_size):
+        """
+        Iterate over the particles of one type in chunks, reading from file.
+
+        fields is an iterable of block names, ptype a particle type index (or
+        alias), and chunk_size the maximum number of particles per chunk.
+        Each chunk is a SnapshotView whose attributes are the named blocks'
+        data for the same contiguous range of particles. Only that range is
+        read from the file for each block, so no full block is ever held in
+        memory.
+
+        The header is loaded from the current file, replacing the current
+        header data. Block data already loaded are not affected.
+        """
+        if self._aliases and ptype in self._aliases:
+            ptype = self._aliases[ptype]
+        fields = list(fields)
+        with FortranFile(self.fname, 'rb') as ffile:
+            self._load_header(ffile)
+            offsets = self._block_offsets(ffile)
+            count = self._ptype_count(ptype)
+            for begin in range(0, count, chunk_size):
+                end = min(begin + chunk_size, count)
+                chunk = [(name, self._read_chunk(ffile, offsets, name, ptype,
+                                                 begin, end))
+                         for name in fields]
+                yield SnapshotView(self, chunk)
+
     def iterfields(self):
         for name in self.fields:
             yield (name, getattr(self, name))
 
-    def load(self):
-        """Load in snapshot data from the current file."""
-        with FortranFile(self.fname, 'rb') as ffile:
-            self.header._load(ffile)
-            self._load(ffile)
+    def load(self, fields=None, ptypes=None, memmap=False, lazy=False,
+             toc_cache=False, prefetch=False):
+        """
+        Load in snapshot data from the current file.
+
+        fields is an optional iterable of block names to load. Blocks not in
+        fields are skipped over in the file, and set to null blocks.
+        ptypes is an optional iterable of particle type indices to load. Data
+        for other particle types are not read, and are set to empty arrays.
+        A snapshot loaded with ptypes may be saved, and the file written then
+        holds only the loaded particle types. A snapshot loaded with fields
+        cannot be saved, as blocks not loaded have no data; see save().
+
+        If memmap is True, block data are not read into memory. Instead, each
+        particle type's array is a view of a copy-on-write memory map of the
+        file, and data are paged in from disk only as they are accessed.
+        In-place modification of such arrays does not alter the file.
+
+        If lazy is True, only the header is read, and the file is scanned for
+        the location of each block. A block is then read from file (subject to
+        memmap) only when its attribute is first accessed. The header should
+        not be modified until all required blocks have been accessed.
+        If toc_cache is also True, block locations are taken from the file's
+        cached table of contents, when it is valid. See table_of_contents().
+
+        If prefetch is True, or a number of bytes, and neither memmap nor lazy
+        is True, a background thread reads each block's record while the
+        previous block is being parsed, holding at most that many bytes
+        (64 MiB, if True) of records at once. See PrefetchingFortranFile.
+        With fields, blocks are first located, from the cached table of
+        contents if toc_cache is True, and only the records of blocks in
+        fields are then prefetched. With ptypes, nothing is prefetched, as
+        records are then read only in part.
+        """
+        if ptypes is not None:
+            ptypes = list(ptypes)
+
+        # Whether blocks are located before any are read.
+        locate = False
+        if prefetch and not (memmap or lazy) and ptypes is None:
+            kwargs = {}
+            if prefetch is not True:
+                kwargs['budget'] = prefetch
+            if fields is not None:
+                # Nothing is prefetched until the blocks have been located.
+                kwargs['offsets'] = []
+                locate = True
+            reader = PrefetchingFortranFile(self.fname, **kwargs)
+        else:
+            reader = FortranFile(self.fname, 'rb', memmap=memmap)
+
+        self._lazy_blocks = {}
+        with reader as ffile:
+            self._load_header(ffile)
+            if lazy:
+                self._lazy_source = (self.fname, memmap, ptypes)
+                self._scan(ffile, fields, toc_cache)
+            elif locate:
+                self._load_located(ffile, fields, toc_cache)
+            else:
+                self._load(ffile, fields, ptypes)
 
-    def save(self, fname=None):
+    def match_ids(self, other, ptype, other_ptype=None):
+        """
+        Return the indices of particles with the same IDs in another snapshot.
+
+        A pair (i, j) of index arrays is returned such that
+
+            self.ID[ptype][i] == other.ID[other_ptype][j]
+
+        for every particle of type other_ptype in other whose ID is that of
+        a particle of type ptype in this snapshot, in order of j. other_ptype
+        defaults to ptype, but may differ, e.g. to match gas to star
+        particles. Particle types may also be given as aliases.
+        """
+        if other_ptype is None:
+            other_ptype = ptype
+        other_ptype, = other._id_ptypes([other_ptype, ])
+        rows, found = self._id_lookup(ptype, other.ID[other_ptype])
+        return (rows, np.nonzero(found)[0])
+
+    @classmethod
+    def register_derived(cls, name, func, depends, ptypes=None):
+        """
+        Register a derived field for this class and its subclasses.
+
+        func(snapshot, ptype) must return the field's data for the particles
+        of type ptype, computed from the data of the fields named in depends.
+        These may be blocks, other derived fields, or any other attributes of
+        the snapshot. The field is valid only for particle types in ptypes (by
+        default, all), and for which every block and derived field it depends
+        on is valid; for other types, its data are None.
+
+        A field registered for a subclass replaces one of the same name
+        registered for a base class, and both are replaced by a block of the
+        same name.
+        """
+        if '_derived_registry' not in cls.__dict__:
+            cls._derived_registry = OrderedDict()
+        if ptypes is not None:
+            ptypes = list(ptypes)
+        field = DerivedField(name, func, tuple(depends), ptypes)
+        cls._derived_registry[name] = field
+
+    def save(self, fname=None, nthreads=1):
         """
         Write header and snapshot to the current file, overwriting the file.
 
@@ -365,22 +681,132 @@ class SnapshotBase(object):
         does not modify the header's or the snapshot's fname attribute, so
         later calling load() will re-load data from the original file.
 
+        By default, records are written serially by the calling thread. If
+        nthreads is not 1, the location of every record is computed first,
+        and records are then written concurrently by nthreads threads (or, if
+        nthreads is None, one per CPU) using positional writes. See
+        ParallelFortranWriter. The resulting file is identical.
+
         The method will raise a SnapshotIOException if the any field is not
-        valid. See verify().
+        valid (see verify()), or if any block to be written has no data for a
+        particle type with particles, e.g. after load() with fields.
+
+        If fname is the file from which the snapshot was loaded with memmap or
+        lazy, all data still mapped from or pending in that file are first
+        read into memory, as writing replaces the file's contents.
         """
         if fname is None:
             fname = self.fname
 
-        if self.header.verify() != []:
-            raise SnapshotIOException("Current header state invalid")
-        if self.verify() != []:
-            raise SnapshotIOException("A field does not match the schema")
-
-        self.update_header()
-        with FortranFile(fname, 'wb') as ffile:
-            self.header._save(ffile)
+        self._verify_save()
+        self._detach_file(fname)
+        if nthreads == 1:
+            writer = FortranFile(fname, 'wb')
+        else:
+            writer = ParallelFortranWriter(fname, nthreads=nthreads)
+        with writer as ffile:
+            self._save_header(ffile)
             self._save(ffile)
 
+    def save_block(self, name, ptypes=None, fname=None):
+        """
+        Overwrite the data of block name in an existing file, in place.
+
+        Only the block's record is written, and the rest of the file,
+        including its header, is unchanged. ptypes optionally restricts
+        writing to the data of the given particle types (indices or aliases).
+        A different file name to write to may optionally be provided.
+
+        The file's header, rather than the current header, determines the
+        block's location and layout. For example,
+
+            >>> s.load(fields=['hsml'])
+            >>> s.hsml[0] *= 2
+            >>> s.save_block('hsml')
+
+        The method will raise a SnapshotIOException if the block, or data for
+        a particle type, is not present in the file, or if the current data
+        differ in size from the file's.
+        """
+        if fname is None:
+            fname = self.fname
+        if name not in self._schema:
+            raise SnapshotIOException("Block '%s' not in schema" % name)
+
+        dtype, ndims, valid_ptypes, _ = self._schema[name]
+        pdata = getattr(self, name)
+
+        # Read the file's header into a copy, leaving the current header as-is.
+        disk = self._empty_copy()
+        with FortranFile(fname, 'r+b') as ffile:
+            disk._load_header(ffile)
+            offsets = disk._block_offsets(ffile)
+            if offsets.get(name) is None:
+                message = "Block '%s' not present in file" % name
+                raise SnapshotIOException(message)
+            layout = disk._block_layout(name, ndims, valid_ptypes)
+
+            if ptypes is None:
+                ptypes = [p for (p, rng) in enumerate(layout)
+                          if rng is not None]
+            ranges = []
+            arrays = []
+            for p in ptypes:
+                if self._aliases and p in self._aliases:
+                    p = self._aliases[p]
+                if layout[p] is None:
+                    message = ("No data for particle type %d in block '%s'" %
+                               (p, name))
+                    raise SnapshotIOException(message)
+                begin, end = layout[p]
+                if pdata[p] is None or np.size(pdata[p]) != end - begin:
+                    message = ("Data for particle type %d in block '%s' "
+                               "differ in size from file" % (p, name))
+                    raise SnapshotIOException(message)
+                ranges.append(layout[p])
+                arrays.append(np.asarray(pdata[p], dtype=dtype))
+
+            ffile.seek(offsets[name])
+            ffile.write_record_parts(dtype, ranges, arrays)
+
+    def select_ids(self, ids, ptypes=None):
+        """
+        Return the indices of the particles with the given IDs.
+
+        A list is returned with, for each particle type, either None, if the
+        type has no ID data or is not in ptypes, or an array of the indices of
+        its particles whose ID is in ids, in the order of ids. IDs not found
+        are omitted. For example, the positions of those star particles are
+
+            >>> s.pos[4][s.select_ids(ids)[4]]
+        """
+        ids = np.asarray(ids)
+        rows = [None for _ in self.ptype_indices]
+        for p in self._id_ptypes(ptypes):
+            rows[p], _ = self._id_lookup(p, ids)
+        return rows
+
+    def table_of_contents(self, cache=False):
+        """
+        Return the table of contents of the current file.
+
+        A list of TOCEntry(name, offset, nbytes, dtype) tuples is returned,
+        one for each record in the file, in file order. The header record is
+        named 'header'. offset is the location of the record's leading
+        control bytes in the file, and nbytes is the size of its payload.
+
+        The header is loaded from the current file, replacing the current
+        header data. Otherwise, only record control bytes are read.
+
+        If cache is True, the table of contents is read from the sidecar file
+        'fname.toc' if that exists, matches the size and modification time of
+        the file, and was written by a snapshot of the same class, schemas and
+        format. Otherwise, the file is scanned and the sidecar (re-)written.
+        """
+        with FortranFile(self.fname, 'rb') as ffile:
+            self._load_header(ffile)
+            return self._read_toc(ffile, cache)
+
     def update_header(self):
         """
         Update the header based on the current snapshot state.
@@ -403,8 +829,10 @@ class SnapshotBase(object):
             dtype, ndims, _, _ = self._schema[name]
             arrays = [a for a in getattr(self, name) if a is not None]
             for a in arrays:
-                if a.dtype != dtype or (a.ndim > 1 and a.shape[-1] != ndims):
-                    print name, a.dtype, dtype
+                # Data read from a file of non-native byte order keep that
+                # order, and are converted when written.
+                if (a.dtype.newbyteorder('=') != dtype or
+                        (a.ndim > 1 and a.shape[-1] != ndims)):
                     malformed.append(name)
                     # Don't want duplicates; one problem is sufficient.
                     break
@@ -422,23 +850,245 @@ class SnapshotBase(object):
         """
         raise NotImplementedError("Subclassees must override _block_exists")
 
+    def _block_layout(self, name, ndims, ptypes):
+        """
+        Return the location of each particle type's data within a block.
+
+        A list is returned with, for each particle type, either a (begin, end)
+        pair of item indices within the block's record, or None if the block
+        holds no data for that particle type.
+
+        Must be overriden by subclasses.
+        """
+        raise NotImplementedError("Subclasses must override _block_layout")
+
+    def _block_offsets(self, ffile):
+        """
+        Return the offset of each block present in the open FortranFile ffile.
+
+        An OrderedDict of block names to file offsets is returned, in schema
+        order. Only blocks with flags resolving to True are included. The file
+        position must be at the start of the first block, and only record
+        control bytes are read.
+        """
+        offsets = OrderedDict()
+        for (name, fmt) in self._schema.items():
+            _, _, ptypes, flag = fmt
+            if self._block_exists(name, ptypes) and self._get_flag(flag):
+                offsets[name] = ffile.tell()
+                self._skip_block(ffile, name)
+        return offsets
+
+    def _derived_array(self, name, ptype):
+        """
+        Return the data of derived field name for particle type ptype.
+
+        Data are taken from the cache if none of the field's dependencies
+        have since been reassigned, and are otherwise computed and cached.
+        None is returned if the field is not valid for the type.
+        """
+        field = self._derived_field(name)
+        dependencies = self._derived_dependencies(field, ptype)
+        if dependencies is None:
+            return None
+
+        key = (name, ptype)
+        cache = self._derived_cache
+        cached = cache.pop(key, None)
+        if cached is not None and all(_refers_to(ref, d) for (ref, d) in
+                                      zip(cached[1], dependencies)):
+            # Reinserted as the most recently used.
+            cache[key] = cached
+            return cached[0]
+
+        data = field.func(self, ptype)
+        if data.nbytes <= self.derived_cache_bytes:
+            references = [_reference(d) for d in dependencies]
+            cache[key] = (data, references)
+            total = sum(d.nbytes for (d, _) in cache.values())
+            while total > self.derived_cache_bytes:
+                _, (old, _) = cache.popitem(last=False)
+                total -= old.nbytes
+        return data
+
+    def _derived_dependencies(self, field, ptype):
+        """
+        Return the current data of each dependency of field for type ptype.
+
+        None is returned if the field is not valid for the type.
+        """
+        if field.ptypes is not None and ptype not in field.ptypes:
+            return None
+        dependencies = []
+        for dep in field.depends:
+            if dep in self._schema:
+                data = getattr(self, dep)[ptype]
+            elif dep in self.derived_fields:
+                data = self._derived_array(dep, ptype)
+            else:
+                dependencies.append(getattr(self, dep))
+                continue
+            if data is None:
+                return None
+            dependencies.append(data)
+        return dependencies
+
+    def _derived_depends(self, name):
+        """Return the fields on which derived field name depends."""
+        field = self._derived_field(name)
+        names = set(field.depends)
+        for dep in field.depends:
+            if dep not in self._schema and dep in self.derived_fields:
+                names |= self._derived_depends(dep)
+        return names
+
+    def _derived_field(self, name):
+        """Return the DerivedField registered as name for this class."""
+        for klass in type(self).__mro__:
+            registry = klass.__dict__.get('_derived_registry', {})
+            if name in registry:
+                return registry[name]
+        raise KeyError(name)
+
+    def _detach_file(self, fname):
+        """
+        Read all block data mapped from, or pending in, file fname into memory.
+        """
+        if not os.path.exists(fname):
+            return
+        source = self._lazy_source
+        if (self._lazy_blocks and isinstance(source, tuple) and
+                os.path.exists(source[0]) and
+                os.path.samefile(source[0], fname)):
+            for name in list(self._lazy_blocks):
+                getattr(self, name)
+
+        for name in self.fields:
+            pdata = getattr(self, name)
+            for (p, parray) in enumerate(pdata):
+                if parray is None:
+                    continue
+                # The file, if any, of which parray is a memory-mapped view.
+                base = parray
+                while base is not None and not (isinstance(base, np.memmap)
+                                                and base.filename):
+                    base = getattr(base, 'base', None)
+                if base is not None and os.path.samefile(base.filename, fname):
+                    pdata[p] = np.array(parray)
+
+    def _empty_copy(self):
+        """
+        Return a snapshot with the same class and schemas, but with no data.
+
+        The copy has a copy of the header, but no block data, and shares none
+        of this snapshot's caches, so that it may load another file's header
+        without affecting this snapshot.
+        """
+        state = dict((k, v) for (k, v) in self.__dict__.items()
+                     if k not in self._schema)
+        state.update(header=copy(self.header), _lazy_blocks={},
+                     _lazy_source=None, _id_index={}, _file_ids=None,
+                     _derived_cache=OrderedDict())
+        empty = object.__new__(type(self))
+        empty.__dict__.update(state)
+        return empty
+
     def _get_flag(self, flag):
         if isinstance(flag, str):
             return getattr(self.header, flag)
         else:
             return flag
 
-    def _load(self, ffile):
+    def _id_lookup(self, ptype, ids):
+        """
+        Return the indices of the particles of type ptype with IDs ids.
+
+        A pair (rows, found) is returned, where found is a boolean array which
+        is True for each element of ids present, and rows holds the index of
+        the particle with each such ID. The index is built if necessary.
+        """
+        ptype, = self._id_ptypes([ptype, ])
+        index = self._id_index.get(ptype)
+        if index is None or not _refers_to(index[0], self.ID[ptype]):
+            self.index_ids([ptype, ])
+            index = self._id_index[ptype]
+
+        _, order, sorted_ids = index
+        ids = np.asarray(ids)
+        if len(sorted_ids) == 0:
+            return (np.empty(0, dtype='i8'), np.zeros(ids.shape, dtype=bool))
+        pos = np.searchsorted(sorted_ids, ids)
+        np.minimum(pos, len(sorted_ids) - 1, out=pos)
+        found = sorted_ids[pos] == ids
+        return (order[pos[found]], found)
+
+    def _id_ptypes(self, ptypes=None):
+        """
+        Return the list of indices of ptypes, all types with ID data if None.
+
+        raise a SnapshotIOException if any type has no ID data.
+        """
+        if 'ID' not in self._schema:
+            raise SnapshotIOException("Snapshot has no 'ID' block")
+        if ptypes is None:
+            return [p for (p, ids) in enumerate(self.ID) if ids is not None]
+
+        indices = []
+        for p in ptypes:
+            if self._aliases and p in self._aliases:
+                p = self._aliases[p]
+            if self.ID[p] is None:
+                message = "No ID data for particle type %d" % p
+                raise SnapshotIOException(message)
+            indices.append(p)
+        return indices
+
+    def _ids_from_file(self, ptype):
+        """Return True if the IDs of type ptype are as read from the file."""
+        if self._file_ids is None:
+            return False
+        fname, references = self._file_ids
+        return (fname == self.fname and
+                _refers_to(references[ptype], self.ID[ptype]))
+
+    def _incomplete_blocks(self):
+        """
+        Return the names of blocks lacking data for types with particles.
+
+        Only blocks which would be written to file are considered; for each,
+        every valid particle type with particles must have as many rows of
+        data as particles.
+        """
+        incomplete = []
+        for (name, fmt) in self._schema.items():
+            _, _, ptypes, flag = fmt
+            if not (self._block_exists(name, ptypes) and self._get_flag(flag)):
+                continue
+            pdata = getattr(self, name)
+            for p in ptypes:
+                count = self._ptype_count(p)
+                if count > 0 and (pdata[p] is None or len(pdata[p]) != count):
+                    incomplete.append(name)
+                    break
+        return incomplete
+
+    def _load(self, ffile, fields=None, load_ptypes=None):
         """
         Load data for each block in the schema from the open FortranFile ffile.
 
         Only blocks with flags resolving to True are loaded from the file.
+        If fields is not None, blocks not in fields are skipped.
+        If load_ptypes is not None, only data for those particle types are
+        loaded.
         """
         for (name, fmt) in self._schema.items():
             dtype, ndims, ptypes, flag = fmt
             if self._block_exists(name, ptypes) and self._get_flag(flag):
-                block_data = self._load_block(ffile, name, dtype)
-                pdata = self._parse_block(block_data, name, dtype, ndims, ptypes)
+                if fields is not None and name not in fields:
+                    self._skip_block(ffile, name)
+                    pdata = self._null_block(dtype, ndims, ptypes)
+                else:
+                    pdata = self._read_block(ffile, name, load_ptypes)
             else:
                 pdata = self._null_block(dtype, ndims, ptypes)
             setattr(self, name, pdata)
@@ -452,6 +1102,79 @@ class SnapshotBase(object):
         """
         return ffile.read_record(dtype)
 
+    def _load_block_ptypes(self, ffile, name, dtype, ndims, ptypes,
+                           load_ptypes):
+        """
+        Return a list of data for each particle type in the next block.
+
+        Only data for particle types in load_ptypes are returned; other valid
+        particle types are set to empty arrays.
+
+        By default the whole block is read and parsed. Subclasses which can
+        locate each particle type's data within the record should override
+        this to read only the required data.
+        """
+        block_data = self._load_block(ffile, name, dtype)
+        pdata = self._parse_block(block_data, name, dtype, ndims, ptypes)
+        for p in self.ptype_indices:
+            if pdata[p] is not None and p not in load_ptypes:
+                pdata[p] = self._null_block(dtype, ndims, [p, ])[p]
+        return pdata
+
+    def _load_header(self, ffile):
+        """
+        Load the header from the open FortranFile ffile.
+
+        This is called at the start of the file, before loading any block, and
+        may need to be overriden by subclasses.
+        """
+        self.header._load(ffile)
+
+    def _load_lazy_block(self, name):
+        """
+        Read, set and return the data for block name, pending from a lazy load.
+        """
+        offset = self._lazy_blocks[name]
+        if callable(self._lazy_source):
+            # Blocks pending from a source other than a snapshot file, which
+            # reads them itself. See ColumnarReader.load().
+            pdata = self._lazy_source(name)
+        else:
+            fname, memmap, load_ptypes = self._lazy_source
+            with FortranFile(fname, 'rb', memmap=memmap) as ffile:
+                # A block with no record (see _skip_block) has no offset in
+                # the table of contents, and nothing is read for it.
+                if offset is not None:
+                    ffile.seek(offset)
+                pdata = self._read_block(ffile, name, load_ptypes)
+        setattr(self, name, pdata)
+        del self._lazy_blocks[name]
+        return pdata
+
+    def _load_located(self, ffile, fields, toc_cache=False):
+        """
+        Load the blocks in fields from the open PrefetchingFortranFile ffile.
+
+        The blocks are first located from the table of contents, read from
+        ffile or, if toc_cache is True, its cache (see _read_toc()), and only
+        their records are then prefetched. Other blocks are set to null blocks.
+        """
+        offsets = self._toc_offsets(self._read_toc(ffile, toc_cache))
+        wanted = [name for name in offsets if name in fields]
+        ffile.set_offsets([offsets[name] for name in wanted
+                           if offsets[name] is not None])
+        for (name, fmt) in self._schema.items():
+            dtype, ndims, ptypes, _ = fmt
+            if name in wanted:
+                # A block with no record (see _skip_block) has no offset, and
+                # nothing is read for it.
+                if offsets[name] is not None:
+                    ffile.seek(offsets[name])
+                pdata = self._read_block(ffile, name)
+            else:
+                pdata = self._null_block(dtype, ndims, ptypes)
+            setattr(self, name, pdata)
+
     def _null_array(self, dtype):
         """Return an empty numpy array of element type dtype."""
         return np.empty(0, dtype=dtype)
@@ -482,17 +1205,219 @@ class SnapshotBase(object):
         """
         raise NotImplementedError("Subclasses must override _parse_block")
 
+    def _ptype_count(self, ptype):
+        """
+        Return the number of particles of type ptype in the current file.
+
+        Must be overriden by subclasses.
+        """
+        raise NotImplementedError("Subclasses must override _ptype_count")
+
     def _ptype_view(self, index):
-        ptype_data = ((name, field[index]) for name, field in self.iterfields())
-        view = SnapshotView(self, ptype_data)
+        ptype_data = ((name, field[index])
+                      for (name, field) in self.iterfields())
+        view = SnapshotView(self, ptype_data, index)
         return view
 
+    def _read_block(self, ffile, name, load_ptypes=None):
+        """
+        Read and return the data for block name from the open FortranFile
+        ffile.
+
+        If load_ptypes is not None, only data for those particle types are
+        read.
+        """
+        dtype, ndims, ptypes, _ = self._schema[name]
+        if load_ptypes is None:
+            block_data = self._load_block(ffile, name, dtype)
+            pdata = self._parse_block(block_data, name, dtype, ndims, ptypes)
+        else:
+            pdata = self._load_block_ptypes(ffile, name, dtype, ndims, ptypes,
+                                            load_ptypes)
+        if name == 'ID':
+            # So that the cached ID index is used only for these arrays.
+            self._file_ids = (ffile.fname, [_reference(a) for a in pdata])
+        return pdata
+
+    def _read_chunk(self, ffile, offsets, name, ptype, begin, end):
+        """
+        Return the data for particles [begin, end) of type ptype in block name.
+
+        offsets are the block offsets in the open FortranFile ffile, as
+        returned by _block_offsets().
+        """
+        dtype, ndims, ptypes, _ = self._schema[name]
+        if ptype not in ptypes:
+            message = ("Particle type %d not valid for block '%s'" %
+                       (ptype, name))
+            raise SnapshotIOException(message)
+        if name not in offsets:
+            message = "Block '%s' not present in file" % name
+            raise SnapshotIOException(message)
+
+        rng = self._block_layout(name, ndims, ptypes)[ptype]
+        if rng is None:
+            message = ("No data for particle type %d in block '%s'" %
+                       (ptype, name))
+            raise SnapshotIOException(message)
+        ffile.seek(offsets[name])
+        chunk_range = (rng[0] + begin * ndims, rng[0] + end * ndims)
+        parray, = ffile.read_record_parts(dtype, [chunk_range, ])
+        if ndims > 1:
+            parray.shape = (end - begin, ndims)
+        return parray
+
+    def _read_toc(self, ffile, cache=False):
+        """
+        Return the table of contents of the open FortranFile ffile.
+
+        The header must already have been loaded. If cache is True, the
+        cached table of contents is used if valid, or else written.
+        See table_of_contents().
+        """
+        key = self._sidecar_key()
+        if cache:
+            entries = sidecar.load_json(ffile.fname, 'toc', key)
+            if entries is not None:
+                return [TOCEntry(*entry) for entry in entries]
+
+        toc = self._toc_entries(ffile)
+        if cache:
+            sidecar.save_json(ffile.fname, 'toc', [list(e) for e in toc], key)
+        return toc
+
     def _save(self, ffile):
         for name in self.fields:
-            # If a is an empty numpy array, nothing will be written, so we
-            # do not need to filter out empty arrays.
-            arrays = [a for a in getattr(self, name) if a is not None]
-            ffile.write_ndarrays(arrays)
+            arrays = self._save_arrays(name)
+            if arrays is not None:
+                ffile.write_ndarrays(arrays)
+
+    def _save_arrays(self, name):
+        """
+        Return the list of arrays to write to file as the record for block
+        name.
+
+        None is returned if the block should have no record in the file; that
+        is, if it would not be read by load(). This may need to be overriden
+        by subclasses.
+        """
+        _, _, ptypes, flag = self._schema[name]
+        if not (self._block_exists(name, ptypes) and self._get_flag(flag)):
+            return None
+        # If a is an empty numpy array, nothing will be written, so we
+        # do not need to filter out empty arrays.
+        return [a for a in getattr(self, name) if a is not None]
+
+    def _save_header(self, ffile):
+        """
+        Write the header to the open FortranFile ffile.
+
+        This is the counterpart to _load_header(), and may need to be
+        overriden by subclasses.
+        """
+        self.header._save(ffile)
+
+    def _scan(self, ffile, fields=None, toc_cache=False):
+        """
+        Record the offset of each block in the open FortranFile ffile.
+
+        Blocks present in the file are removed from the instance, and read on
+        first access. Blocks with flags resolving to False, or not in fields
+        if it is not None, are set to null blocks.
+
+        If toc_cache is True, offsets are taken from the table of contents.
+        """
+        if toc_cache:
+            offsets = self._toc_offsets(self._read_toc(ffile, cache=True))
+        else:
+            offsets = self._block_offsets(ffile)
+        for (name, fmt) in self._schema.items():
+            dtype, ndims, ptypes, _ = fmt
+            if name in offsets and (fields is None or name in fields):
+                self._lazy_blocks[name] = offsets[name]
+                self.__dict__.pop(name, None)
+            else:
+                setattr(self, name, self._null_block(dtype, ndims, ptypes))
+
+    def _sidecar_key(self):
+        """
+        Return the key of this snapshot's sidecar files. See sidecar.
+
+        The key describes how the file is read, by the snapshot's class and
+        schemas, so that a sidecar derived by reading the file differently is
+        not used. This may need to be extended by subclasses.
+        """
+        blocks = [[name, fmt[0].str, int(fmt[1]), [int(p) for p in fmt[2]],
+                   fmt[3]] for (name, fmt) in self._schema.items()]
+        return {'class': '%s.%s' % (type(self).__module__,
+                                    type(self).__name__),
+                'header': str(self.header.dtype), 'blocks': blocks}
+
+    def _skip_block(self, ffile, name):
+        """
+        Move past the next block in the open FortranFile ffile without reading.
+
+        Return the size of the skipped record's payload in bytes, or None if
+        the block has no record in the file.
+
+        This is the counterpart to _load_block(), and may need to be overriden
+        by subclasses.
+        """
+        return ffile.skip_record()
+
+    def _toc_entries(self, ffile):
+        """
+        Scan the open FortranFile ffile and return its table of contents.
+
+        The header must already have been loaded. May need to be overriden by
+        subclasses whose files do not contain the header and then the blocks
+        in schema order.
+        """
+        ffile.seek(0)
+        toc = [TOCEntry('header', 0, ffile.skip_record(), 'b1')]
+        for (name, fmt) in self._schema.items():
+            dtype, _, ptypes, flag = fmt
+            if self._block_exists(name, ptypes) and self._get_flag(flag):
+                offset = ffile.tell()
+                nbytes = self._skip_block(ffile, name)
+                if nbytes is not None:
+                    toc.append(TOCEntry(name, offset, nbytes, dtype.str))
+        return toc
+
+    def _toc_offsets(self, toc):
+        """
+        Return the offset of each block present in the file, given its toc.
+
+        As _block_offsets(), except that blocks with no record in the file
+        have an offset of None. The header must already have been loaded.
+        """
+        entries = dict((entry.name, entry.offset) for entry in toc)
+        offsets = OrderedDict()
+        for (name, fmt) in self._schema.items():
+            _, _, ptypes, flag = fmt
+            if self._block_exists(name, ptypes) and self._get_flag(flag):
+                offsets[name] = entries.get(name)
+        return offsets
+
+    def _verify_save(self):
+        """
+        Update the header, and check that the snapshot may be saved.
+
+        raise a SnapshotIOException if the header or any field is not valid,
+        or if any block to be written has no data for a particle type with
+        particles. See save().
+        """
+        if self.header.verify() != []:
+            raise SnapshotIOException("Current header state invalid")
+        if self.verify() != []:
+            raise SnapshotIOException("A field does not match the schema")
+
+        self.update_header()
+        incomplete = self._incomplete_blocks()
+        if incomplete:
+            message = ("Blocks %s have no data for some particle types"
+                       % ', '.join(incomplete))
+            raise SnapshotIOException(message)
 
     def _verify_schema(self):
         """
@@ -504,6 +1429,9 @@ class SnapshotBase(object):
         be 1.
         When a block's particle type is also not supplied, it is assumed to
         apply to all particle types.
+        A block's schema may have a fifth element, the precision to which its
+        data may be stored in lossy formats, or None. See the precisions
+        property.
 
         All valid particle types must appear in at least one of the block
         schemas, though a particle type of 0 is always assumed.
@@ -518,7 +1446,10 @@ class SnapshotBase(object):
         for (name, fmt) in self._schema.items():
             # So that these are defined even for an invalid formatter.
             dtype, ndims, ptypes, flag = ('f4', 1, [None, ], True)
-            if len(fmt) == 4:
+            precision = self._precisions.get(name)
+            if len(fmt) == 5:
+                dtype, ndims, ptypes, flag, precision = fmt
+            elif len(fmt) == 4:
                 dtype, ndims, ptypes, flag = fmt
             elif len(fmt) == 3:
                 dtype, ndims, ptypes = fmt
@@ -543,8 +1474,19 @@ class SnapshotBase(object):
                 message = "N-dimensions size for block '%s' is invalid." % name
                 raise SnapshotIOException(message)
 
+            if precision is not None:
+                try:
+                    kind, error = precision
+                    valid = kind in ('box', 'relative') and 0 < error < 1
+                except (TypeError, ValueError):
+                    valid = False
+                if not valid:
+                    message = "Precision for block '%s' is invalid." % name
+                    raise SnapshotIOException(message)
+
             max_ptype = max(max_ptype, max(ptypes))
             self._schema[name] = (dtype, ndims, ptypes, flag)
+            self._precisions[name] = precision
 
         if max_ptype == -1:
             message = 'At least one block schema must have specified ptypes'
@@ -559,3 +1501,21 @@ class SnapshotBase(object):
                 self._schema[name] = self.ptype_indices
 
         self._fields = self._schema.keys()
+
+def _reference(obj):
+    """
+    Return a reference to obj which does not keep it alive, if possible.
+
+    Arrays are referred to weakly; objects which cannot be, such as None or
+    tuples, are referred to directly.
+    """
+    try:
+        return weakref.ref(obj)
+    except TypeError:
+        return obj
+
+def _refers_to(reference, obj):
+    """Return True if reference, from _reference(), refers to obj."""
+    if isinstance(reference, weakref.ref):
+        return reference() is obj
+    return reference is obj
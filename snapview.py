@@ -30,15 +30,29 @@ class SnapshotView(object):
         False
         >>> g.gas.hsml is g.hsml[0]
         True
+
+    A view of all particles of one type, such as g.gas, also has an attribute
+    for each of the snapshot's derived fields, computed for that type when
+    first accessed. See SnapshotBase.register_derived().
     """
 
-    def __init__(self, _parent_snapshot, _data):
+    def __init__(self, _parent_snapshot, _data, _ptype=None):
         super(SnapshotView, self).__setattr__('_parent', _parent_snapshot)
+        super(SnapshotView, self).__setattr__('_ptype', _ptype)
         super(SnapshotView, self).__setattr__('_fields', set())
         for (name, value) in _data:
             self._fields.add(name)
             super(SnapshotView, self).__setattr__(name, value)
 
+    def __getattr__(self, name):
+        # Only called when normal attribute lookup fails.
+        parent = self.__dict__.get('_parent')
+        ptype = self.__dict__.get('_ptype')
+        if ptype is not None and name in parent.derived_fields:
+            return parent._derived_array(name, ptype)
+        msg = "'%s' object has no attribute %s" % (type(self).__name__, name)
+        raise AttributeError(msg)
+
     # TODO: We should be able to change attributes of the view, and these
     # changes should be propagated to the parent snapshot.
     def __setattr__(self, name, value):
@@ -47,3 +61,31 @@ class SnapshotView(object):
     @property
     def fields(self):
         return tuple(self._fields)
+
+
+class DerivedBlock(object):
+    """
+    The data of a derived field of a snapshot, for each particle type.
+
+    Indexed like a block, so that s.derived_name[p] is the field's data for
+    particle type p, or None if the field is not valid for that type. Data
+    are computed, or taken from the snapshot's cache, only for the types
+    indexed. See SnapshotBase.register_derived().
+    """
+
+    def __init__(self, _parent_snapshot, _name):
+        self._parent = _parent_snapshot
+        self._name = _name
+
+    def __getitem__(self, index):
+        ptypes = list(self._parent.ptype_indices)
+        if isinstance(index, slice):
+            return [self[p] for p in ptypes[index]]
+        return self._parent._derived_array(self._name, ptypes[index])
+
+    def __iter__(self):
+        for p in self._parent.ptype_indices:
+            yield self._parent._derived_array(self._name, p)
+
+    def __len__(self):
+        return len(self._parent.ptype_indices)
@@ -0,0 +1,324 @@
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from . import sidecar
+from .snapshot import SnapshotIOException
+from .snapview import SnapshotView
+
+# The mean number of particles per cell of a default grid, and the maximum
+# number of cells along each side of any default grid.
+_PARTICLES_PER_CELL = 8
+_MAX_CELLS = 128
+
+class SpatialIndex(object):
+    """
+    A spatial index over the positions of a snapshot's particles.
+
+    Particles are binned into a grid of ncells^3 cubic cells, with one
+    sorting permutation of each particle type's particles by cell. If
+    header.BoxSize is positive, the grid spans the periodic box [0, BoxSize)
+    and queries use the nearest periodic image of every particle. Otherwise,
+    the grid spans the particles' extent, and the volume is not periodic.
+
+        >>> from glio import GadgetSnapshot, SpatialIndex
+        >>> s = GadgetSnapshot('file_name')
+        >>> s.load()
+        >>> index = SpatialIndex(s)
+        >>> rows = index.sphere(centre, radius)
+        >>> halo = index.view(1, rows[1])
+        >>> halo.pos.shape
+        (len(rows[1]), 3)
+
+    sphere() and box() return, like a block, a list with one element for
+    each particle type, which is None for types not indexed and otherwise the
+    array of indices of the particles in the region. nearest() returns the k
+    nearest particles of one type. view() returns a SnapshotView of all
+    fields for given particles.
+
+    The index is built by a pool of nthreads threads (by default, one per
+    CPU), one particle type per thread. If cache is True, it is read from a
+    sidecar file alongside the snapshot's file when that is valid for the
+    snapshot (see SnapshotBase.table_of_contents()), of the same grid and of
+    the same numbers of particles, or else written to it.
+    The cached index is correct only for positions as loaded from that file.
+    The index is not updated if positions change.
+
+    Methods:
+        box
+        nearest
+        sphere
+        view
+    """
+
+    def __init__(self, snapshot, ptypes=None, ncells=None, nthreads=None,
+                 cache=False):
+        """
+        snapshot: the snapshot whose 'pos' block is to be indexed
+        ptypes: the particle types to index, by default all with positions
+        ncells: the number of cells along each side of the grid; by default,
+                such that there are about eight particles per cell
+        nthreads: the number of threads used to build the index
+        cache: if True, read the index from, or write it to, a sidecar file
+        """
+        super(SpatialIndex, self).__init__()
+        if 'pos' not in snapshot.fields:
+            raise SnapshotIOException("Snapshot has no 'pos' block")
+
+        self.snapshot = snapshot
+        pos = snapshot.pos
+        if ptypes is None:
+            ptypes = [p for (p, a) in enumerate(pos) if a is not None]
+        aliases = snapshot.ptype_aliases
+        self.ptypes = [aliases[p] if aliases and p in aliases else p
+                       for p in ptypes]
+        for p in self.ptypes:
+            if pos[p] is None:
+                message = "No position data for particle type %d" % p
+                raise SnapshotIOException(message)
+
+        box = float(snapshot.header.BoxSize)
+        self.periodic = box > 0
+        if self.periodic:
+            self.origin = np.zeros(3)
+            self.size = box
+        else:
+            self.origin, self.size = self._extent()
+
+        cached = None
+        if cache:
+            cached = sidecar.load_arrays(snapshot.fname, 'grid',
+                                         snapshot._sidecar_key())
+            if cached is not None and not self._cache_matches(cached, ncells):
+                cached = None
+        if cached is not None:
+            ncells = int(cached['ncells'])
+        elif ncells is None:
+            npart = sum(len(pos[p]) for p in self.ptypes)
+            ncells = npart / float(_PARTICLES_PER_CELL)
+            ncells = int(round(ncells ** (1 / 3.)))
+            ncells = min(max(ncells, 1), _MAX_CELLS)
+        self.ncells = ncells
+        self.cell_size = self.size / float(ncells)
+
+        self._order = [None for _ in pos]
+        self._starts = [None for _ in pos]
+        if cached is not None:
+            for p in self.ptypes:
+                self._order[p] = cached['order%d' % p]
+                self._starts[p] = cached['starts%d' % p]
+        else:
+            pool = ThreadPool(nthreads)
+            try:
+                grids = pool.map(self._build, self.ptypes)
+            finally:
+                pool.close()
+                pool.join()
+            for (p, (order, starts)) in zip(self.ptypes, grids):
+                self._order[p] = order
+                self._starts[p] = starts
+            if cache:
+                self._save_cache()
+
+    def box(self, lower, upper, ptypes=None):
+        """
+        Return the indices of the particles within an axis-aligned box.
+
+        lower and upper are the box's minimum and maximum coordinates. If the
+        volume is periodic, the box may extend beyond [0, BoxSize), and
+        contains all periodic images of particles within it.
+        """
+        lower = np.asarray(lower, dtype='f8')
+        upper = np.asarray(upper, dtype='f8')
+        width = upper - lower
+        rows = [None for _ in self._order]
+        for p in self._query_ptypes(ptypes):
+            idx = self._candidates(p, lower, upper)
+            pos = self.snapshot.pos[p][idx]
+            offset = pos - lower
+            if self.periodic:
+                offset %= self.size
+                inside = np.all((offset <= width) | (width >= self.size),
+                                axis=1)
+            else:
+                inside = np.all((offset >= 0) & (offset <= width), axis=1)
+            rows[p] = np.sort(idx[inside])
+        return rows
+
+    def nearest(self, point, k, ptype):
+        """
+        Return the k particles of type ptype nearest to point.
+
+        A pair (rows, distances) of arrays is returned, in order of increasing
+        distance. Fewer than k particles are returned only if there are fewer
+        than k particles of the type.
+        """
+        ptype, = self._query_ptypes([ptype, ])
+        point = np.asarray(point, dtype='f8')
+        n = len(self._order[ptype])
+        k = min(k, n)
+        # A radius beyond which every particle must lie within the sphere.
+        if self.periodic:
+            limit = self.size * np.sqrt(3.)
+        else:
+            # That of the grid's farthest corner, as point may lie outside it.
+            lower = np.abs(point - self.origin)
+            upper = np.abs(point - self.origin - self.size)
+            limit = np.sqrt((np.maximum(lower, upper) ** 2).sum())
+        radius = self.cell_size
+        while True:
+            idx = self._candidates(ptype, point - radius, point + radius)
+            dist = self._distances(ptype, idx, point)
+            inside = dist <= radius
+            if inside.sum() >= k or radius >= limit:
+                break
+            radius *= 2
+        idx, dist = idx[inside], dist[inside]
+        nearest = np.argsort(dist, kind='mergesort')[:k]
+        return (idx[nearest], dist[nearest])
+
+    def sphere(self, centre, radius, ptypes=None):
+        """
+        Return the indices of the particles within radius of centre.
+
+        If the volume is periodic, the distance to each particle is that to
+        its nearest periodic image.
+        """
+        centre = np.asarray(centre, dtype='f8')
+        rows = [None for _ in self._order]
+        for p in self._query_ptypes(ptypes):
+            idx = self._candidates(p, centre - radius, centre + radius)
+            inside = self._distances(p, idx, centre) <= radius
+            rows[p] = np.sort(idx[inside])
+        return rows
+
+    def view(self, ptype, rows, fields=None):
+        """
+        Return a SnapshotView of the data of particles rows of type ptype.
+
+        The view has an attribute for each of fields (by default, all fields
+        with data for the type), holding the data of those particles. As rows
+        are arbitrary, these are copies of the snapshot's data.
+        """
+        aliases = self.snapshot.ptype_aliases
+        if aliases and ptype in aliases:
+            ptype = aliases[ptype]
+        if fields is None:
+            fields = self.snapshot.fields
+        data = []
+        for name in fields:
+            parray = getattr(self.snapshot, name)[ptype]
+            if parray is not None and len(parray) > 0:
+                data.append((name, parray[rows]))
+        return SnapshotView(self.snapshot, data)
+
+    def _build(self, ptype):
+        """Return the sorting permutation and cell starts of type ptype."""
+        keys = self._cell_keys(self.snapshot.pos[ptype])
+        order = np.argsort(keys, kind='mergesort')
+        counts = np.bincount(keys, minlength=self.ncells ** 3)
+        starts = np.zeros(self.ncells ** 3 + 1, dtype='i8')
+        np.cumsum(counts, out=starts[1:])
+        return (order, starts)
+
+    def _cache_matches(self, cached, ncells):
+        """
+        Return True if the cached index is of the required grid, and of the
+        loaded particles; after load() with ptypes, it may not be.
+        """
+        try:
+            if ncells is not None and int(cached['ncells']) != ncells:
+                return False
+            if not np.allclose(cached['origin'], self.origin):
+                return False
+            if float(cached['size']) != self.size:
+                return False
+            pos = self.snapshot.pos
+            return all(int(cached['npart%d' % p]) == len(pos[p]) and
+                       len(cached['order%d' % p]) == len(pos[p])
+                       for p in self.ptypes)
+        except KeyError:
+            return False
+
+    def _candidates(self, ptype, lower, upper):
+        """
+        Return the indices of all particles in cells overlapping a box.
+
+        lower and upper are the box's minimum and maximum coordinates.
+        """
+        n = self.ncells
+        first = np.floor((lower - self.origin) / self.cell_size).astype('i8')
+        last = np.floor((upper - self.origin) / self.cell_size).astype('i8')
+        cells = []
+        for (a, b) in zip(first, last):
+            if self.periodic:
+                if b - a + 1 >= n:
+                    cells.append(np.arange(n))
+                else:
+                    cells.append(np.arange(a, b + 1) % n)
+            else:
+                cells.append(np.arange(max(a, 0), min(b, n - 1) + 1))
+        ix, iy, iz = np.meshgrid(*cells, indexing='ij')
+        keys = ((ix * n + iy) * n + iz).ravel()
+
+        starts = self._starts[ptype]
+        begins = starts[keys]
+        counts = starts[keys + 1] - begins
+        total = counts.sum()
+        # For each candidate, its position in the sorted order is the start
+        # of its cell plus its position within the cell.
+        offsets = np.repeat(begins - (np.cumsum(counts) - counts), counts)
+        return self._order[ptype][offsets + np.arange(total)]
+
+    def _cell_keys(self, pos):
+        """Return the linear index of the cell containing each position."""
+        n = self.ncells
+        cells = np.floor((pos - self.origin) / self.cell_size).astype('i8')
+        if self.periodic:
+            cells %= n
+        else:
+            np.clip(cells, 0, n - 1, out=cells)
+        return (cells[:, 0] * n + cells[:, 1]) * n + cells[:, 2]
+
+    def _distances(self, ptype, idx, point):
+        """Return the distance of particles idx of type ptype from point."""
+        offset = self.snapshot.pos[ptype][idx] - point
+        if self.periodic:
+            offset -= self.size * np.round(offset / self.size)
+        return np.sqrt((offset ** 2).sum(axis=1))
+
+    def _extent(self):
+        """Return the origin and side of a cube holding all particles."""
+        pos = [self.snapshot.pos[p] for p in self.ptypes
+               if len(self.snapshot.pos[p]) > 0]
+        if not pos:
+            return (np.zeros(3), 1.0)
+        lower = np.min([a.min(axis=0) for a in pos], axis=0).astype('f8')
+        upper = np.max([a.max(axis=0) for a in pos], axis=0).astype('f8')
+        size = float((upper - lower).max())
+        return (lower, size if size > 0 else 1.0)
+
+    def _query_ptypes(self, ptypes):
+        """Return the indices of ptypes, or all indexed types if None."""
+        if ptypes is None:
+            return self.ptypes
+        aliases = self.snapshot.ptype_aliases
+        indices = []
+        for p in ptypes:
+            if aliases and p in aliases:
+                p = aliases[p]
+            if p not in self.ptypes:
+                raise ValueError("Particle type %d is not indexed" % p)
+            indices.append(p)
+        return indices
+
+    def _save_cache(self):
+        arrays = {'ncells': np.array(self.ncells),
+                  'origin': np.asarray(self.origin, dtype='f8'),
+                  'size': np.array(self.size)}
+        for p in self.ptypes:
+            arrays['npart%d' % p] = np.array(len(self.snapshot.pos[p]))
+            arrays['order%d' % p] = self._order[p]
+            arrays['starts%d' % p] = self._starts[p]
+        sidecar.save_arrays(self.snapshot.fname, 'grid', arrays,
+                            self.snapshot._sidecar_key())
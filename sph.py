@@ -0,0 +1,273 @@
+"""
+Smoothing of SPH particle data onto maps and grids.
+
+Each particle is spread over the cells within its smoothing length, hsml,
+with the cubic spline kernel of Gadget-2 (Springel 2005),
+
+    W(q) = 1 - 6 q^2 + 6 q^3,  0 <= q < 1/2
+           2 (1 - q)^3,        1/2 <= q < 1
+           0,                  q >= 1
+
+where q = r / hsml, sampled at cell centres. For a projected map, the kernel
+is first integrated along the line of sight. Each particle's samples are
+normalized to sum to one, so that its weight is conserved however small its
+smoothing length is relative to a cell; a particle whose kernel reaches no
+cell centre is assigned to the cell containing it.
+
+Particles are grouped by the number of cells their kernels span, and each
+group is smoothed in chunks of particles. The chunks are divided between a
+pool of threads, each of which smooths its own chunks onto a private copy
+of the output, and the copies are summed once all threads are done.
+"""
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from .snapshot import SnapshotIOException
+
+# The maximum number of particle-cell pairs smoothed at once.
+_CHUNK_CELLS = 1 << 21
+# The number of impact parameters at which the projected kernel is tabulated.
+_TABLE_SIZE = 257
+
+def project(snapshot, npix, axis=2, ptype=0, weights='mass', quantity=None,
+            origin=None, size=None, nthreads=None):
+    """
+    Return an (npix, npix) map of the particles of type ptype, projected.
+
+    Particles are projected along axis (0, 1 or 2, for x, y or z) onto the
+    plane of the other two axes, in order, such that map[i, j] is the
+    pixel at position i along the first. The map spans the square of side
+    length size whose lower corner is origin, in the plane; by default, the
+    periodic box [0, header.BoxSize), in which case kernels are wrapped
+    periodically. Otherwise, kernels are truncated at the map's edges.
+
+    If quantity is None, each pixel holds the total weight projected onto it
+    divided by its area, e.g. the mass column density. weights is the name of
+    the block holding each particle's weight, or None for unit weights.
+    Otherwise, quantity is the name of a block, and each pixel holds the
+    weighted mean of quantity along its line of sight, or zero where no
+    particles project. The type may be given as an alias.
+
+    The map is computed by a pool of nthreads threads (by default, one per
+    CPU), each of which smooths its own share of the particles onto its own
+    copy of the map.
+
+    raise a SnapshotIOException if the type has no positions or smoothing
+    lengths, and a ValueError if no size is given and header.BoxSize is not
+    positive.
+    """
+    if axis not in (0, 1, 2):
+        raise ValueError('Invalid projection axis: ' + str(axis))
+    plane = [d for d in range(3) if d != axis]
+    box = float(snapshot.header.BoxSize)
+    periodic = origin is None and size is None
+    if size is None:
+        if box <= 0:
+            raise ValueError('A size is required if header.BoxSize is not '
+                             'positive')
+        size = box
+    if origin is None:
+        origin = np.zeros(2)
+
+    pos, hsml, w, values = _particles(snapshot, ptype, weights, quantity)
+    cell = size / float(npix)
+    coords = (pos[:, plane] - origin) / cell
+    maps = _smooth(coords, hsml / cell, w, values, npix, periodic,
+                   _projected_kernel, nthreads)
+    return _result(maps, quantity, cell ** 2)
+
+def smooth(snapshot, ngrid, ptype=0, weights='mass', quantity=None,
+           nthreads=None):
+    """
+    Return an (ngrid, ngrid, ngrid) grid of the particles of type ptype.
+
+    The grid is indexed as grid[x, y, z], and spans the periodic box
+    [0, header.BoxSize). If quantity is None, each cell holds the total
+    weight smoothed onto it divided by its volume, e.g. the mass density.
+    Otherwise, each cell holds the weighted mean of quantity. weights,
+    quantity, ptype and nthreads are as for project(); each thread holds
+    its own copy of the grid.
+
+    raise a SnapshotIOException if the type has no positions or smoothing
+    lengths, and a ValueError if header.BoxSize is not positive.
+    """
+    box = float(snapshot.header.BoxSize)
+    if box <= 0:
+        raise ValueError('Smoothing requires a positive header.BoxSize')
+
+    pos, hsml, w, values = _particles(snapshot, ptype, weights, quantity)
+    cell = box / float(ngrid)
+    maps = _smooth(pos / cell, hsml / cell, w, values, ngrid, True,
+                   _cubic_spline, nthreads)
+    return _result(maps, quantity, cell ** 3)
+
+def _cubic_spline(q):
+    """Return the (unnormalized) cubic spline kernel at q = r / hsml."""
+    q = np.asarray(q, dtype='f8')
+    w = np.where(q < 0.5, 1 - 6 * q ** 2 + 6 * q ** 3, 2 * (1 - q) ** 3)
+    return np.where(q < 1, w, 0.)
+
+def _footprints(coords, h, w, values, n, periodic, kernel):
+    """
+    Return the cells and weights of the kernels of a chunk of particles.
+
+    coords and h are in units of the cell size, and all particles span the
+    same number of cells. A tuple (cells, weights, weighted values) of flat
+    arrays is returned, where weighted values is None if values is None.
+    """
+    npart, ndim = coords.shape
+    r = _span(h.max(), n, periodic)
+    offsets = np.arange(-r, r + 1)
+    k = len(offsets)
+
+    base = np.floor(coords).astype('i8')
+    dist2 = np.zeros((npart, ) + (k, ) * ndim)
+    cells = np.zeros((npart, ) + (k, ) * ndim, dtype='i8')
+    inside = np.ones((npart, ) + (k, ) * ndim, dtype=bool)
+    for d in range(ndim):
+        shape = [npart] + [1] * ndim
+        shape[d + 1] = k
+        c = base[:, d, np.newaxis] + offsets
+        delta = c + 0.5 - coords[:, d, np.newaxis]
+        dist2 += (delta ** 2).reshape(shape)
+        if periodic:
+            c %= n
+        else:
+            inside &= ((c >= 0) & (c < n)).reshape(shape)
+            np.clip(c, 0, n - 1, out=c)
+        cells = cells * n + c.reshape(shape)
+
+    q = np.sqrt(dist2) / h.reshape([npart] + [1] * ndim)
+    kern = kernel(q).reshape(npart, -1)
+    norm = kern.sum(axis=1)
+    # Particles whose kernels reach no cell centre; the centre offset is that
+    # of the cell containing the particle.
+    empty = norm == 0
+    kern[empty, kern.shape[1] // 2] = 1
+    norm[empty] = 1
+    kern *= (w / norm)[:, np.newaxis]
+
+    inside = inside.reshape(npart, -1)
+    cells = cells.reshape(npart, -1)[inside]
+    weighted = None
+    if values is not None:
+        weighted = (kern * values[:, np.newaxis])[inside]
+    return (cells, kern[inside], weighted)
+
+def _particles(snapshot, ptype, weights, quantity):
+    """Return the positions, hsml, weights and quantity of type ptype."""
+    aliases = snapshot.ptype_aliases
+    if aliases and ptype in aliases:
+        ptype = aliases[ptype]
+    for name in ('pos', 'hsml'):
+        if (name not in snapshot.fields or
+                getattr(snapshot, name)[ptype] is None):
+            message = "No '%s' data for particle type %d" % (name, ptype)
+            raise SnapshotIOException(message)
+
+    pos = np.asarray(snapshot.pos[ptype], dtype='f8')
+    hsml = np.asarray(snapshot.hsml[ptype], dtype='f8')
+    w = np.ones(len(pos))
+    if weights is not None:
+        w = np.asarray(getattr(snapshot, weights)[ptype], dtype='f8')
+    values = None
+    if quantity is not None:
+        values = np.asarray(getattr(snapshot, quantity)[ptype], dtype='f8')
+    return (pos, hsml, w, values)
+
+def _projected_kernel(q):
+    """Return the cubic spline kernel integrated along a line of sight."""
+    return np.interp(q, _projected_q, _projected_table, right=0.)
+
+def _projected_kernel_table(size):
+    """Return impact parameters q in [0, 1], and the projected kernel at q."""
+    q = np.linspace(0, 1, size)
+    z = np.linspace(0, 1, 4 * size)
+    kern = _cubic_spline(np.sqrt(q[:, np.newaxis] ** 2 + z ** 2))
+    # Trapezoidal integration over the line of sight z in [-1, 1].
+    table = (kern[:, 1:] + kern[:, :-1]).sum(axis=1) * (z[1] - z[0])
+    return (q, table)
+
+def _result(maps, quantity, cell_size):
+    """Return the map of weight density, or of mean quantity."""
+    total, weighted = maps
+    if quantity is None:
+        return total / cell_size
+    mean = np.zeros_like(weighted)
+    np.divide(weighted, total, out=mean, where=total > 0)
+    return mean
+
+def _smooth(coords, h, w, values, n, periodic, kernel, nthreads):
+    """
+    Return the total weight and weighted values smoothed onto each cell.
+
+    coords and h are in units of the cell size, the grid has n cells along
+    each of the coords' axes, and weighted values is None if values is None.
+    """
+    ndim = coords.shape[1]
+    shape = (n, ) * ndim
+    if not periodic:
+        # Only particles whose kernels may overlap the grid.
+        near = np.all((coords + h[:, np.newaxis] >= 0) &
+                      (coords - h[:, np.newaxis] < n), axis=1)
+        coords, h, w = coords[near], h[near], w[near]
+        if values is not None:
+            values = values[near]
+
+    # Group particles by the number of cells their kernels span.
+    spans = np.floor(h + 0.5).astype('i8')
+    order = np.argsort(spans, kind='mergesort')
+    spans = spans[order]
+    chunks = []
+    for r in np.unique(spans):
+        begin, end = np.searchsorted(spans, [r, r + 1])
+        step = max(1, _CHUNK_CELLS // (2 * int(r) + 1) ** ndim)
+        chunks.extend(order[b:min(b + step, end)]
+                      for b in range(begin, end, step))
+
+    def run(part):
+        # Chunks are dealt out in turn, so that each thread has a similar
+        # share of each span.
+        total = np.zeros(n ** ndim)
+        weighted = None if values is None else np.zeros(n ** ndim)
+        for rows in chunks[part::nthreads]:
+            v = None if values is None else values[rows]
+            cells, kern, kv = _footprints(coords[rows], h[rows], w[rows], v,
+                                          n, periodic, kernel)
+            np.add.at(total, cells, kern)
+            if weighted is not None:
+                np.add.at(weighted, cells, kv)
+        return (total, weighted)
+
+    nthreads = max(1, min(nthreads or cpu_count(), len(chunks)))
+    pool = ThreadPool(nthreads)
+    try:
+        parts = pool.map(run, range(nthreads))
+    finally:
+        pool.close()
+        pool.join()
+
+    total, weighted = parts[0]
+    for (t, wv) in parts[1:]:
+        total += t
+        if weighted is not None:
+            weighted += wv
+    if weighted is not None:
+        weighted = weighted.reshape(shape)
+    return (total.reshape(shape), weighted)
+
+def _span(h, n, periodic):
+    """
+    Return the number of cells a kernel may reach either side of its own.
+
+    h is the smoothing length in units of the cell size. Periodic kernels are
+    truncated so as not to wrap onto themselves.
+    """
+    r = int(np.floor(h + 0.5))
+    if periodic:
+        r = min(r, (n - 1) // 2)
+    return r
+
+_projected_q, _projected_table = _projected_kernel_table(_TABLE_SIZE)
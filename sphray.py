@@ -51,6 +51,15 @@ _sphray_blocks_schema = OrderedDict([
 ])
 
 
+# See gadget.py
+# Additional to gadget._g_block_labels. Only needed where the default labels
+# would not be unique.
+_sphray_block_labels = {
+    'xHeI': 'XHE1',
+    'xHeII': 'XHE2',
+}
+
+
 class SPHRAYSnapshot(GadgetSnapshot):
     """
     A class for SPHRAY snapshots.
@@ -65,9 +74,11 @@ class SPHRAYSnapshot(GadgetSnapshot):
     """
 
     def __init__(self, fname, header_schema=_sphray_header_schema,
-                 blocks_schema=_sphray_blocks_schema, **kwargs):
+                 blocks_schema=_sphray_blocks_schema,
+                 block_labels=_sphray_block_labels, **kwargs):
         """Initializes an SPHRAY snapshot."""
         super(SPHRAYSnapshot, self).__init__(fname,
                                              header_schema=header_schema,
                                              blocks_schema=blocks_schema,
+                                             block_labels=block_labels,
                                              **kwargs)
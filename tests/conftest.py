@@ -0,0 +1,97 @@
+import importlib.util
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# The repository root is itself the glio package.
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if 'glio' not in sys.modules:
+    _spec = importlib.util.spec_from_file_location(
+        'glio', os.path.join(_root, '__init__.py'),
+        submodule_search_locations=[_root])
+    _glio = importlib.util.module_from_spec(_spec)
+    sys.modules['glio'] = _glio
+    _spec.loader.exec_module(_glio)
+
+import glio
+from glio.fortranio import FortranFile
+
+BOX_SIZE = 100.0
+NPART = (50, 80, 0, 0, 20, 0)
+# The byte order character of non-native data.
+SWAPPED = '<' if sys.byteorder == 'big' else '>'
+HEADER_MASS = (0, 2.5, 0, 0, 0, 0)
+
+
+def fill(snapshot, npart=NPART, header_mass=HEADER_MASS, seed=0):
+    """Fill snapshot with random data for npart particles of each type."""
+    rng = np.random.RandomState(seed)
+    snapshot.header.num_files = np.int32(1)
+    snapshot.header.BoxSize = np.float64(BOX_SIZE)
+    snapshot.header.mass = np.array(header_mass, dtype='f8')
+    next_id = 1
+    for (name, fmt) in snapshot._schema.items():
+        dtype, ndims, ptypes, _ = fmt
+        pdata = []
+        for p in snapshot.ptype_indices:
+            if p not in ptypes:
+                pdata.append(None)
+                continue
+            n = npart[p]
+            if name == 'mass' and header_mass[p] != 0:
+                a = snapshot._header_mass_array(header_mass[p], n)
+            elif name == 'ID':
+                a = np.arange(next_id, next_id + n).astype(dtype)
+                rng.shuffle(a)
+                next_id += n
+            elif name == 'pos':
+                a = (rng.rand(n, ndims) * BOX_SIZE).astype(dtype)
+            else:
+                a = rng.rand(n * ndims).astype(dtype)
+                if ndims > 1:
+                    a.shape = (n, ndims)
+            pdata.append(a)
+        setattr(snapshot, name, pdata)
+    return snapshot
+
+
+def assert_blocks_equal(a, b, fields=None):
+    """Assert that the data of every block in fields are equal in a and b."""
+    for name in fields or a.fields:
+        for (x, y) in zip(getattr(a, name), getattr(b, name)):
+            if x is None:
+                assert y is None
+            else:
+                np.testing.assert_array_equal(x, y)
+
+
+def save_as(snapshot, fname, control_bytes='4', byteorder='='):
+    """Save snapshot to fname with the given control words and byte order."""
+    snapshot.update_header()
+    with FortranFile(fname, 'wb', control_bytes=control_bytes,
+                     byteorder=byteorder) as ffile:
+        snapshot._save_header(ffile)
+        snapshot._save(ffile)
+
+
+def load(fname, **kwargs):
+    """Return the Gadget snapshot fname, loaded with kwargs."""
+    s = glio.GadgetSnapshot(fname)
+    s.load(**kwargs)
+    return s
+
+
+@pytest.fixture(params=[1, 2], ids=['format1', 'format2'])
+def snap_format(request):
+    return request.param
+
+
+@pytest.fixture
+def snapshot_file(tmp_path, snap_format):
+    """Return the name of a saved Gadget snapshot, and its data."""
+    fname = str(tmp_path / 'snap')
+    s = fill(glio.GadgetSnapshot(fname, snap_format=snap_format))
+    s.save()
+    return (fname, s)
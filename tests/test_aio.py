@@ -0,0 +1,112 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+import glio
+from glio import aio
+
+from conftest import assert_blocks_equal, fill
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def snapshot_files(tmp_path, snap_format):
+    """Return the names of three saved snapshots, and their data."""
+    snapshots = []
+    for i in range(3):
+        fname = str(tmp_path / ('snap_%d' % i))
+        s = fill(glio.GadgetSnapshot(fname, snap_format=snap_format), seed=i)
+        s.save()
+        snapshots.append(s)
+    return ([s.fname for s in snapshots], snapshots)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'memmap': True},
+                                    {'toc_cache': True}],
+                         ids=['read', 'memmap', 'toc_cache'])
+def test_aload(snapshot_files, kwargs):
+    fnames, originals = snapshot_files
+    snapshots = [glio.GadgetSnapshot(fname) for fname in fnames]
+
+    async def load_all():
+        return await asyncio.gather(*[s.aload(**kwargs) for s in snapshots])
+
+    loaded = run(load_all())
+    assert loaded == snapshots
+    for (s, original) in zip(snapshots, originals):
+        np.testing.assert_array_equal(s.header.npart, original.header.npart)
+        assert_blocks_equal(s, original)
+
+
+def test_aload_selective(snapshot_files):
+    fnames, originals = snapshot_files
+    s = glio.GadgetSnapshot(fnames[0])
+    run(s.aload(fields=['pos', 'ID'], ptypes=[4]))
+    np.testing.assert_array_equal(s.pos[4], originals[0].pos[4])
+    np.testing.assert_array_equal(s.ID[4], originals[0].ID[4])
+    assert len(s.pos[0]) == 0
+    assert len(s.vel[4]) == 0
+
+
+def test_async_fortran_file(snapshot_files):
+    fnames, _ = snapshot_files
+
+    async def read():
+        async with aio.AsyncFortranFile(fnames[0]) as ffile:
+            first = await ffile.skip_record()
+            position = await ffile.tell()
+            await ffile.seek(0)
+            return (first, position, await ffile.read_record('b1'))
+
+    first, position, data = run(read())
+    assert len(data) == first
+    assert position > first
+
+
+def test_aload_cancelled(snapshot_files, monkeypatch):
+    fnames, _ = snapshot_files
+    files = []
+    started = threading.Event()
+    release = threading.Event()
+
+    aenter = aio.AsyncFortranFile.__aenter__
+
+    async def recording_aenter(self):
+        files.append(self)
+        return await aenter(self)
+    monkeypatch.setattr(aio.AsyncFortranFile, '__aenter__', recording_aenter)
+
+    read_block = aio._read_block
+
+    def blocking_read_block(*args):
+        started.set()
+        release.wait(10)
+        return read_block(*args)
+    monkeypatch.setattr(aio, '_read_block', blocking_read_block)
+
+    s = glio.GadgetSnapshot(fnames[0])
+    before = dict(s.iterfields())
+
+    async def load_and_cancel():
+        task = asyncio.ensure_future(s.aload())
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, started.wait, 10)
+        task.cancel()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    run(load_and_cancel())
+    assert len(files) == 1
+    assert files[0]._ffile._file is None
+    for (name, pdata) in s.iterfields():
+        assert pdata is before[name]
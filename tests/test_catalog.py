@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import glio
+from glio.fortranio import FortranFile
+from glio.snapshot import SnapshotIOException
+
+from conftest import SWAPPED, fill, save_as
+
+
+@pytest.fixture
+def snapshot_files(tmp_path):
+    """Return the names of snapshots of each format and byte order."""
+    fnames = []
+    for (i, (snap_format, byteorder)) in enumerate([(1, '='), (2, '='),
+                                                    (1, SWAPPED),
+                                                    (2, SWAPPED)]):
+        fname = str(tmp_path / ('snap_%d' % i))
+        s = fill(glio.GadgetSnapshot(fname, snap_format=snap_format),
+                 npart=(10 * (i + 1), 5, 0, 0, 0, 0))
+        s.header.redshift = np.float64(i + 0.5)
+        save_as(s, fname, byteorder=byteorder)
+        fnames.append(fname)
+    return fnames
+
+
+def test_load_headers(snapshot_files):
+    headers = glio.load_headers(snapshot_files, nthreads=2)
+    assert headers.shape == (4, )
+    np.testing.assert_array_equal(headers['redshift'], [0.5, 1.5, 2.5, 3.5])
+    np.testing.assert_array_equal(headers['npart'][:, 0], [10, 20, 30, 40])
+    np.testing.assert_array_equal(headers['mass'][:, 1], 2.5)
+    assert headers['npart'].dtype.isnative
+
+
+def test_load_headers_matches_load(snapshot_files):
+    headers = glio.load_headers(snapshot_files)
+    for (fname, header) in zip(snapshot_files, headers):
+        s = glio.GadgetSnapshot(fname)
+        s.load()
+        for (name, value) in s.header.iterfields():
+            np.testing.assert_array_equal(header[name], value)
+
+
+def test_load_headers_invalid(snapshot_files, tmp_path):
+    fname = str(tmp_path / 'other')
+    with FortranFile(fname, 'wb') as ffile:
+        ffile.write_ndarray(np.zeros(10, dtype='i4'))
+    with pytest.raises(SnapshotIOException):
+        glio.load_headers(snapshot_files + [fname])
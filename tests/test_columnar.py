@@ -0,0 +1,238 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import glio
+from glio import columnar
+from glio.snapshot import SnapshotIOException
+
+from conftest import assert_blocks_equal, fill
+
+CODECS = ['zlib', 'none',
+          pytest.param('lzma', marks=pytest.mark.skipif(
+              columnar.lzma is None, reason='lzma is not available'))]
+NPART = (300, 250, 0, 0, 40, 0)
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    return fill(glio.GadgetSnapshot(str(tmp_path / 'snap')), npart=NPART)
+
+
+def index(path):
+    with open(os.path.join(path, 'index.json'), 'r') as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize('codec', CODECS)
+@pytest.mark.parametrize('filters', [None, [], ['shuffle'], ['delta'],
+                                     ['delta', 'shuffle']])
+def test_round_trip(snapshot, tmp_path, codec, filters):
+    path = str(tmp_path / 'container')
+    if filters is not None:
+        # The delta filter is only valid for integer data.
+        filters = dict((name, [f for f in filters
+                               if f != 'delta' or name == 'ID'])
+                       for name in snapshot.fields)
+    columnar.save_columnar(snapshot, path, chunk_size=64, codec=codec,
+                           filters=filters, nthreads=3)
+
+    reader = glio.ColumnarReader(path, nthreads=2)
+    s = reader.load()
+    assert type(s) is glio.GadgetSnapshot
+    assert_blocks_equal(s, snapshot)
+    for (name, value) in snapshot.header.iterfields():
+        np.testing.assert_array_equal(getattr(s.header, name), value)
+    for (name, block) in index(path)['blocks'].items():
+        for entry in block['ptypes'].values():
+            if 'constant' not in entry:
+                assert entry['codec'] == codec
+                assert entry['quantization'] is None
+
+
+def test_header_mass(snapshot, tmp_path):
+    path = str(tmp_path / 'container')
+    columnar.save_columnar(snapshot, path)
+    assert index(path)['blocks']['mass']['ptypes']['1'] == {
+        'rows': NPART[1], 'constant': 2.5}
+    s = glio.ColumnarReader(path).load()
+    assert s._is_header_mass_array(s.mass[1])
+    np.testing.assert_array_equal(s.mass[1], snapshot.mass[1])
+
+
+@pytest.mark.parametrize('begin, end', [(0, None), (0, 1), (63, 65),
+                                        (64, 128), (100, 300), (300, 300)])
+def test_read(snapshot, tmp_path, begin, end):
+    path = str(tmp_path / 'container')
+    columnar.save_columnar(snapshot, path, chunk_size=64)
+    reader = glio.ColumnarReader(path)
+    for name in ('pos', 'ID', 'u'):
+        np.testing.assert_array_equal(reader.read(name, 0, begin, end),
+                                      getattr(snapshot, name)[0][begin:end])
+
+
+def test_read_invalid(snapshot, tmp_path):
+    path = str(tmp_path / 'container')
+    columnar.save_columnar(snapshot, path)
+    reader = glio.ColumnarReader(path)
+    with pytest.raises(SnapshotIOException):
+        reader.read('pos', 0, 0, NPART[0] + 1)
+    with pytest.raises(SnapshotIOException):
+        reader.read('u', 1)
+    with pytest.raises(SnapshotIOException):
+        reader.read('nonexistent', 0)
+
+
+def test_load_selective(snapshot, tmp_path):
+    path = str(tmp_path / 'container')
+    columnar.save_columnar(snapshot, path, chunk_size=64)
+    reader = glio.ColumnarReader(path)
+    s = reader.load(fname=str(tmp_path / 'new'), fields=['pos', 'ID'],
+                    ptypes=[0, 4])
+    assert s.fname == str(tmp_path / 'new')
+    for name in ('pos', 'ID'):
+        for p in (0, 4):
+            np.testing.assert_array_equal(getattr(s, name)[p],
+                                          getattr(snapshot, name)[p])
+        assert len(getattr(s, name)[1]) == 0
+    assert len(s.vel[0]) == 0
+
+
+def test_load_lazy(snapshot, tmp_path):
+    path = str(tmp_path / 'container')
+    columnar.save_columnar(snapshot, path, chunk_size=64)
+    s = glio.ColumnarReader(path).load(lazy=True)
+    assert 'pos' not in s.__dict__
+    assert_blocks_equal(s, snapshot)
+
+
+def test_load_and_save(snapshot, tmp_path):
+    path = str(tmp_path / 'container')
+    columnar.save_columnar(snapshot, path)
+    fname = str(tmp_path / 'new')
+    glio.ColumnarReader(path).load(fname=fname).save()
+    s = glio.GadgetSnapshot(fname)
+    s.load()
+    assert_blocks_equal(s, snapshot)
+
+
+def test_invalid(snapshot, tmp_path):
+    path = str(tmp_path / 'container')
+    with pytest.raises(ValueError):
+        columnar.save_columnar(snapshot, path, codec='gzip')
+    with pytest.raises(ValueError):
+        columnar.save_columnar(snapshot, path, filters={'ID': ['rle']})
+    with pytest.raises(ValueError):
+        columnar.save_columnar(snapshot, path, filters={'pos': ['delta']})
+
+
+def typed_snapshot(tmp_path, dtype):
+    """Return a snapshot whose pos, vel and u blocks are of type dtype."""
+    schema = glio.gadget._g_blocks_schema.copy()
+    schema['pos'] = (dtype, 3, list(range(6)), True)
+    schema['vel'] = (dtype, 3, list(range(6)), True)
+    schema['u'] = (dtype, 1, [0], True)
+    s = glio.GadgetSnapshot(str(tmp_path / 'snap'), blocks_schema=schema)
+    return fill(s, npart=NPART)
+
+
+@pytest.mark.parametrize('error', [1e-2, 1e-4, 1e-7])
+@pytest.mark.parametrize('dtype', ['f4', 'f8'])
+def test_box_precision(tmp_path, error, dtype):
+    snapshot = typed_snapshot(tmp_path, dtype)
+    path = str(tmp_path / 'container')
+    # Positions at and just within the box's edges, which wrap around.
+    snapshot.pos[0][:4] = [[0, 0, 0], [1e-9, 50, 99.99999],
+                           [99.9999, 0.5, 25], [np.nextafter(100, 0), 1, 2]]
+    columnar.save_columnar(snapshot, path, chunk_size=64,
+                           precisions={'pos': ('box', error)})
+    quantization = index(path)['blocks']['pos']['ptypes']['0']['quantization']
+    assert quantization['kind'] == 'box'
+    assert quantization['step'] == 2 * error * 100.0
+
+    s = glio.ColumnarReader(path).load(blocks_schema=snapshot._schema)
+    for p in (0, 1, 4):
+        assert s.pos[p].dtype == np.dtype(dtype)
+        offset = np.asarray(s.pos[p], 'f8') - np.asarray(snapshot.pos[p], 'f8')
+        offset -= 100.0 * np.round(offset / 100.0)
+        # Up to the rounding of the dequantized value to dtype.
+        bound = error * 100.0 + 100.0 * np.finfo(dtype).eps
+        assert np.abs(offset).max() <= bound
+        assert np.all((s.pos[p] >= 0) & (s.pos[p] < 100.0))
+    # Blocks without a precision are exact.
+    assert_blocks_equal(s, snapshot, fields=['vel', 'ID', 'u'])
+
+
+@pytest.mark.parametrize('error', [0.1, 1e-3, 1e-6, 1e-12])
+@pytest.mark.parametrize('dtype', ['f4', 'f8'])
+def test_relative_precision(tmp_path, error, dtype):
+    snapshot = typed_snapshot(tmp_path, dtype)
+    path = str(tmp_path / 'container')
+    rng = np.random.RandomState(1)
+    n = NPART[0]
+    # Values of both signs over many orders of magnitude.
+    u = rng.standard_normal(n) * 10.0 ** rng.uniform(-20, 20, n)
+    u[:3] = [0, 1, -1]
+    snapshot.u[0] = u.astype(dtype)
+    columnar.save_columnar(snapshot, path, chunk_size=64,
+                           precisions={'u': ('relative', error),
+                                       'vel': ('relative', error)})
+
+    s = glio.ColumnarReader(path).load(blocks_schema=snapshot._schema)
+    for name in ('u', 'vel'):
+        for p in (0, 1, 4):
+            original = getattr(snapshot, name)[p]
+            if original is None or len(original) == 0:
+                continue
+            stored = getattr(s, name)[p]
+            assert stored.dtype == np.dtype(dtype)
+            original = np.asarray(original, 'f8')
+            diff = np.abs(np.asarray(stored, 'f8') - original)
+            assert np.all(diff <= error * np.abs(original))
+    assert s.u[0][0] == 0
+    assert_blocks_equal(s, snapshot, fields=['pos', 'ID'])
+
+
+def test_precision_compresses(snapshot, tmp_path):
+    exact, lossy = str(tmp_path / 'exact'), str(tmp_path / 'lossy')
+    columnar.save_columnar(snapshot, exact)
+    columnar.save_columnar(snapshot, lossy,
+                           precisions={'pos': ('box', 1e-3),
+                                       'vel': ('relative', 1e-2)})
+    for name in ('pos.0.dat', 'vel.0.dat'):
+        assert (os.path.getsize(os.path.join(lossy, name)) <
+                os.path.getsize(os.path.join(exact, name)))
+
+
+def test_schema_precision(tmp_path):
+    schema = glio.gadget._g_blocks_schema.copy()
+    schema['pos'] = ('f4', 3, list(range(6)), True, ('box', 1e-3))
+    s = fill(glio.GadgetSnapshot(str(tmp_path / 'snap'),
+                                 blocks_schema=schema), npart=NPART)
+    path = str(tmp_path / 'container')
+    columnar.save_columnar(s, path)
+    assert index(path)['blocks']['pos']['ptypes']['0']['quantization']
+    # A precision of None overrides the schema's.
+    columnar.save_columnar(s, path, precisions={'pos': None})
+    assert_blocks_equal(glio.ColumnarReader(path).load(), s, fields=['pos'])
+
+
+@pytest.mark.parametrize('precisions', [
+    {'pos': ('box', 0)},
+    {'pos': ('box', 1)},
+    {'pos': ('absolute', 1e-3)},
+    {'ID': ('relative', 1e-3)},
+])
+def test_invalid_precision(snapshot, tmp_path, precisions):
+    with pytest.raises(ValueError):
+        columnar.save_columnar(snapshot, str(tmp_path / 'container'),
+                               precisions=precisions)
+
+
+def test_box_precision_requires_box(snapshot, tmp_path):
+    snapshot.header.BoxSize = np.float64(0)
+    with pytest.raises(ValueError):
+        columnar.save_columnar(snapshot, str(tmp_path / 'container'),
+                               precisions={'pos': ('box', 1e-3)})
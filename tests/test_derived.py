@@ -0,0 +1,244 @@
+import collections
+import gc
+import weakref
+
+import numpy as np
+import pytest
+
+import glio
+
+from conftest import fill
+
+calls = collections.Counter()
+
+
+def speed(s, ptype):
+    calls['speed', ptype] += 1
+    return np.sqrt((s.vel[ptype] ** 2).sum(axis=1))
+
+
+def kinetic_energy(s, ptype):
+    calls['kinetic_energy', ptype] += 1
+    return 0.5 * s.mass[ptype] * s.speed[ptype] ** 2
+
+
+def scaled_energy(s, ptype):
+    calls['scaled_energy', ptype] += 1
+    return s.kinetic_energy[ptype] * s.scale
+
+
+def gas_speed(s, ptype):
+    calls['gas_speed', ptype] += 1
+    return s.speed[ptype]
+
+
+class DerivedSnapshot(glio.GadgetSnapshot):
+    pass
+
+DerivedSnapshot.register_derived('speed', speed, ['vel'])
+# Chained: kinetic_energy depends on speed, and scaled_energy on both it and
+# a plain attribute.
+DerivedSnapshot.register_derived('kinetic_energy', kinetic_energy,
+                                 ['mass', 'speed'])
+DerivedSnapshot.register_derived('scaled_energy', scaled_energy,
+                                 ['kinetic_energy', 'scale'])
+DerivedSnapshot.register_derived('gas_speed', gas_speed, ['speed'],
+                                 ptypes=[0])
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    calls.clear()
+    s = fill(DerivedSnapshot(str(tmp_path / 'snap')))
+    s.scale = 2.0
+    return s
+
+
+def expected_speed(s, ptype):
+    return np.sqrt((s.vel[ptype] ** 2).sum(axis=1))
+
+
+def test_values(snapshot):
+    s = snapshot
+    assert 'speed' in s.derived_fields
+    assert 'temperature' in s.derived_fields
+    for p in (0, 1, 4):
+        speed = expected_speed(s, p)
+        np.testing.assert_allclose(s.speed[p], speed)
+        np.testing.assert_allclose(s.kinetic_energy[p],
+                                   0.5 * s.mass[p] * speed ** 2)
+        np.testing.assert_allclose(s.scaled_energy[p],
+                                   s.mass[p] * speed ** 2)
+    assert s.gas.speed is s.speed[0]
+    assert len(list(s.speed)) == 6
+    np.testing.assert_allclose(s.temperature[0] / s.u[0],
+                               s.temperature[0][0] / s.u[0][0])
+
+
+def test_invalid_ptypes(snapshot):
+    s = snapshot
+    np.testing.assert_array_equal(s.gas_speed[0], s.speed[0])
+    assert s.gas_speed[1] is None
+    # u, and so temperature, is only valid for gas.
+    assert s.temperature[1] is None
+
+
+def test_cached(snapshot):
+    s = snapshot
+    first = s.scaled_energy[0]
+    assert s.scaled_energy[0] is first
+    assert s.kinetic_energy[0] is s.kinetic_energy[0]
+    assert calls['speed', 0] == 1
+    assert calls['kinetic_energy', 0] == 1
+    assert calls['scaled_energy', 0] == 1
+
+
+def test_reassign_block(snapshot):
+    s = snapshot
+    for p in (0, 1):
+        s.scaled_energy[p]
+    s.vel = [None if v is None else 2 * v for v in s.vel]
+    # Discarded at once, with everything depending on vel.
+    assert not s._derived_cache
+    for p in (0, 1):
+        np.testing.assert_allclose(s.speed[p], expected_speed(s, p))
+        np.testing.assert_allclose(s.scaled_energy[p],
+                                   s.mass[p] * expected_speed(s, p) ** 2)
+        assert calls['speed', p] == 2
+        assert calls['scaled_energy', p] == 2
+
+
+def test_reassign_ptype_array(snapshot):
+    s = snapshot
+    for p in (0, 1):
+        s.scaled_energy[p]
+    s.vel[0] = s.vel[0] * 3
+    np.testing.assert_allclose(s.scaled_energy[0],
+                               s.mass[0] * expected_speed(s, 0) ** 2)
+    s.scaled_energy[1]
+    assert calls['speed', 0] == 2
+    assert calls['scaled_energy', 0] == 2
+    assert calls['speed', 1] == 1
+    assert calls['scaled_energy', 1] == 1
+
+
+def test_reassign_attribute(snapshot):
+    s = snapshot
+    before = s.scaled_energy[0].copy()
+    s.kinetic_energy[0]
+    s.scale = 4.0
+    np.testing.assert_allclose(s.scaled_energy[0], 2 * before)
+    assert calls['scaled_energy', 0] == 2
+    # Fields not depending on scale are kept.
+    assert calls['kinetic_energy', 0] == 1
+    s.kinetic_energy[0]
+    assert calls['kinetic_energy', 0] == 1
+
+
+def test_reassign_centre(snapshot):
+    s = snapshot
+    centre = np.full(3, 50.)
+    np.testing.assert_allclose(s.radius[0],
+                               np.sqrt(((s.pos[0] - centre) ** 2).sum(axis=1)),
+                               rtol=1e-5)
+    s.centre = np.zeros(3)
+    offset = s.pos[0] - 100. * np.round(s.pos[0] / 100.)
+    np.testing.assert_allclose(s.radius[0],
+                               np.sqrt((offset ** 2).sum(axis=1)), rtol=1e-5)
+
+
+def test_reload(snapshot, tmp_path):
+    s = snapshot
+    s.save()
+    loaded = DerivedSnapshot(s.fname)
+    loaded.load()
+    old = loaded.speed[0]
+    loaded.load()
+    assert loaded.speed[0] is not old
+    np.testing.assert_array_equal(loaded.speed[0], old)
+
+
+def test_in_place_modification(snapshot):
+    s = snapshot
+    old = s.speed[0].copy()
+    s.vel[0] *= 2
+    # Not detected, until the cache is cleared.
+    np.testing.assert_array_equal(s.speed[0], old)
+    s.clear_derived()
+    np.testing.assert_allclose(s.speed[0], 2 * old, rtol=1e-6)
+
+
+def test_no_dependency_references(snapshot):
+    s = snapshot
+    vel = s.vel[0]
+    s.speed[0]
+    ref = weakref.ref(vel)
+    s.vel[0] = vel.copy()
+    del vel
+    gc.collect()
+    assert ref() is None
+
+
+def cache_total(s):
+    return sum(d.nbytes for (d, _) in s._derived_cache.values())
+
+
+def test_cache_bytes(snapshot):
+    s = snapshot
+    # Room for the speeds of 100 particles; types 0, 1 and 4 have 50, 80 and
+    # 20 particles.
+    s.derived_cache_bytes = 100 * s.speed[0].itemsize
+    s.clear_derived()
+    calls.clear()
+    s.speed[0]
+    s.speed[4]
+    assert list(s._derived_cache) == [('speed', 0), ('speed', 4)]
+
+    # Type 0, the least recently used, is evicted to make room for type 1.
+    s.speed[1]
+    assert list(s._derived_cache) == [('speed', 4), ('speed', 1)]
+    assert cache_total(s) <= s.derived_cache_bytes
+
+    # Type 4's data are reused, and so become the most recently used, and
+    # type 1's are evicted instead.
+    s.speed[4]
+    s.speed[0]
+    assert list(s._derived_cache) == [('speed', 4), ('speed', 0)]
+    assert calls['speed', 0] == 2
+    assert calls['speed', 4] == 1
+    assert cache_total(s) <= s.derived_cache_bytes
+
+
+def test_cache_bytes_chained(snapshot):
+    s = snapshot
+    s.derived_cache_bytes = 60 * s.speed[0].itemsize
+    s.clear_derived()
+    calls.clear()
+    # Both speed and kinetic_energy of type 0 do not fit, so that speed is
+    # evicted, and recomputed for the next kinetic_energy.
+    s.kinetic_energy[0]
+    assert list(s._derived_cache) == [('kinetic_energy', 0)]
+    s.vel[0] = s.vel[0] * 2
+    s.kinetic_energy[0]
+    assert calls['speed', 0] == 2
+    assert calls['kinetic_energy', 0] == 2
+    assert cache_total(s) <= s.derived_cache_bytes
+
+
+def test_cache_too_small(snapshot):
+    s = snapshot
+    s.derived_cache_bytes = 0
+    first = s.speed[0]
+    np.testing.assert_array_equal(s.speed[0], first)
+    assert calls['speed', 0] == 2
+    assert not s._derived_cache
+
+
+def test_block_replaces_derived(tmp_path):
+    class BlockSnapshot(DerivedSnapshot):
+        pass
+    BlockSnapshot.register_derived('u', speed, ['vel'])
+    s = fill(BlockSnapshot(str(tmp_path / 'snap')))
+    assert 'u' not in s.derived_fields
+    assert s.u[0].shape == (50, )
+    assert 'speed' in s.derived_fields
@@ -0,0 +1,216 @@
+import functools
+
+import numpy as np
+import pytest
+
+import glio
+from glio.fortranio import (FortranFile, FortranIOException,
+                            ParallelFortranWriter, PrefetchingFortranFile)
+
+from conftest import SWAPPED, assert_blocks_equal, fill, load, save_as
+
+FORMATS = [('4', '='), ('4', SWAPPED), ('8', '='), ('8', SWAPPED)]
+
+
+@pytest.mark.parametrize('control_bytes, byteorder', FORMATS)
+@pytest.mark.parametrize('memmap', [False, True])
+def test_detect_format(tmp_path, control_bytes, byteorder, memmap):
+    fname = str(tmp_path / 'records')
+    records = [np.arange(10, dtype='i4'), np.linspace(0, 1, 7)]
+    with FortranFile(fname, 'wb', control_bytes=control_bytes,
+                     byteorder=byteorder) as ffile:
+        for record in records:
+            ffile.write_ndarray(record)
+
+    with FortranFile(fname, 'rb', memmap=memmap) as ffile:
+        assert ffile.control_bytes == int(control_bytes)
+        assert ffile.byteorder == byteorder
+        np.testing.assert_array_equal(ffile.read_record('i4'), records[0])
+        np.testing.assert_array_equal(ffile.read_record('f8'), records[1])
+
+
+@pytest.mark.parametrize('control_bytes, byteorder', FORMATS)
+@pytest.mark.parametrize('kwargs', [{}, {'memmap': True}, {'lazy': True},
+                                    {'memmap': True, 'lazy': True},
+                                    {'ptypes': [4]}],
+                         ids=['read', 'memmap', 'lazy', 'lazy-memmap',
+                              'ptypes'])
+def test_load_snapshot(tmp_path, snap_format, control_bytes, byteorder,
+                       kwargs):
+    fname = str(tmp_path / 'snap')
+    original = fill(glio.GadgetSnapshot(fname, snap_format=snap_format))
+    save_as(original, fname, control_bytes, byteorder)
+
+    s = load(fname, **kwargs)
+    assert s.snap_format == snap_format
+    np.testing.assert_array_equal(s.header.npart, original.header.npart)
+    assert s.header.mass[1] == 2.5
+    if 'ptypes' in kwargs:
+        np.testing.assert_array_equal(s.pos[4], original.pos[4])
+        np.testing.assert_array_equal(s.ID[4], original.ID[4])
+    else:
+        assert_blocks_equal(s, original)
+
+
+@pytest.mark.parametrize('control_bytes, byteorder', FORMATS)
+def test_resave_native(tmp_path, snap_format, control_bytes, byteorder):
+    fname = str(tmp_path / 'snap')
+    original = fill(glio.GadgetSnapshot(fname, snap_format=snap_format))
+    save_as(original, fname, control_bytes, byteorder)
+
+    copy = str(tmp_path / 'copy')
+    load(fname).save(copy)
+    with FortranFile(copy) as ffile:
+        assert (ffile.control_bytes, ffile.byteorder) == (4, '=')
+    assert_blocks_equal(load(copy), original)
+
+
+def test_invalid_file(tmp_path):
+    fname = str(tmp_path / 'invalid')
+    # Head and tail control elements match for no size or byte order.
+    np.array([8, 0, 0, 9], dtype='i4').tofile(fname)
+    with pytest.raises(FortranIOException):
+        with FortranFile(fname) as ffile:
+            ffile.read_record()
+
+
+def write_records(fname, n):
+    """Write n records of increasing size, and return them."""
+    records = [np.arange(i * 100, dtype='f8') for i in range(1, n + 1)]
+    with FortranFile(fname, 'wb') as ffile:
+        ffile.write_ndarrays(records[:1])
+        for record in records[1:]:
+            ffile.write_ndarray(record)
+    return records
+
+
+def record_offsets(fname, n):
+    with FortranFile(fname) as ffile:
+        offsets = []
+        for _ in range(n):
+            offsets.append(ffile.tell())
+            ffile.skip_record()
+    return offsets
+
+
+@pytest.mark.parametrize('budget', [1, 4096, 1 << 20])
+def test_prefetch(tmp_path, budget):
+    fname = str(tmp_path / 'records')
+    records = write_records(fname, 8)
+    offsets = record_offsets(fname, 8)
+    with PrefetchingFortranFile(fname, budget=budget) as ffile:
+        for record in records[:3]:
+            np.testing.assert_array_equal(ffile.read_record('f8'), record)
+        ffile.skip_record()
+        np.testing.assert_array_equal(ffile.read_record('f8'), records[4])
+        # Backwards, which restarts prefetching.
+        ffile.seek(offsets[1])
+        for record in records[1:]:
+            np.testing.assert_array_equal(ffile.read_record('f8'), record)
+
+
+def spy_prefetch(monkeypatch):
+    """Return the list to which the offset of each prefetch is appended."""
+    prefetched = []
+    read_at = PrefetchingFortranFile._read_at
+
+    def spy(self, f, offset):
+        prefetched.append(offset)
+        return read_at(self, f, offset)
+    monkeypatch.setattr(PrefetchingFortranFile, '_read_at', spy)
+    return prefetched
+
+
+def test_prefetch_offsets(tmp_path, monkeypatch):
+    fname = str(tmp_path / 'records')
+    records = write_records(fname, 8)
+    offsets = record_offsets(fname, 8)
+    prefetched = spy_prefetch(monkeypatch)
+    with PrefetchingFortranFile(fname, offsets=[]) as ffile:
+        np.testing.assert_array_equal(ffile.read_record('f8'), records[0])
+        ffile.set_offsets([offsets[3], offsets[6]])
+        for i in (3, 5, 6):
+            ffile.seek(offsets[i])
+            np.testing.assert_array_equal(ffile.read_record('f8'), records[i])
+    assert sorted(set(prefetched)) == [offsets[3], offsets[6]]
+
+
+@pytest.mark.parametrize('control_bytes', ['4', '8'])
+def test_parallel_save_swapped(tmp_path, monkeypatch, snap_format,
+                               control_bytes):
+    fname = str(tmp_path / 'snap')
+    original = fill(glio.GadgetSnapshot(fname, snap_format=snap_format))
+    save_as(original, fname, control_bytes, SWAPPED)
+
+    # Small pieces, so that every large block would be split as raw bytes.
+    monkeypatch.setattr(glio.snapshot, 'ParallelFortranWriter',
+                        functools.partial(ParallelFortranWriter,
+                                          piece_bytes=256))
+    copy = str(tmp_path / 'copy')
+    load(fname).save(copy, nthreads=2)
+    with FortranFile(copy) as ffile:
+        assert (ffile.control_bytes, ffile.byteorder) == (4, '=')
+    assert_blocks_equal(load(copy), original)
+
+
+def read_back(fname, dtype):
+    with FortranFile(fname) as ffile:
+        return ffile.read_record(dtype)
+
+
+@pytest.mark.parametrize('byteorder', ['=', SWAPPED])
+def test_write_non_contiguous(tmp_path, byteorder):
+    fname = str(tmp_path / 'records')
+    data = np.arange(60, dtype='f8').reshape(6, 10)
+    arrays = [data[::2], data[:, 3], data.T]
+    with FortranFile(fname, 'wb', byteorder=byteorder) as ffile:
+        ffile.write_ndarrays(arrays)
+    expected = np.concatenate([a.ravel() for a in arrays])
+    np.testing.assert_array_equal(read_back(fname, 'f8'), expected)
+
+
+@pytest.mark.parametrize('byteorder', ['=', SWAPPED])
+def test_write_swapped_arrays(tmp_path, byteorder):
+    fname = str(tmp_path / 'records')
+    native = np.arange(10, dtype='i4')
+    swapped = np.arange(10, 20, dtype=SWAPPED + 'i4')
+    with FortranFile(fname, 'wb', byteorder=byteorder) as ffile:
+        ffile.write_ndarrays([native, swapped, native])
+    expected = np.concatenate([native, swapped, native])
+    np.testing.assert_array_equal(read_back(fname, 'i4'), expected)
+
+
+@pytest.mark.parametrize('byteorder', ['=', SWAPPED])
+def test_write_0d_arrays(tmp_path, byteorder):
+    fname = str(tmp_path / 'records')
+    scalars = [np.array(1.5), np.array(-2.0, dtype=SWAPPED + 'f8')]
+    with FortranFile(fname, 'wb', byteorder=byteorder) as ffile:
+        ffile.write_ndarrays(scalars)
+        ffile.write_ndarray(np.array(7, dtype='i4'))
+    with FortranFile(fname) as ffile:
+        np.testing.assert_array_equal(ffile.read_record('f8'), [1.5, -2.0])
+        np.testing.assert_array_equal(ffile.read_record('i4'), [7])
+
+
+def test_write_staging_chunks(tmp_path, monkeypatch):
+    fname = str(tmp_path / 'records')
+    # A staging buffer smaller than the array, and smaller than one row.
+    monkeypatch.setattr(glio.fortranio, '_STAGING_BYTES', 64)
+    data = np.arange(400, dtype='f8').reshape(20, 20)
+    with FortranFile(fname, 'wb') as ffile:
+        ffile.write_ndarrays([data[:, ::2], data.T])
+    expected = np.concatenate([data[:, ::2].ravel(), data.T.ravel()])
+    np.testing.assert_array_equal(read_back(fname, 'f8'), expected)
+
+
+@pytest.mark.parametrize('iov_max', [1, 3, 16])
+def test_write_split_at_iov_max(tmp_path, monkeypatch, iov_max):
+    fname = str(tmp_path / 'records')
+    monkeypatch.setattr(glio.fortranio, '_IOV_MAX', iov_max)
+    arrays = [np.arange(i, i + 5, dtype='i8') for i in range(0, 100, 5)]
+    with FortranFile(fname, 'wb') as ffile:
+        ffile.write_ndarrays(arrays)
+        ffile.write_ndarray(arrays[0])
+    with FortranFile(fname) as ffile:
+        np.testing.assert_array_equal(ffile.read_record('i8'), np.arange(100))
+        np.testing.assert_array_equal(ffile.read_record('i8'), arrays[0])
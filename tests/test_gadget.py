@@ -0,0 +1,365 @@
+import filecmp
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import glio
+from glio import sidecar
+from glio.fortranio import FortranFile, PrefetchingFortranFile
+from glio.snapshot import SnapshotIOException
+
+from conftest import assert_blocks_equal, fill, load
+
+
+def test_round_trip(snapshot_file, snap_format):
+    fname, original = snapshot_file
+    s = load(fname)
+    assert s.snap_format == snap_format
+    assert_blocks_equal(s, original)
+    np.testing.assert_array_equal(s.header.npart, [50, 80, 0, 0, 20, 0])
+
+
+def test_resave_is_identical(snapshot_file, tmp_path):
+    fname, _ = snapshot_file
+    copy = str(tmp_path / 'copy')
+    load(fname).save(copy)
+    assert filecmp.cmp(fname, copy, shallow=False)
+
+
+def test_memmap_load(snapshot_file):
+    fname, original = snapshot_file
+    s = load(fname, memmap=True)
+    assert isinstance(s.pos[0].base, np.memmap)
+    assert_blocks_equal(s, original)
+
+
+def test_memmap_is_copy_on_write(snapshot_file, tmp_path):
+    fname, original = snapshot_file
+    backup = str(tmp_path / 'backup')
+    shutil.copy(fname, backup)
+
+    s = load(fname, memmap=True)
+    s.pos[0][:] = 0
+    assert filecmp.cmp(fname, backup, shallow=False)
+    s.save()
+    np.testing.assert_array_equal(load(fname).pos[0], 0)
+    np.testing.assert_array_equal(load(fname).vel[0], original.vel[0])
+
+
+@pytest.mark.parametrize('memmap, lazy', [(True, False), (False, True),
+                                          (True, True)])
+def test_save_in_place(snapshot_file, tmp_path, memmap, lazy):
+    fname, original = snapshot_file
+    backup = str(tmp_path / 'backup')
+    shutil.copy(fname, backup)
+
+    s = load(fname, memmap=memmap, lazy=lazy)
+    s.save()
+    assert filecmp.cmp(fname, backup, shallow=False)
+    assert_blocks_equal(s, original)
+
+
+def test_lazy_load(snapshot_file):
+    fname, original = snapshot_file
+    s = load(fname, lazy=True)
+    assert 'pos' not in s.__dict__
+    np.testing.assert_array_equal(s.pos[4], original.pos[4])
+    assert 'pos' in s.__dict__
+    assert_blocks_equal(s, original)
+
+
+def test_load_fields(snapshot_file):
+    fname, original = snapshot_file
+    s = load(fname, fields=['vel', 'ID'])
+    assert_blocks_equal(s, original, ['vel', 'ID'])
+    assert len(s.pos[0]) == 0
+
+
+def test_save_after_load_fields_raises(snapshot_file):
+    fname, _ = snapshot_file
+    s = load(fname, fields=['pos'])
+    with pytest.raises(SnapshotIOException):
+        s.save()
+
+
+def test_load_ptypes_and_save(snapshot_file, tmp_path):
+    fname, original = snapshot_file
+    s = load(fname, ptypes=[0])
+    np.testing.assert_array_equal(s.pos[0], original.pos[0])
+    assert len(s.pos[1]) == 0
+
+    copy = str(tmp_path / 'copy')
+    s.save(copy)
+    t = load(copy)
+    np.testing.assert_array_equal(t.header.npart, [50, 0, 0, 0, 0, 0])
+    assert_blocks_equal(t, s)
+
+
+@pytest.mark.parametrize('snap_format', [1, 2])
+@pytest.mark.parametrize('ptype', [0, 1, 'halo', 4])
+def test_iter_chunks(tmp_path, snap_format, ptype):
+    fname = str(tmp_path / 'snap')
+    original = fill(glio.GadgetSnapshot(fname, snap_format=snap_format))
+    original.save()
+    p = original.ptype_aliases.get(ptype, ptype)
+
+    s = glio.GadgetSnapshot(fname)
+    # 7 divides none of the particle counts.
+    chunks = list(s.iter_chunks(['pos', 'mass', 'ID'], ptype, 7))
+    n = original.header.npart[p]
+    assert [len(c.ID) for c in chunks] == [7] * (n // 7) + [n % 7]
+    for name in ('pos', 'mass', 'ID'):
+        data = np.concatenate([getattr(c, name) for c in chunks])
+        np.testing.assert_array_equal(data, getattr(original, name)[p])
+
+
+def test_table_of_contents(snapshot_file, snap_format):
+    fname, original = snapshot_file
+    toc = load(fname).table_of_contents()
+    # In format 2, each record follows a 16-byte label record.
+    label = 16 if snap_format == 2 else 0
+    assert toc[0][:3] == ('header', label, 256)
+    # Records are contiguous, each with 4-byte control words either side.
+    for (entry, following) in zip(toc[:-1], toc[1:]):
+        assert following.offset == entry.offset + entry.nbytes + 8 + label
+    assert toc[-1].offset + toc[-1].nbytes + 8 == os.path.getsize(fname)
+
+    names = [entry.name for entry in toc[1:]]
+    assert names == [name for name in original.fields
+                     if original._save_arrays(name) is not None]
+    for entry in toc[1:]:
+        arrays = original._save_arrays(entry.name)
+        assert entry.nbytes == sum(a.nbytes for a in arrays)
+        assert np.dtype(entry.dtype) == original._schema[entry.name][0]
+
+
+def toc_sidecar(fname):
+    with open(sidecar.sidecar_name(fname, 'toc')) as f:
+        return json.load(f)
+
+
+def tamper_toc_sidecar(fname):
+    """Rename the first block in fname's TOC sidecar, keeping it valid."""
+    content = toc_sidecar(fname)
+    content['data'][1][0] = 'tampered'
+    with open(sidecar.sidecar_name(fname, 'toc'), 'w') as f:
+        json.dump(content, f)
+
+
+def test_table_of_contents_cache(snapshot_file):
+    fname, _ = snapshot_file
+    s = load(fname)
+    toc = s.table_of_contents(cache=True)
+    assert os.path.exists(sidecar.sidecar_name(fname, 'toc'))
+    assert s.table_of_contents(cache=True) == toc
+
+    # A valid sidecar is used without scanning the file.
+    tamper_toc_sidecar(fname)
+    assert s.table_of_contents(cache=True)[1].name == 'tampered'
+    assert s.table_of_contents()[1].name == toc[1].name
+
+
+def test_table_of_contents_cache_mtime(snapshot_file):
+    fname, _ = snapshot_file
+    s = load(fname)
+    toc = s.table_of_contents(cache=True)
+    tamper_toc_sidecar(fname)
+    stat = os.stat(fname)
+    os.utime(fname, (stat.st_atime, stat.st_mtime + 10))
+    assert s.table_of_contents(cache=True) == toc
+    assert toc_sidecar(fname)['data'][1][0] == toc[1].name
+
+
+def test_table_of_contents_cache_size(snapshot_file):
+    fname, original = snapshot_file
+    s = load(fname)
+    s.table_of_contents(cache=True)
+    stat = os.stat(fname)
+
+    smaller = fill(glio.GadgetSnapshot(fname), npart=(10, 0, 0, 0, 0, 0))
+    smaller.save()
+    os.utime(fname, (stat.st_atime, stat.st_mtime))
+    assert os.path.getsize(fname) != stat.st_size
+    toc = s.table_of_contents(cache=True)
+    assert toc == s.table_of_contents()
+    assert toc[1].nbytes == 10 * 12
+
+
+@pytest.mark.parametrize('kwargs', [{'ICfile': True},
+                                    {'block_labels': {'vel': 'VELO'}}],
+                         ids=['schema', 'labels'])
+def test_table_of_contents_cache_key(snapshot_file, kwargs):
+    fname, _ = snapshot_file
+    load(fname).table_of_contents(cache=True)
+    tamper_toc_sidecar(fname)
+
+    # A sidecar written by a snapshot which reads the file differently is
+    # not used.
+    other = glio.GadgetSnapshot(fname, **kwargs)
+    toc = other.table_of_contents(cache=True)
+    assert toc[1].name != 'tampered'
+    assert toc == other.table_of_contents()
+
+
+def test_format2_labels(snapshot_file, snap_format):
+    fname, original = snapshot_file
+    with open(fname, 'rb') as f:
+        data = f.read()
+    for label in (b'HEAD', b'POS ', b'VEL ', b'ID  ', b'MASS'):
+        assert (label in data) == (snap_format == 2)
+
+
+def test_format2_custom_label(tmp_path):
+    fname = str(tmp_path / 'snap')
+    s = fill(glio.GadgetSnapshot(fname, snap_format=2,
+                                 block_labels={'vel': 'VELO'}))
+    s.save()
+
+    t = glio.GadgetSnapshot(fname, block_labels={'vel': 'VELO'})
+    t.load()
+    assert_blocks_equal(t, s)
+
+    # Blocks whose labels are not present in the file are not loaded.
+    u = load(fname)
+    np.testing.assert_array_equal(u.pos[0], s.pos[0])
+    assert len(u.vel[0]) == 0
+
+
+def test_header_mass(tmp_path, snap_format):
+    fname = str(tmp_path / 'snap')
+    fill(glio.GadgetSnapshot(fname, snap_format=snap_format),
+         header_mass=(0, 0.1, 0, 0, 0, 0)).save()
+    s = load(fname)
+    assert s.header.mass[1] == 0.1
+    assert len(s.mass[1]) == 80
+    assert s.mass[1].strides == (0, )
+    assert np.all(s.mass[1] == 0.1)
+
+    s.save()
+    assert load(fname).header.mass[1] == 0.1
+
+
+def test_header_mass_from_block(tmp_path):
+    fname = str(tmp_path / 'snap')
+    s = fill(glio.GadgetSnapshot(fname), header_mass=(0, ) * 6)
+    s.mass[4] = s._header_mass_array(3.0, 20)
+    s.mass[0] = np.full(50, 2.0, dtype='f4')
+    s.save()
+
+    t = load(fname)
+    np.testing.assert_array_equal(t.header.mass, [0, 0, 0, 0, 3.0, 0])
+    np.testing.assert_array_equal(t.mass[0], 2.0)
+    np.testing.assert_array_equal(t.mass[1], s.mass[1])
+    np.testing.assert_array_equal(t.mass[4], 3.0)
+
+
+@pytest.mark.parametrize('nthreads', [None, 4])
+def test_parallel_save_is_identical(snapshot_file, tmp_path, nthreads):
+    fname, _ = snapshot_file
+    copy = str(tmp_path / 'copy')
+    load(fname).save(copy, nthreads=nthreads)
+    assert filecmp.cmp(fname, copy, shallow=False)
+
+
+def test_save_block(snapshot_file):
+    fname, original = snapshot_file
+    s = load(fname, fields=['hsml'])
+    s.hsml[0] *= 2
+    s.save_block('hsml')
+    t = load(fname)
+    np.testing.assert_array_equal(t.hsml[0], original.hsml[0] * 2)
+    assert_blocks_equal(t, original, ['pos', 'vel', 'ID', 'mass', 'u'])
+
+
+def test_save_block_ptypes(snapshot_file):
+    fname, original = snapshot_file
+    s = load(fname)
+    s.pos[0][:] = 1
+    s.pos[4][:] = 2
+    s.save_block('pos', ptypes=['star'])
+    t = load(fname)
+    np.testing.assert_array_equal(t.pos[0], original.pos[0])
+    np.testing.assert_array_equal(t.pos[4], 2)
+
+
+def test_save_block_size_mismatch(snapshot_file):
+    fname, _ = snapshot_file
+    s = load(fname)
+    s.pos[0] = s.pos[0][:10]
+    with pytest.raises(SnapshotIOException):
+        s.save_block('pos')
+
+
+class ComovingSnapshot(glio.GadgetSnapshot):
+    pass
+
+
+ComovingSnapshot.register_derived(
+    'physical_pos', lambda s, p: s.pos[p] / (1 + s.header.redshift),
+    ['pos', 'header'])
+
+
+def test_save_block_keeps_state(snapshot_file):
+    fname, _ = snapshot_file
+    s = ComovingSnapshot(fname)
+    s.load()
+    s.index_ids()
+    s.physical_pos[0]
+    s.header.redshift = 7.0
+    cached = list(s._derived_cache)
+    s.save_block('vel')
+    assert s.header.redshift == 7.0
+    assert cached and list(s._derived_cache) == cached
+    assert s._id_index
+    assert load(fname).header.redshift != 7.0
+
+
+@pytest.mark.parametrize('fields', [None, ['vel'], ['pos', 'ID', 'mass']])
+@pytest.mark.parametrize('toc_cache', [False, True])
+def test_load_prefetch(snapshot_file, monkeypatch, fields, toc_cache):
+    fname, original = snapshot_file
+    toc = load(fname).table_of_contents(cache=toc_cache)
+    prefetched = []
+    read_at = PrefetchingFortranFile._read_at
+
+    def spy(self, f, offset):
+        prefetched.append(offset)
+        return read_at(self, f, offset)
+    monkeypatch.setattr(PrefetchingFortranFile, '_read_at', spy)
+
+    s = load(fname, fields=fields, prefetch=True, toc_cache=toc_cache)
+    assert_blocks_equal(s, original, fields)
+    if fields is not None:
+        assert len(s.u[0]) == 0
+        assert sorted(set(prefetched)) == sorted(
+            entry.offset for entry in toc if entry.name in fields)
+
+
+def test_load_prefetch_cached_toc(snapshot_file, monkeypatch):
+    fname, original = snapshot_file
+    load(fname).table_of_contents(cache=True)
+    skipped = []
+    skip_record = FortranFile.skip_record
+
+    def spy(self):
+        skipped.append(self.tell())
+        return skip_record(self)
+    monkeypatch.setattr(FortranFile, 'skip_record', spy)
+
+    s = load(fname, fields=['vel'], prefetch=True, toc_cache=True)
+    assert_blocks_equal(s, original, ['vel'])
+    # Only the first record is skipped, to detect the format.
+    assert skipped == [0]
+
+
+def test_load_prefetch_ptypes(snapshot_file, monkeypatch):
+    fname, original = snapshot_file
+    opened = []
+    monkeypatch.setattr(PrefetchingFortranFile, '_open',
+                        lambda self: opened.append(self))
+    s = load(fname, ptypes=[4], prefetch=True)
+    np.testing.assert_array_equal(s.pos[4], original.pos[4])
+    assert opened == []
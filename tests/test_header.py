@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+import glio
+from glio.snapshot import SnapshotIOException
+
+from conftest import fill
+
+
+@pytest.fixture
+def header(tmp_path):
+    return fill(glio.GadgetSnapshot(str(tmp_path / 'snap'))).header
+
+
+def test_valid(header):
+    assert header.verify() == []
+
+
+@pytest.mark.parametrize('name, value', [
+    ('npart', np.zeros(5, dtype='i4')),
+    ('npart', 3),
+    ('mass', np.zeros(7)),
+    ('BoxSize', np.zeros(2)),
+])
+def test_wrong_shape(header, name, value):
+    setattr(header, name, value)
+    assert header.verify() == [name]
+
+
+@pytest.mark.parametrize('name, value', [
+    ('npart', np.array([1.5] * 6)),
+    ('num_files', 1.0),
+    ('npartTotal', np.ones(6, dtype='f4')),
+    ('BoxSize', 'large'),
+    ('time', None),
+])
+def test_wrong_kind(header, name, value):
+    setattr(header, name, value)
+    assert header.verify() == [name]
+
+
+@pytest.mark.parametrize('name, value', [
+    ('npart', [1, 2, 3, 4, 5, 6]),
+    ('npartTotal', np.arange(6, dtype='i8')),
+    ('num_files', np.int64(2)),
+    ('BoxSize', 50),
+    ('mass', np.ones(6, dtype='f4')),
+])
+def test_compatible_kind(header, name, value):
+    setattr(header, name, value)
+    assert header.verify() == []
+
+
+def test_several_malformed(header):
+    header.npart = np.zeros(5, dtype='i4')
+    header.time = 'now'
+    header.BoxSize = np.ones(1, dtype='c16')
+    assert header.verify() == ['npart', 'time', 'BoxSize']
+
+
+def test_save_invalid_raises(header, tmp_path):
+    header.npart = np.array([1.5] * 6)
+    with pytest.raises(SnapshotIOException):
+        header.save(str(tmp_path / 'header'))
+
+
+def test_round_trip(header, tmp_path):
+    fname = str(tmp_path / 'header')
+    header.redshift = 2.5
+    header.save(fname)
+    loaded = glio.GadgetSnapshot(fname).header
+    loaded.load()
+    for (name, value) in header.iterfields():
+        np.testing.assert_array_equal(getattr(loaded, name), value)
+    assert loaded.to_array().dtype == header.dtype
@@ -0,0 +1,152 @@
+import gc
+import weakref
+
+import numpy as np
+import pytest
+
+import glio
+from glio import sidecar
+from glio.snapshot import SnapshotIOException
+
+from conftest import fill, load
+
+
+def cached_orders(fname):
+    """Return the arrays of the ids sidecar to fname, as read by load()."""
+    return sidecar.load_arrays(fname, 'ids', load(fname)._sidecar_key())
+
+
+def test_select_ids(snapshot_file):
+    fname, original = snapshot_file
+    s = load(fname)
+    ids = np.concatenate([original.ID[4][[3, 0, 7]], original.ID[0][:2],
+                          [10 ** 6]])
+    rows = s.select_ids(ids)
+    assert len(rows[2]) == 0
+    np.testing.assert_array_equal(rows[4], [3, 0, 7])
+    np.testing.assert_array_equal(rows[0], [0, 1])
+    assert len(rows[1]) == 0
+    np.testing.assert_array_equal(s.ID[4][rows[4]], ids[:3])
+
+
+def test_select_ids_ptypes(snapshot_file):
+    fname, original = snapshot_file
+    s = load(fname)
+    rows = s.select_ids(original.ID[0][:5], ptypes=['gas', 4])
+    np.testing.assert_array_equal(rows[0], np.arange(5))
+    assert rows[1] is None and rows[2] is None
+    assert len(rows[4]) == 0
+
+
+def test_select_ids_after_reassignment(snapshot_file):
+    fname, _ = snapshot_file
+    s = load(fname)
+    s.select_ids([1])
+    s.ID[0] = np.arange(100, 150, dtype=s.ID[0].dtype)
+    np.testing.assert_array_equal(s.select_ids([101, 149])[0], [1, 49])
+
+
+def test_match_ids(tmp_path):
+    s = fill(glio.GadgetSnapshot(str(tmp_path / 'a')))
+    t = fill(glio.GadgetSnapshot(str(tmp_path / 'b')), seed=1)
+    # Some gas particles of s have become star particles of t.
+    t.ID[4][:5] = s.ID[0][10:15]
+    i, j = s.match_ids(t, 'gas', 'star')
+    np.testing.assert_array_equal(j, np.arange(5))
+    np.testing.assert_array_equal(s.ID[0][i], t.ID[4][j])
+
+    i, j = s.match_ids(t, 0)
+    np.testing.assert_array_equal(s.ID[0][i], t.ID[0][j])
+    assert len(i) == len(np.intersect1d(s.ID[0], t.ID[0]))
+
+
+def test_no_ids(snapshot_file):
+    fname, _ = snapshot_file
+    s = load(fname)
+    s.ID[0] = None
+    with pytest.raises(SnapshotIOException):
+        s.select_ids([1], ptypes=[0])
+
+
+def test_index_ids_cache(snapshot_file):
+    fname, _ = snapshot_file
+    s = load(fname)
+    s.index_ids(cache=True)
+    cached = cached_orders(fname)
+    for p in (0, 1, 4):
+        np.testing.assert_array_equal(cached['order%d' % p],
+                                      np.argsort(s.ID[p], kind='mergesort'))
+
+    t = load(fname)
+    t.index_ids(cache=True)
+    for p in (0, 1, 4):
+        np.testing.assert_array_equal(t._id_index[p][1],
+                                      cached['order%d' % p])
+
+
+def test_index_ids_cache_partial_load(snapshot_file):
+    fname, original = snapshot_file
+    s = load(fname, ptypes=[0])
+    s.index_ids(cache=True)
+    cached = cached_orders(fname)
+    assert 'order0' in cached
+    assert 'order1' not in cached and 'order4' not in cached
+
+    t = load(fname)
+    t.index_ids(cache=True)
+    ids = original.ID[4][[4, 2]]
+    np.testing.assert_array_equal(t.select_ids(ids)[4], [4, 2])
+    cached = cached_orders(fname)
+    assert 'order1' in cached and 'order4' in cached
+
+    # A later partial load keeps the cached orders of the other types.
+    u = load(fname, ptypes=[1])
+    u.index_ids(cache=True)
+    assert sorted(cached_orders(fname)) == sorted(cached)
+
+
+def test_index_releases_reassigned_ids(snapshot_file):
+    fname, _ = snapshot_file
+    s = load(fname)
+    s.select_ids([1])
+    old = weakref.ref(s.ID[0])
+    s.ID = [None if ids is None else ids.copy() for ids in s.ID]
+    gc.collect()
+    assert old() is None
+    np.testing.assert_array_equal(s.ID[0][s.select_ids([1])[0]], [1])
+
+
+def test_index_ids_cache_after_sort(snapshot_file):
+    fname, original = snapshot_file
+    load(fname).index_ids(cache=True)
+    cached = cached_orders(fname)
+
+    # Once reordered, the IDs are not those of the file, so the cache is
+    # neither used nor overwritten.
+    s = load(fname)
+    s.sort_peano_hilbert()
+    s.index_ids(cache=True)
+    for p in (0, 1, 4):
+        ids = original.ID[p][:5]
+        np.testing.assert_array_equal(s.ID[p][s.select_ids(ids)[p]], ids)
+    written = cached_orders(fname)
+    for p in (0, 1, 4):
+        np.testing.assert_array_equal(written['order%d' % p],
+                                      cached['order%d' % p])
+
+
+def test_index_ids_cache_key(snapshot_file):
+    fname, _ = snapshot_file
+    load(fname).index_ids(cache=True)
+    other = glio.GadgetSnapshot(fname, ICfile=True)
+    other.load()
+    assert sidecar.load_arrays(fname, 'ids', other._sidecar_key()) is None
+    other.index_ids(cache=True)
+    assert cached_orders(fname) is None
+
+
+def test_index_ids_cache_without_file():
+    s = fill(glio.GadgetSnapshot(None))
+    with pytest.raises(SnapshotIOException):
+        s.index_ids(cache=True)
+    s.index_ids()
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+import glio
+from glio.mesh import _assign, _slab_jobs
+
+from conftest import BOX_SIZE, fill
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    return fill(glio.GadgetSnapshot(str(tmp_path / 'snap')),
+                npart=(500, 800, 0, 0, 200, 0))
+
+
+def total_mass(snapshot):
+    return sum(m.sum(dtype='f8') for m in snapshot.mass if m is not None)
+
+
+@pytest.mark.parametrize('scheme', ['ngp', 'cic', 'tsc'])
+@pytest.mark.parametrize('nprocs', [1, 3])
+def test_mass_conserved(snapshot, scheme, nprocs):
+    mesh = glio.deposit(snapshot, 16, scheme=scheme, nprocs=nprocs,
+                        chunk_size=100)
+    assert mesh.shape == (16, 16, 16)
+    assert np.all(mesh >= 0)
+    assert np.isclose(mesh.sum(), total_mass(snapshot))
+
+
+def test_density(snapshot):
+    mesh = glio.deposit(snapshot, 8, density=True)
+    assert np.isclose(mesh.sum() * (BOX_SIZE / 8) ** 3, total_mass(snapshot))
+
+
+def test_counts(snapshot):
+    mesh = glio.deposit(snapshot, 8, scheme='ngp', ptypes=['gas'],
+                        weights=None)
+    assert mesh.sum() == 500
+    assert np.all(mesh == np.round(mesh))
+
+
+def test_slabs_match_single_process(snapshot):
+    single = glio.deposit(snapshot, 12, scheme='tsc', nprocs=1)
+    split = glio.deposit(snapshot, 12, scheme='tsc', nprocs=4)
+    np.testing.assert_allclose(split, single)
+
+
+@pytest.mark.parametrize('scheme', ['ngp', 'cic', 'tsc'])
+def test_slabs_of_one_cell(snapshot, scheme):
+    single = glio.deposit(snapshot, 3, scheme=scheme, nprocs=1)
+    split = glio.deposit(snapshot, 3, scheme=scheme, nprocs=3, chunk_size=64)
+    np.testing.assert_allclose(split, single)
+
+
+@pytest.mark.parametrize('scheme', ['ngp', 'cic', 'tsc'])
+def test_slab_jobs(snapshot, scheme):
+    ngrid = 12
+    coords = snapshot.pos[1].astype('f8') * (ngrid / BOX_SIZE)
+    bounds = np.array([0, 3, 7, 12])
+    jobs = _slab_jobs(coords, None, ngrid, scheme, bounds)
+    zcells, _ = _assign(coords[:, 2], ngrid, scheme)
+    for (z0, z1, sent, w) in jobs:
+        # Exactly the particles assigned to some cell of the slab.
+        reach = ((zcells >= z0) & (zcells < z1)).any(axis=0)
+        expected = np.sort(coords[reach], axis=0)
+        np.testing.assert_array_equal(np.sort(sent, axis=0), expected)
+        assert w is None
+
+
+def test_ngp_cells(snapshot):
+    mesh = glio.deposit(snapshot, 10, scheme='ngp', ptypes=[0, 4],
+                        weights=None, chunk_size=64)
+    pos = np.concatenate([snapshot.pos[0], snapshot.pos[4]])
+    edges = np.linspace(0, BOX_SIZE, 11)
+    counts, _ = np.histogramdd(pos, bins=(edges, edges, edges))
+    np.testing.assert_array_equal(mesh, counts)
+
+
+@pytest.mark.parametrize('scheme', ['ngp', 'cic', 'tsc'])
+def test_cell_centre(snapshot, scheme):
+    # A particle at a cell's centre is assigned to that cell, and to its
+    # neighbours along each axis, symmetrically.
+    snapshot.pos[0] = np.array([[15., 25., 95.]], dtype='f4')
+    mesh = glio.deposit(snapshot, 10, scheme=scheme, ptypes=[0],
+                        weights=None)
+    assert mesh.argmax() == np.ravel_multi_index((1, 2, 9), mesh.shape)
+    if scheme == 'tsc':
+        # Wrapped periodically, across the edge at z = BoxSize.
+        assert np.isclose(mesh[1, 2, 0], mesh[1, 2, 8])
+        assert np.isclose(mesh[1, 2, 9], 0.75 ** 3)
+    else:
+        assert mesh[1, 2, 9] == 1
+
+
+def test_memmap(snapshot):
+    snapshot.save()
+    s = glio.GadgetSnapshot(snapshot.fname)
+    s.load(memmap=True)
+    np.testing.assert_allclose(glio.deposit(s, 8, nprocs=2, chunk_size=64),
+                               glio.deposit(snapshot, 8, nprocs=1))
+
+
+def test_invalid_box(snapshot):
+    snapshot.header.BoxSize = np.float64(0)
+    with pytest.raises(ValueError):
+        glio.deposit(snapshot, 8)
+
+
+def test_invalid_scheme(snapshot):
+    with pytest.raises(ValueError):
+        glio.deposit(snapshot, 8, scheme='pcs')
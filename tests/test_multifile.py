@@ -0,0 +1,215 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+import glio
+from glio.multifile import subfile_names
+from glio.snapshot import SnapshotBase, SnapshotIOException
+
+from conftest import fill
+
+SUBFILE_NPART = [(20, 30, 0, 0, 10, 0), (20, 30, 0, 0, 0, 0),
+                 (10, 20, 0, 0, 10, 0)]
+
+
+def concatenate(subs, name, ptype):
+    return np.concatenate([getattr(s, name)[ptype] for s in subs])
+
+
+def write_subfiles(fname, **kwargs):
+    """Save three sub-files of fname, created with kwargs, and return each."""
+    total = np.sum(SUBFILE_NPART, axis=0)
+    subs = []
+    for (i, sub_fname) in enumerate(subfile_names(fname, 3)):
+        sub = fill(glio.GadgetSnapshot(sub_fname, **kwargs),
+                   npart=SUBFILE_NPART[i], seed=i)
+        sub.update_header()
+        sub.header.num_files = np.int32(3)
+        sub.header.npartTotal = total.astype('u4')
+        # GadgetSnapshot.save() permits only single-file snapshots.
+        SnapshotBase.save(sub)
+        subs.append(sub)
+    return subs
+
+
+@pytest.fixture
+def multi_file(tmp_path):
+    """Return the base name of a three sub-file snapshot, and each's data."""
+    fname = str(tmp_path / 'multi')
+    return (fname, write_subfiles(fname))
+
+
+def test_load(multi_file):
+    fname, subs = multi_file
+    s = glio.GadgetMultiSnapshot(fname)
+    s.load()
+    np.testing.assert_array_equal(s.header.npart, [50, 80, 0, 0, 20, 0])
+    assert len(s.subheaders) == 3
+    for p in (0, 1, 4):
+        for name in ('pos', 'vel', 'ID'):
+            np.testing.assert_array_equal(getattr(s, name)[p],
+                                          concatenate(subs, name, p))
+
+
+def test_header_mass(multi_file):
+    fname, _ = multi_file
+    s = glio.GadgetMultiSnapshot(fname)
+    s.load()
+    assert s.header.mass[1] == 2.5
+    assert len(s.mass[1]) == 80
+    assert np.all(s.mass[1] == 2.5)
+
+
+def test_load_format2_missing_blocks(tmp_path):
+    fname = str(tmp_path / 'multi')
+    subs = write_subfiles(fname, ICfile=True, snap_format=2)
+    s = glio.GadgetMultiSnapshot(fname)
+    s.load()
+    assert s.snap_format == 2
+    np.testing.assert_array_equal(s.pos[0], concatenate(subs, 'pos', 0))
+    # Initial conditions have no rho or hsml blocks.
+    assert len(s.rho[0]) == 0
+    assert len(s.hsml[0]) == 0
+
+
+def test_load_selective(multi_file):
+    fname, subs = multi_file
+    s = glio.GadgetMultiSnapshot(fname)
+    s.load(fields=['pos', 'ID'], ptypes=[4])
+    np.testing.assert_array_equal(s.pos[4], concatenate(subs, 'pos', 4))
+    assert len(s.pos[0]) == 0
+    assert len(s.vel[4]) == 0
+
+
+def test_inconsistent_headers(multi_file):
+    fname, subs = multi_file
+    subs[1].header.npartTotal = subs[1].header.npartTotal + 1
+    SnapshotBase.save(subs[1])
+    with pytest.raises(SnapshotIOException):
+        glio.GadgetMultiSnapshot(fname).load()
+
+
+@pytest.mark.parametrize('call', [
+    lambda s: s.load(memmap=True),
+    lambda s: s.load(lazy=True),
+    lambda s: s.aload(),
+    lambda s: s.iter_chunks(['pos'], 0, 10),
+    lambda s: s.table_of_contents(),
+    lambda s: s.save_block('pos'),
+    lambda s: s.index_ids(cache=True),
+])
+def test_single_file_methods_unsupported(multi_file, call):
+    fname, _ = multi_file
+    s = glio.GadgetMultiSnapshot(fname)
+    s.load()
+    with pytest.raises(SnapshotIOException):
+        call(s)
+
+
+def by_id(snapshot, name, ptype):
+    """Return the data of block name for type ptype, in order of ID."""
+    order = np.argsort(snapshot.ID[ptype])
+    return getattr(snapshot, name)[ptype][order]
+
+
+@pytest.mark.parametrize('split', ['contiguous', 'id', 'slab'])
+def test_save(tmp_path, split):
+    fname = str(tmp_path / 'multi')
+    original = fill(glio.GadgetMultiSnapshot(fname))
+    original.save(num_files=3, split=split, nprocs=2)
+
+    total = np.zeros(6, dtype='i8')
+    for sub_fname in subfile_names(fname, 3):
+        sub = glio.GadgetSnapshot(sub_fname)
+        sub.load()
+        assert sub.header.num_files == 3
+        np.testing.assert_array_equal(sub.header.npartTotal,
+                                      [50, 80, 0, 0, 20, 0])
+        assert sub.header.mass[1] == 2.5
+        total += sub.header.npart
+    np.testing.assert_array_equal(total, [50, 80, 0, 0, 20, 0])
+
+    s = glio.GadgetMultiSnapshot(fname)
+    s.load()
+    for p in (0, 1, 4):
+        for name in ('pos', 'vel', 'mass'):
+            np.testing.assert_array_equal(by_id(s, name, p),
+                                          by_id(original, name, p))
+
+
+@pytest.mark.parametrize('method', ['spawn', 'forkserver'])
+def test_save_without_fork(tmp_path, monkeypatch, method):
+    if method not in multiprocessing.get_all_start_methods():
+        pytest.skip('%s start method is not available' % method)
+    # Worker processes import glio afresh, rather than inheriting it.
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.symlink(root, str(tmp_path / 'glio'))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(glio.multifile, '_process_context',
+                        lambda: multiprocessing.get_context(method))
+
+    fname = str(tmp_path / 'multi')
+    original = fill(glio.GadgetMultiSnapshot(fname))
+    original.save(num_files=2, split='id', nprocs=2)
+
+    s = glio.GadgetMultiSnapshot(fname)
+    s.load()
+    assert s.header.mass[1] == 2.5
+    assert s.mass[1].strides == (0, )
+    for p in (0, 1, 4):
+        for name in ('pos', 'mass'):
+            np.testing.assert_array_equal(by_id(s, name, p),
+                                          by_id(original, name, p))
+
+
+def test_save_split_by_id(tmp_path):
+    fname = str(tmp_path / 'multi')
+    fill(glio.GadgetMultiSnapshot(fname)).save(num_files=3, split='id')
+    ranges = []
+    for sub_fname in subfile_names(fname, 3):
+        sub = glio.GadgetSnapshot(sub_fname)
+        sub.load(fields=['ID'])
+        ids = np.concatenate([i for i in sub.ID if i is not None])
+        ranges.append((ids.min(), ids.max()))
+    assert ranges[0][1] < ranges[1][0] and ranges[1][1] < ranges[2][0]
+
+
+@pytest.mark.parametrize('split', ['contiguous', 'id', 'slab'])
+def test_save_empty(tmp_path, split):
+    fname = str(tmp_path / 'multi')
+    original = fill(glio.GadgetMultiSnapshot(fname), npart=(0, ) * 6)
+    original.header.BoxSize = np.float64(0)
+    original.save(num_files=2, split=split)
+
+    s = glio.GadgetMultiSnapshot(fname)
+    s.load()
+    np.testing.assert_array_equal(s.header.npart, [0] * 6)
+    assert len(s.subheaders) == 2
+    assert len(s.pos[0]) == 0
+
+
+def test_save_split_by_slab(tmp_path):
+    fname = str(tmp_path / 'multi')
+    fill(glio.GadgetMultiSnapshot(fname)).save(num_files=4, split='slab')
+    for (i, sub_fname) in enumerate(subfile_names(fname, 4)):
+        sub = glio.GadgetSnapshot(sub_fname)
+        sub.load(fields=['pos'])
+        x = np.concatenate([pos[:, 0] for pos in sub.pos])
+        assert np.all((x >= 25 * i) & (x < 25 * (i + 1)))
+
+
+def test_save_peano_hilbert(tmp_path):
+    fname = str(tmp_path / 'multi')
+    original = fill(glio.GadgetMultiSnapshot(fname))
+    reference = fill(glio.GadgetSnapshot(fname))
+    original.save(num_files=2, peano_hilbert=True, nprocs=2, nthreads=2)
+    for sub_fname in subfile_names(fname, 2):
+        assert os.path.exists(sub_fname + '.phkeys')
+
+    s = glio.GadgetMultiSnapshot(fname)
+    s.load()
+    for p in (0, 1, 4):
+        np.testing.assert_array_equal(by_id(s, 'pos', p),
+                                      by_id(reference, 'pos', p))
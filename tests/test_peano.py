@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+
+import glio
+from glio import gadget, sidecar
+from glio.peano import peano_hilbert_keys, PH_BITS
+from glio.snapshot import SnapshotIOException
+
+from conftest import BOX_SIZE, fill
+
+
+def cell_centres(bits):
+    n = 1 << bits
+    cells = np.indices((n, n, n)).reshape(3, -1).T
+    return cells, (cells + 0.5) / n
+
+
+@pytest.mark.parametrize('bits', [1, 2, 3, 4])
+def test_keys_bijection(bits):
+    cells, pos = cell_centres(bits)
+    keys = peano_hilbert_keys(pos, np.zeros(3), 1.0, bits=bits)
+    assert keys.dtype == np.uint64
+    np.testing.assert_array_equal(np.sort(keys), np.arange(len(pos)))
+
+    # Cells consecutive along the curve are adjacent.
+    path = cells[np.argsort(keys)]
+    steps = np.abs(np.diff(path, axis=0)).sum(axis=1)
+    assert np.all(steps == 1)
+
+
+def test_keys_cube():
+    _, pos = cell_centres(3)
+    keys = peano_hilbert_keys(pos, np.zeros(3), 1.0, bits=3)
+    shifted = peano_hilbert_keys(pos * 20 - 5, -5 * np.ones(3), 20.0, bits=3)
+    np.testing.assert_array_equal(keys, shifted)
+
+    # Positions outside the cube are placed in the nearest cell.
+    outside = np.array([[-1.0, -1.0, -1.0], [2.0, 0.01, 0.01]])
+    inside = np.array([[0.01, 0.01, 0.01], [0.99, 0.01, 0.01]])
+    np.testing.assert_array_equal(
+        peano_hilbert_keys(outside, np.zeros(3), 1.0, bits=3),
+        peano_hilbert_keys(inside, np.zeros(3), 1.0, bits=3))
+
+
+def test_keys_full_order():
+    pos = np.random.RandomState(0).random_sample((1000, 3))
+    keys = peano_hilbert_keys(pos, np.zeros(3), 1.0)
+    assert keys.max() < 1 << (3 * PH_BITS)
+    # Keys at a lower order are those at full order, truncated.
+    coarse = peano_hilbert_keys(pos, np.zeros(3), 1.0, bits=4)
+    np.testing.assert_array_equal(coarse, keys >> np.uint64(3 * (PH_BITS - 4)))
+
+
+@pytest.mark.parametrize('bits', [0, PH_BITS + 1])
+def test_keys_invalid_bits(bits):
+    with pytest.raises(ValueError):
+        peano_hilbert_keys(np.zeros((1, 3)), np.zeros(3), 1.0, bits=bits)
+
+
+def by_id(snapshot, ptype):
+    """Return the data of each field for particles of type ptype, by ID."""
+    order = np.argsort(snapshot.ID[ptype])
+    data = {}
+    for name in snapshot.fields:
+        parray = getattr(snapshot, name)[ptype]
+        if parray is not None and len(parray) > 0:
+            data[name] = parray[order]
+    return data
+
+
+@pytest.mark.parametrize('box', [BOX_SIZE, 0.0], ids=['periodic', 'open'])
+def test_sort_peano_hilbert(tmp_path, box):
+    s = fill(glio.GadgetSnapshot(str(tmp_path / 'snap')))
+    s.header.BoxSize = np.float64(box)
+    before = [by_id(s, p) for p in range(6)]
+
+    keys = s.sort_peano_hilbert()
+    origin, size = s._ph_cube()
+    for p in range(6):
+        np.testing.assert_array_equal(
+            keys[p], peano_hilbert_keys(s.pos[p], origin, size))
+        assert np.all(np.diff(keys[p].astype('f8')) >= 0)
+        after = by_id(s, p)
+        assert sorted(after) == sorted(before[p])
+        for name in after:
+            np.testing.assert_array_equal(after[name], before[p][name])
+    # Masses given in the header are not copied.
+    assert s._is_header_mass_array(s.mass[1])
+
+
+def test_sort_peano_hilbert_mismatch(tmp_path):
+    s = fill(glio.GadgetSnapshot(str(tmp_path / 'snap')))
+    s.vel[4] = s.vel[4][:-1]
+    pos = [a.copy() for a in s.pos]
+    with pytest.raises(SnapshotIOException):
+        s.sort_peano_hilbert()
+    for (a, b) in zip(s.pos, pos):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_save_phkeys(snapshot_file, monkeypatch):
+    fname, original = snapshot_file
+    monkeypatch.setattr(gadget, '_g_ph_chunk_size', 16)
+    s = glio.GadgetSnapshot(fname)
+    s.load()
+    s.save(peano_hilbert=True)
+
+    content = sidecar.load_json(fname, 'phkeys')
+    assert content['bits'] == PH_BITS
+    assert content['origin'] == [0.0, 0.0, 0.0]
+    assert content['size'] == BOX_SIZE
+    assert content['chunk_size'] == 16
+
+    saved = glio.GadgetSnapshot(fname)
+    saved.load()
+    for p in range(6):
+        keys = peano_hilbert_keys(saved.pos[p], [0.0, 0.0, 0.0], BOX_SIZE)
+        expected = [[int(keys[b]), int(keys[min(b + 16, len(keys)) - 1])]
+                    for b in range(0, len(keys), 16)]
+        assert content['ranges'][p] == expected
+        np.testing.assert_array_equal(np.sort(saved.ID[p]),
+                                      np.sort(original.ID[p]))
+        assert np.all(np.diff(keys.astype('f8')) >= 0)
+
+
+def test_save_incomplete_unchanged(snapshot_file):
+    fname, _ = snapshot_file
+    s = glio.GadgetSnapshot(fname)
+    s.load(fields=['pos', 'ID'])
+    pos = [a.copy() for a in s.pos]
+    with pytest.raises(SnapshotIOException):
+        s.save(fname=fname + '.new', peano_hilbert=True)
+    for (a, b) in zip(s.pos, pos):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_multi_save_incomplete_unchanged(tmp_path):
+    s = fill(glio.GadgetMultiSnapshot(str(tmp_path / 'multi')))
+    s.vel[0] = None
+    pos = [a.copy() for a in s.pos]
+    with pytest.raises(SnapshotIOException):
+        s.save(num_files=2, peano_hilbert=True)
+    for (a, b) in zip(s.pos, pos):
+        np.testing.assert_array_equal(a, b)
@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+
+import glio
+from glio import sidecar
+
+from conftest import BOX_SIZE, fill
+
+
+@pytest.fixture(params=[True, False], ids=['periodic', 'open'])
+def snapshot(request, tmp_path):
+    s = fill(glio.GadgetSnapshot(str(tmp_path / 'snap')),
+             npart=(400, 300, 0, 0, 50, 0))
+    if not request.param:
+        s.header.BoxSize = np.float64(0)
+    return s
+
+
+def distances(snapshot, ptype, point):
+    """Return the distance of every particle of type ptype from point."""
+    offset = snapshot.pos[ptype] - np.asarray(point)
+    if snapshot.header.BoxSize > 0:
+        offset -= BOX_SIZE * np.round(offset / BOX_SIZE)
+    return np.sqrt((offset ** 2).sum(axis=1))
+
+
+# Points inside the box, near its edges and corners, and outside it.
+POINTS = [(50, 50, 50), (1, 99, 50), (0.5, 0.5, 99.5), (-20, 130, 50),
+          (500, 500, 500)]
+
+
+@pytest.mark.parametrize('point', POINTS)
+@pytest.mark.parametrize('radius', [3, 15, 60])
+def test_sphere(snapshot, point, radius):
+    index = glio.SpatialIndex(snapshot)
+    rows = index.sphere(point, radius)
+    for p in range(6):
+        expected = np.nonzero(distances(snapshot, p, point) <= radius)[0]
+        np.testing.assert_array_equal(rows[p], expected)
+
+
+@pytest.mark.parametrize('lower, upper', [
+    ((10, 20, 30), (40, 50, 60)),
+    ((-10, -10, -10), (10, 10, 10)),
+    ((90, 0, 95), (110, 100, 105)),
+    ((-50, -50, -50), (200, 200, 200)),
+    ((150, 150, 150), (160, 160, 160)),
+])
+def test_box(snapshot, lower, upper):
+    index = glio.SpatialIndex(snapshot, ptypes=['gas', 'star'])
+    rows = index.box(lower, upper)
+    assert rows[1] is None
+    lower, upper = np.asarray(lower), np.asarray(upper)
+    for p in (0, 4):
+        pos = snapshot.pos[p]
+        if snapshot.header.BoxSize > 0:
+            offset = (pos - lower) % BOX_SIZE
+            width = upper - lower
+            inside = np.all((offset <= width) | (width >= BOX_SIZE), axis=1)
+        else:
+            inside = np.all((pos >= lower) & (pos <= upper), axis=1)
+        np.testing.assert_array_equal(rows[p], np.nonzero(inside)[0])
+
+
+@pytest.mark.parametrize('point', POINTS)
+@pytest.mark.parametrize('k', [1, 10, 50, 1000])
+def test_nearest(snapshot, point, k):
+    index = glio.SpatialIndex(snapshot)
+    for p in (0, 4):
+        rows, dist = index.nearest(point, k, p)
+        expected = np.sort(distances(snapshot, p, point))[:k]
+        assert len(rows) == min(k, len(snapshot.pos[p]))
+        np.testing.assert_allclose(dist, expected)
+        np.testing.assert_allclose(distances(snapshot, p, point)[rows], dist)
+
+
+def test_nearest_outside_extent(tmp_path):
+    s = fill(glio.GadgetSnapshot(str(tmp_path / 'snap')),
+             npart=(100, 0, 0, 0, 0, 0))
+    s.header.BoxSize = np.float64(0)
+    s.pos[0] = s.pos[0] / BOX_SIZE
+    index = glio.SpatialIndex(s, ptypes=[0])
+    rows, dist = index.nearest((10, 10, 10), 5, 0)
+    assert len(rows) == 5
+    expected = np.sort(distances(s, 0, (10, 10, 10)))[:5]
+    np.testing.assert_allclose(dist, expected)
+
+
+def test_view(snapshot):
+    index = glio.SpatialIndex(snapshot)
+    rows = index.sphere((50, 50, 50), 20)[1]
+    view = index.view('halo', rows, fields=['pos', 'ID'])
+    np.testing.assert_array_equal(view.pos, snapshot.pos[1][rows])
+    np.testing.assert_array_equal(view.ID, snapshot.ID[1][rows])
+
+
+def test_cache(snapshot_file):
+    fname, _ = snapshot_file
+    s = glio.GadgetSnapshot(fname)
+    s.load()
+    index = glio.SpatialIndex(s, ncells=4, cache=True)
+    assert sidecar.load_arrays(fname, 'grid', s._sidecar_key()) is not None
+
+    cached = glio.SpatialIndex(s, cache=True)
+    assert cached.ncells == 4
+    for p in index.ptypes:
+        np.testing.assert_array_equal(cached._order[p], index._order[p])
+    np.testing.assert_array_equal(cached.sphere((10, 10, 10), 30)[0],
+                                  index.sphere((10, 10, 10), 30)[0])
+    # A different grid is built, not read from the cache.
+    assert glio.SpatialIndex(s, ncells=5, cache=True).ncells == 5
+
+
+def test_cache_after_load_ptypes(snapshot_file):
+    fname, original = snapshot_file
+    partial = glio.GadgetSnapshot(fname)
+    partial.load(ptypes=[0])
+    glio.SpatialIndex(partial, cache=True)
+
+    # The cache of the partial load holds no halo particles, and is not used.
+    s = glio.GadgetSnapshot(fname)
+    s.load()
+    index = glio.SpatialIndex(s, cache=True)
+    centre = np.full(3, BOX_SIZE / 2)
+    assert len(index.sphere(centre, BOX_SIZE)[1]) == len(original.pos[1])
+    rows, _ = index.nearest(centre, 5, 1)
+    assert len(rows) == 5
@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+
+import glio
+from glio.snapshot import SnapshotIOException
+from glio.sph import _cubic_spline, _projected_kernel, _smooth
+
+from conftest import BOX_SIZE, fill
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    s = fill(glio.GadgetSnapshot(str(tmp_path / 'snap')),
+             npart=(400, 100, 0, 0, 0, 0))
+    # Kernels spanning from less than one to several cells.
+    s.hsml[0] = s.hsml[0] * 20
+    return s
+
+
+def gas_mass(snapshot):
+    return snapshot.mass[0].sum(dtype='f8')
+
+
+@pytest.mark.parametrize('axis', [0, 1, 2])
+def test_projection_normalized(snapshot, axis):
+    npix = 32
+    image = glio.project(snapshot, npix, axis=axis, nthreads=2)
+    assert image.shape == (npix, npix)
+    assert np.isclose(image.sum() * (BOX_SIZE / npix) ** 2,
+                      gas_mass(snapshot))
+
+
+def test_smooth_normalized(snapshot):
+    ngrid = 16
+    grid = glio.smooth(snapshot, ngrid, nthreads=2)
+    assert grid.shape == (ngrid, ngrid, ngrid)
+    assert np.isclose(grid.sum() * (BOX_SIZE / ngrid) ** 3,
+                      gas_mass(snapshot))
+
+
+def test_threads_agree(snapshot):
+    single = glio.smooth(snapshot, 16, nthreads=1)
+    many = glio.smooth(snapshot, 16, nthreads=5)
+    np.testing.assert_allclose(many, single)
+
+
+def test_threads_share_chunks(snapshot, monkeypatch):
+    single = glio.project(snapshot, 24, nthreads=1)
+    # Several chunks of each span, dealt out between threads.
+    monkeypatch.setattr(glio.sph, '_CHUNK_CELLS', 64)
+    many = glio.project(snapshot, 24, nthreads=3)
+    np.testing.assert_allclose(many, single)
+
+
+def test_mean_quantity(snapshot):
+    snapshot.rho[0][:] = 3.0
+    image = glio.project(snapshot, 32, quantity='rho')
+    assert np.any(image > 0)
+    np.testing.assert_allclose(image[image > 0], 3.0)
+
+
+def test_single_kernel():
+    coords = np.array([[5.3, 7.7, 2.1]])
+    h = np.array([2.6])
+    total, _ = _smooth(coords, h, np.ones(1), None, 16, True, _cubic_spline,
+                       3)
+
+    centres = np.indices((16, 16, 16)).reshape(3, -1).T + 0.5
+    d = centres - coords
+    d -= 16 * np.round(d / 16)
+    expected = _cubic_spline(np.sqrt((d ** 2).sum(axis=1)) / h[0])
+    np.testing.assert_allclose(total.ravel(), expected / expected.sum())
+
+
+def test_region_truncated(snapshot):
+    image = glio.project(snapshot, 16, origin=(10, 10), size=20)
+    assert image.shape == (16, 16)
+    assert image.sum() * (20. / 16) ** 2 < gas_mass(snapshot)
+
+
+def test_small_kernel(snapshot):
+    # Kernels reaching no cell centre are assigned to the containing cell.
+    snapshot.pos[0] = np.array([[12.4, 31.3, 77.0], [60.1, 5.2, 90.0]],
+                               dtype='f4')
+    snapshot.hsml[0] = np.array([0.01, 0.02], dtype='f4')
+    snapshot.mass[0] = np.array([1.0, 2.0], dtype='f4')
+    grid = glio.smooth(snapshot, 10) * (BOX_SIZE / 10) ** 3
+    assert grid[1, 3, 7] == 1
+    assert grid[6, 0, 9] == 2
+    assert grid.sum() == 3
+
+
+@pytest.mark.parametrize('axis, plane', [(0, (1, 2)), (1, (0, 2)),
+                                         (2, (0, 1))])
+def test_projection_axes(snapshot, axis, plane):
+    pos = np.array([[15., 45., 85.]])
+    snapshot.pos[0] = pos.astype('f4')
+    snapshot.hsml[0] = np.array([12.], dtype='f4')
+    snapshot.mass[0] = np.ones(1, dtype='f4')
+    image = glio.project(snapshot, 10, axis=axis)
+    peak = np.unravel_index(image.argmax(), image.shape)
+    assert peak == tuple(int(pos[0, d] // 10) for d in plane)
+    # Symmetric about the particle, which is at a pixel centre.
+    i, j = peak
+    assert np.isclose(image[i - 1, j], image[i + 1, j])
+    assert np.isclose(image[i, j - 1], image[i, (j + 1) % 10])
+
+
+def test_projected_kernel():
+    # The line-of-sight integral of the kernel, directly.
+    q = np.linspace(0, 1.2, 13)
+    z = np.linspace(-1, 1, 20001)
+    kern = _cubic_spline(np.sqrt(q[:, np.newaxis] ** 2 + z ** 2))
+    expected = (kern[:, 1:] + kern[:, :-1]).sum(axis=1) * (z[1] - z[0]) / 2
+    np.testing.assert_allclose(_projected_kernel(q), expected, atol=1e-3)
+
+
+def test_invalid(snapshot):
+    with pytest.raises(ValueError):
+        glio.project(snapshot, 8, axis=3)
+    with pytest.raises(SnapshotIOException):
+        glio.smooth(snapshot, 8, ptype=1)
+    snapshot.header.BoxSize = np.float64(0)
+    with pytest.raises(ValueError):
+        glio.smooth(snapshot, 8)
+    with pytest.raises(ValueError):
+        glio.project(snapshot, 8)
+    # An explicit region needs no box.
+    image = glio.project(snapshot, 8, origin=(0, 0), size=BOX_SIZE)
+    assert image.shape == (8, 8)